@@ -1,6 +1,20 @@
 import serial
 import numpy as np
 import time
+import collections
+import contextlib
+import re
+import threading
+import zlib
+from concurrent.futures import Future
+from .firmware import (render, sync_freq, format_float, cmd_name,
+                       trigger_schedule, SER_BUFFER_SIZE, SYNC_STATE,
+                       SYNC_PERF, PERF_BIN_EDGES, TRIGGER_PROG_SIZE)
+from . import pack
+
+# Allows "emu://" URLs to be opened as serial ports (see emulator.py)
+if 'ad_sync' not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append('ad_sync')
 
 
 class ADSyncError(Exception):
@@ -10,17 +24,55 @@ class ADSyncError(Exception):
 class ADSync:
     ANALOG_RANGE = 20
     ANALOG_MAX = 65536
+    FREQ_MIN = 30
     FREQ_MAX = 700000
     MAX_ADDR = 16384
-
-    def __init__(self, port, baud=921600, timeout=0.5, debug=False):
+    # Approximate cost (in bytes) of sending an extra SYNC WRITE command: the
+    #   command header plus the reply.  Used by `update` to decide when it is
+    #   cheaper to resend unchanged samples than to split a write.
+    WRITE_OVERHEAD = 96
+    # Flow control: at most WINDOW bytes of commands are sent ahead of the
+    #   replies, which is the size of the device serial receive buffer.
+    #   Writes are split into chunks of at most WRITE_CHUNK bytes, so that two
+    #   of them (plus their headers) fit in the window.
+    WINDOW = SER_BUFFER_SIZE
+    WRITE_CHUNK = SER_BUFFER_SIZE // 2 - 32
+    # Maximum samples per SYNC READ, so that the reply fits in the device
+    #   output buffer
+    READ_CHUNK = (SER_BUFFER_SIZE - 32) // 4
+    # The sync memory is split into two banks by `update_bank`, so that one
+    #   can be written while the other is output
+    BANK_SIZE = MAX_ADDR // 2
+    # Polling interval of `wait_swap`, in seconds
+    SWAP_POLL = 0.005
+    # Polling interval of `wait_trigger`, in seconds
+    TRIGGER_POLL = 0.01
+    # The device settings mirrored by ADSync; the names used by `settings`
+    #   for each setting command
+    SETTINGS = {
+        "SYNC RATE": "rate",
+        "SYNC ADDR": "addr",
+        "SYNC ACTIVE": "active",
+        "SYNC MODE": "mode",
+        "ANA0 SCALE": "ana0_scale",
+        "ANA1 SCALE": "ana1_scale",
+        "ANA0 SET": "ana0_set",
+        "ANA1 SET": "ana1_set",
+        "TRIGGER MASK": "trigger_mask",
+        "LED": "led",
+    }
+
+    def __init__(self, port, baud=921600, timeout=0.5, debug=False,
+                 max_rate=None):
         """
         Initialize a AD sync device.
 
         Parameters
         ----------
         port : string
-            The serial port address of the device.
+            The serial port address of the device.  Can also be a pyserial
+            URL; in particular "emu://" connects to an emulated device (see
+            `ad_sync.emulator`).
 
         Keywords
         --------
@@ -28,14 +80,44 @@ class ADSync:
         timeout : float (default: 0.5)
         debug : bool (default: False)
             If true, prints out all serial communcation with the device.
+        max_rate : float (default: None)
+            If specified, the maximum rate (in Hz) at which each setting
+            (analog scale and value, modes, LED and trigger mask) is sent to
+            the device.  Changes made faster than this are deferred, and only
+            the latest value is sent.  Can also be changed later with the
+            `max_rate` attribute.
         """
         self.debug = debug
-        self.ser = serial.Serial(port=None, baudrate=baud, timeout=timeout)
-        self.ser.port = port
+        self.max_rate = max_rate
+        # Serializes access to the device, so that deferred settings can be
+        #   sent from a timer thread
+        self._lock = threading.RLock()
+        # Mirror of the device settings: the last (value, reply) for each
+        #   setting command, the settings waiting for the rate limit
+        #   (value, command, future), and the last send time
+        self._settings = {}
+        self._deferred = {}
+        self._set_time = {}
+        self._staging = False
+        # Host side copy of the sync memory, used by `update`.  Only entries
+        #   flagged as valid are known to match the device.
+        self._shadow = np.zeros(self.MAX_ADDR, dtype='uint32')
+        self._shadow_valid = np.zeros(self.MAX_ADDR, dtype=bool)
+        # Named slots of the sync memory (see `upload_slot`): name -> (addr,
+        #   data, rate), least recently used first
+        self._slots = collections.OrderedDict()
+        self.ser = serial.serial_for_url(port, baudrate=baud, timeout=timeout,
+                                         do_not_open=True)
         self.ser.rts = False
         self.ser.dtr = False
         self.ser.open()
         self.byte_rate = baud / 10
+        self._last_cmd = b''
+        # List of queued (command, reader, parse, future) entries when batching
+        self._batch = None
+        self._firmware_version = None
+        # Transfer statistics of the last write
+        self.write_stats = None
 
     def reset(self):
         """
@@ -44,26 +126,46 @@ class ADSync:
         Note: this works by activing the RTS bit on the serial port, which
         will *not* work over bluetooth!
         """
-        self.ser.rts = True
-        time.sleep(0.5)
-        self.ser.rts = False
-        time.sleep(1.0)
-        self.ser.flush()
+        with self._lock:
+            self.invalidate_shadow()
+            self.invalidate_settings()
+            self.ser.rts = True
+            time.sleep(0.5)
+            self.ser.rts = False
+            time.sleep(1.0)
+            self.ser.flush()
 
     def idn(self):
         "Return identification string."
         self._cmd("*IDN")
         return(self._reply())
 
+    @property
+    def firmware_version(self):
+        "The firmware version of the device, as a (major, minor) tuple."
+        if self._firmware_version is None:
+            # This is needed right away, so it can't be part of a batch
+            batch, self._batch = self._batch, None
+            try:
+                reply = self.idn()
+            finally:
+                self._batch = batch
+
+            self._firmware_version = self._parse_version(reply)
+
+        return self._firmware_version
+
+    @staticmethod
+    def _parse_version(reply):
+        m = re.search(rb'version (\d+)\.(\d+)', reply)
+        return (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+
     def stat(self):
         "Return statistics on sync output."
         self._cmd("SYNC STAT")
         return(self._reply())
 
     def _cmd(self, *args):
-        if self.ser.in_waiting:
-            self.ser.reset_input_buffer()
-
         cmd = []
         for arg in args:
             if isinstance(arg, str):
@@ -83,60 +185,578 @@ class ADSync:
                 )
 
         cmd = b' '.join(cmd) + b'\n'
-        self.ser.write(cmd)
-
         self._last_cmd = cmd
 
-        if self.debug:
-            print("Wrote to device: ", cmd)
+        # When batching, the command is sent later by _flush
+        if self._batch is None:
+            # Held until the reply has been read (in _result)
+            self._lock.acquire()
+            try:
+                if self.ser.in_waiting:
+                    self.ser.reset_input_buffer()
+
+                self.ser.write(cmd)
+            except BaseException:
+                self._lock.release()
+                raise
+
+            if self.debug:
+                print("Wrote to device: ", cmd)
 
         return cmd
 
-    def _reply(self):
-        reply = self.ser.readline().strip()
+    def _error(self, reply, cmd):
+        if len(cmd) > 31:
+            cmd = cmd[:28] + b'...'
+        return ADSyncError(reply[6:].decode('utf-8').strip()
+            + "\n(serial command: %s)" % repr(cmd))
+
+    @property
+    def _input(self):
+        # The stream which replies are read from
+        return self.ser
+
+    def _read_reply(self, cmd):
+        reply = self._input.readline().strip()
         if reply.startswith(b'ERROR:'):
-            lc = self._last_cmd
-            if len(lc) > 31:
-                lc = lc[:28] + b'...'
-            raise ADSyncError(reply[6:].decode('utf-8').strip()
-                + "\n(serial command: %s)" % repr(lc))
+            raise self._error(reply, cmd)
 
         if self.debug:
             print("Received from device ", reply)
 
         return reply
 
-    def _bin_reply(self, err=True):
-        c = self.ser.read()
+    def _read_bin_reply(self, cmd, err=True):
+        c = self._input.read()
         if c == b'>':
-            header = self.ser.read_until(b'>')
+            header = self._input.read_until(b'>')
             try:
                 nbytes = int(header[:-1])
             except ValueError:
                 raise ADSyncError(
-                    'expected binary reply, device returned invalid size' %
-                    (c + header)
+                    'expected binary reply, device returned invalid size (%s)'
+                    % repr(c + header)
                 )
-            data = self.ser.read(nbytes)
+            data = self._input.read(nbytes)
             # Should be a newline at the end -> lets flush it
-            self.ser.readline()
+            self._input.readline()
             return data
 
         else:
             # This is not a binary reply!  Just treat it normally (prob. error)
-            reply = c + self.ser.readline().strip()
+            reply = c + self._input.readline().strip()
             if reply.startswith(b'ERROR:'):
-                raise ADSyncError(reply[6:].decode('utf-8').strip())
+                raise self._error(reply, cmd)
             elif err:
                 raise ADSyncError(
                     'expected binary reply, device returned "%s"' % reply
                 )
             return reply
 
+    def _result(self, read, parse=None):
+        # Outside of a batch the reply is read immediately, otherwise a future
+        #   is returned, which is filled in when the batch is flushed.
+        if self._batch is None:
+            try:
+                reply = read(self._last_cmd)
+            finally:
+                self._lock.release()
+            return reply if parse is None else parse(reply)
+
+        future = Future()
+        self._batch.append((self._last_cmd, read, parse, future))
+        return future
+
+    def _reply(self, parse=None):
+        return self._result(self._read_reply, parse)
+
+    def _bin_reply(self, err=True, parse=None):
+        return self._result(
+            lambda cmd: self._read_bin_reply(cmd, err), parse
+        )
+
+    def _flush(self, pending):
+        if not pending:
+            return
+
+        if self.ser.in_waiting:
+            self.ser.reset_input_buffer()
+
+        # Each reply means the device has consumed the command, so its bytes
+        #   are credited back to the window.  A command larger than the
+        #   window is sent on its own.
+        timeout = self.ser.timeout
+        sent = 0
+        in_flight = 0
+
+        try:
+            for i, (cmd, read, parse, future) in enumerate(pending):
+                start = sent
+                while (sent < len(pending)) and ((sent == i) or
+                        (in_flight + len(pending[sent][0]) <= self.WINDOW)):
+                    in_flight += len(pending[sent][0])
+                    sent += 1
+
+                if sent > start:
+                    data = b''.join(c[0] for c in pending[start:sent])
+                    self.ser.write(data)
+                    if self.debug:
+                        print("Wrote to device: ", data)
+
+                # Allow extra time for the device to receive the commands
+                #   ahead of this reply
+                self.ser.timeout = timeout + in_flight / self.byte_rate
+                try:
+                    reply = read(cmd)
+                    if parse is not None:
+                        reply = parse(reply)
+                except ADSyncError as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(reply)
+                in_flight -= len(cmd)
+
+        except BaseException:
+            for cmd, read, parse, future in pending:
+                future.cancel()
+            raise
+
+        finally:
+            self.ser.timeout = timeout
+
+    @contextlib.contextmanager
+    def batch(self, raise_errors=True):
+        """
+        Context manager which pipelines commands to the device.
+
+        Inside the context, each method returns a
+        `concurrent.futures.Future` instead of the device reply.  On exit,
+        the commands are streamed to the device without waiting for each
+        reply (but never more than `WINDOW` bytes ahead of them), and the
+        replies are matched to the futures in order.  Errors are attributed
+        to the command which caused them.
+
+        Keywords
+        --------
+        raise_errors : bool (default: True)
+            If True, the first error returned by the device is raised on exit
+            (after all replies have been collected).  If False, errors are
+            only available through the futures.
+
+        Example
+        -------
+        with sync.batch():
+            sync.led(0, 255, 0)
+            sync.start()
+            mode = sync.mode(1, 0)
+        print(mode.result())
+
+        Nested batches are merged into the outermost one.
+        """
+        if self._batch is not None:
+            yield self
+            return
+
+        with self._lock:
+            self._batch = []
+            try:
+                yield self
+            except BaseException:
+                pending, self._batch = self._batch, None
+                for cmd, read, parse, future in pending:
+                    future.cancel()
+                raise
+
+            pending, self._batch = self._batch, None
+            self._flush(pending)
+
+        if raise_errors:
+            for cmd, read, parse, future in pending:
+                if future.exception() is not None:
+                    raise future.exception()
+
+    @contextlib.contextmanager
+    def staged(self):
+        """
+        Context manager which makes the output settings changed inside it
+        take effect together, at the end of an output cycle (`SYNC STAGE` /
+        `SYNC COMMIT`).  The commands are sent as a batch, and settings are
+        not deferred by `max_rate`.  If an exception is raised inside the
+        context, nothing is sent.  Requires firmware version 1.6 or later.
+
+        This applies to the address range, modes, analog scales and trigger
+        mask; other commands (e.g. `rate` or `analog_set`) take effect
+        immediately.
+
+        Example
+        -------
+        with sync.staged():
+            sync.addr(0, 2000)
+            sync.analog_scale(0, 5, 0)
+            sync.mode(1, 2)
+        """
+        with self.batch():
+            self._cmd("SYNC STAGE")
+            self._reply()
+            # Anything deferred is included, so it isn't sent separately
+            for key in list(self._deferred):
+                self._send_deferred(key)
+
+            self._staging = True
+            try:
+                yield self
+            finally:
+                self._staging = False
+
+            self._cmd("SYNC COMMIT")
+            self._reply()
+
+    def send_many(self, commands):
+        """
+        Send a list of raw serial commands, without waiting for the reply to
+        each one.
+
+        Parameters
+        ----------
+        commands : list
+            Each command is either a string (e.g. `"SYNC START"`) or a tuple
+            of command arguments (e.g. `("LED", 0, 255, 0)`).  All commands
+            should have single line replies.
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            The reply to each command, in order.  Errors returned by the
+            device are raised when calling `result()` on the corresponding
+            future.
+        """
+        futures = []
+        with self.batch(raise_errors=False):
+            for command in commands:
+                if not isinstance(command, tuple):
+                    command = (command, )
+                self._cmd(*command)
+                futures.append(self._reply())
+
+        return futures
+
+    def _completed(self, reply):
+        # A reply which is already known, in the same form as _result
+        if self._batch is None:
+            return reply
+        future = Future()
+        future.set_result(reply)
+        return future
+
+    def _set(self, key, *value, cmd=None, limit=True):
+        # Send a setting command, where only the latest value matters.  The
+        #   command is `key` followed by `value`, unless `cmd` is given.  If
+        #   the value is the same as the last one sent, nothing is sent and
+        #   the previous reply is returned.  If `limit` is True and the
+        #   setting was sent less than 1/max_rate ago, the command is
+        #   deferred until then and a Future is returned; further changes in
+        #   the meantime replace the deferred value (and share the future).
+        if cmd is None:
+            cmd = (key, ) + value
+
+        with self._lock:
+            deferred = self._deferred.pop(key, None)
+            if key in self._settings and self._settings[key][0] == value:
+                reply = self._settings[key][1]
+                if deferred is not None:
+                    deferred[2].set_result(reply)
+                return self._completed(reply)
+
+            if limit and self.max_rate and not self._staging:
+                delay = (self._set_time.get(key, -np.inf) + 1 / self.max_rate
+                         - time.monotonic())
+                if delay > 0:
+                    if deferred is None:
+                        future = Future()
+                        self._schedule_setting(key, delay)
+                    else:
+                        future = deferred[2]
+                    self._deferred[key] = (value, cmd, future)
+                    return future
+
+            if deferred is not None:
+                # Only possible if max_rate was changed
+                deferred[2].cancel()
+
+            return self._send_setting(key, value, cmd)
+
+    def _send_setting(self, key, value, cmd):
+        self._set_time[key] = time.monotonic()
+        self._cmd(*cmd)
+        return self._result(lambda c: self._read_setting(key, value, c))
+
+    def _read_setting(self, key, value, cmd):
+        # If the command fails, the state of the setting is unknown
+        self._settings.pop(key, None)
+        reply = self._read_reply(cmd)
+        self._settings[key] = (value, reply)
+        return reply
+
+    def _schedule_setting(self, key, delay):
+        timer = threading.Timer(delay, self._send_deferred, (key, ))
+        timer.daemon = True
+        timer.start()
+
+    def _send_deferred(self, key):
+        with self._lock:
+            value, cmd, future = self._deferred.pop(key, (None, None, None))
+            if future is None or not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                reply = self._send_setting(key, value, cmd)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                if isinstance(reply, Future):
+                    # Sent as part of a batch (see `staged`)
+                    reply.add_done_callback(
+                        lambda reply: self._chain_future(reply, future))
+                else:
+                    future.set_result(reply)
+
+    @staticmethod
+    def _chain_future(source, target):
+        # Copy the result of a completed future to another
+        if source.cancelled():
+            target.set_exception(ADSyncError('command was not sent'))
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    @property
+    def settings(self):
+        """
+        The device settings, as far as they are known: a dictionary with
+        the raw values last sent to (or read from) the device.  Settings
+        which are unknown are omitted.  (See `query_state`.)
+        """
+        settings = {}
+        for key, name in self.SETTINGS.items():
+            value, reply = self._settings.get(key, (None, None))
+            if value is not None:
+                settings[name] = value[0] if len(value) == 1 else value
+        return settings
+
+    def query_state(self):
+        """
+        Read all of the settings from the device, and update the host side
+        mirror of them.  After this, setting methods which would not change
+        anything are skipped.  Requires firmware version 1.2 or later; with
+        1.3 or later this is a single `SYNC DUMP` command (see `state`),
+        otherwise each setting is queried (in a single batch).
+
+        Returns
+        -------
+        settings : dict
+            The same as the `settings` attribute.
+        """
+        if self.firmware_version >= (1, 3):
+            return self._store_state(self._state_replies(self.state()))
+        if self.firmware_version < (1, 2):
+            raise ADSyncError("query_state requires firmware version >= 1.2")
+
+        with self.batch():
+            replies = {}
+            for key in self.SETTINGS:
+                self._cmd(key)
+                replies[key] = self._reply()
+
+        return self._store_state(
+            {key: reply.result() for key, reply in replies.items()})
+
+    def _store_state(self, replies):
+        # Update the settings mirror from the replies to the queries
+        with self._lock:
+            for key, reply in replies.items():
+                if key == "SYNC RATE":
+                    # Same as the reply to a rate change
+                    self._settings[key] = (self._parse_rate(reply), reply)
+                else:
+                    self._settings[key] = (self._parse_query(key, reply),
+                                           b'ok.')
+
+        return self.settings
+
+    @staticmethod
+    def _parse_query(key, reply):
+        # e.g. "ANA0 SCALE 65536 0" -> (65536, 0)
+        fields = reply.split()
+        n = len(key.split())
+        if fields[:n] != key.encode('utf-8').split():
+            raise ADSyncError('unexpected reply to "%s" (%s)' % (key, reply))
+        return tuple(int(x) for x in fields[n:])
+
+    def _state_replies(self, state):
+        # The replies to the setting queries, constructed from a SYNC DUMP
+        values = {
+            "SYNC ADDR": (state['sync_start'], state['sync_cycles']),
+            "SYNC ACTIVE": (state['sync_active'], ),
+            "SYNC MODE": (state['analog_sync_mode'],
+                          state['digital_sync_mode']),
+            "TRIGGER MASK": (state['trigger_mask'], ),
+            "LED": tuple(state['led']),
+        }
+        for n in range(2):
+            values["ANA%d SCALE" % n] = (state['ana_multiplier'][n],
+                                         state['ana_offset'][n])
+            values["ANA%d SET" % n] = (state['ana_set'][n], )
+
+        replies = {key: b' '.join([key.encode('utf-8')]
+                                  + [b'%d' % x for x in value])
+                   for key, value in values.items()}
+        replies["SYNC RATE"] = (b'SYNC RATE = %s Hz'
+                                % format_float(state['sync_rate']).encode())
+        return replies
+
+    @staticmethod
+    def _parse_rate(reply):
+        m = re.match(rb'SYNC RATE = ([0-9.]+) Hz', reply)
+        if not m:
+            raise ADSyncError('unexpected reply to "SYNC RATE" (%s)' % reply)
+        return (float(m.group(1)), )
+
+    def state(self):
+        """
+        Read a snapshot of all the device settings and status with a single
+        command (`SYNC DUMP`).  Requires firmware version 1.3 or later.
+
+        Returns
+        -------
+        state : numpy structured scalar (dtype `ad_sync.firmware.SYNC_STATE`)
+            Fields (accessed as e.g. `state['sync_rate']`):
+                - `sync_start`, `sync_cycles`: the address range (`addr`)
+                - `sync_rate`: the actual output rate, in Hz
+                - `ana_multiplier`, `ana_offset`: the raw analog scale of
+                  each channel (`analog_scale`)
+                - `trigger_mask`, `trigger_count`: the trigger mask, and the
+                  number of triggered cycles remaining
+                - `buffer_update_time`: time taken to compute the last output
+                  buffer, in us
+                - `last_update_age`: time since the last buffer update, in us
+                - `last_bytes_written`: bytes passed to the DMA in the last
+                  update
+                - `ana_set`: the fixed analog values (`analog_set`)
+                - `ser_fill`: bytes waiting in the tunneled serial buffers
+                  (serial 1 input, serial 1 output, serial 2 input, serial 2
+                  output)
+                - `analog_sync_mode`, `digital_sync_mode`: (`mode`)
+                - `sync_active`: 1 if the output is started
+                - `led`: the LED color
+                - `ser_overflow`: bit flags indicating if each of the
+                  tunneled serial buffers has overflowed (same order as
+                  `ser_fill`)
+                - `settings_pending`: 1 if changed settings are waiting for
+                  the end of the output cycle (firmware 1.5 or later)
+                - `buffer_update_time_max`: the longest buffer update since
+                  the last `stat`, in us (firmware 1.7 or later)
+                - `cache`: bit 0 is set if pre-rendering is on, and bit 1 if
+                  the output is using it (see `cache`; firmware 1.8 or
+                  later)
+                - `underruns`: the number of times the output has run out of
+                  data since the device was reset
+                - `dma_buf_count`, `dma_buf_len`, `dma_auto`: the DMA
+                  buffers (see `dma`; firmware 1.9 or later)
+                - `cycle_count`: the number of the current output cycle
+                  (see `cycle_count`; firmware 1.11 or later)
+                - `trigger_prog`: bit 0 is set if the trigger program is
+                  running, and bit 1 if a `trigger_at` is pending (firmware
+                  1.11 or later)
+        """
+        self._cmd("SYNC DUMP")
+        return self._bin_reply(parse=self._parse_state)
+
+    def _parse_state(self, data):
+        # Later firmware versions may add fields at the end, and earlier ones
+        #   don't have the last few (which are left as zero)
+        if len(data) < SYNC_STATE.fields['buffer_update_time_max'][1]:
+            raise ADSyncError('SYNC DUMP reply too short (%d bytes)'
+                              % len(data))
+        data = data[:SYNC_STATE.itemsize].ljust(SYNC_STATE.itemsize, b'\0')
+        return np.frombuffer(data, SYNC_STATE)[0]
+
+    def perf(self):
+        """
+        Read the timing statistics of the device (`SYNC PERF`).  The
+        histograms cover the time since the last call (or the last reset),
+        and are cleared by each call; the counters are totals since the
+        device was reset.  Requires firmware version 1.10 or later.
+
+        Returns
+        -------
+        perf : dict
+            - `interval`: the time covered by the histograms, in us
+            - `underruns`: the number of times the output has run out of
+              data
+            - `ser_dropped`: uint32 array of the number of bytes dropped
+              because a buffer was full, for serial 1 input and output,
+              serial 2 input and output, and the command replies
+            - `slowest_command`: the command which took longest to execute,
+              e.g. `"SYNC CRC"` (empty if there were none)
+            - `buffer_update`: the time taken to compute each output buffer
+            - `buffer_interval`: the time between output buffers being
+              handed to the DMA
+            - `loop`: the time taken by each pass of the main loop (which
+              processes the commands and serial ports)
+            - `command`: the time taken to execute each command
+
+            Each of the timings is a dict with:
+                - `count`: the number of times measured
+                - `min`, `mean`, `max`: in us (nan if `count` is 0)
+                - `bins`: uint32 array histogramming the times in powers of
+                  two, with bin `i` counting times from `edges[i]` up to
+                  `edges[i+1]` (the last bin counts anything longer)
+                - `edges`: the lower edge of each bin, in us
+        """
+        self._cmd("SYNC PERF")
+        return self._bin_reply(parse=self._parse_perf)
+
+    @staticmethod
+    def _parse_perf(data):
+        if len(data) != SYNC_PERF.itemsize:
+            raise ADSyncError('SYNC PERF reply has the wrong size (%d bytes)'
+                              % len(data))
+        perf = np.frombuffer(data, SYNC_PERF)[0]
+
+        stats = {
+            'interval': int(perf['interval']),
+            'underruns': int(perf['underruns']),
+            'ser_dropped': perf['ser_dropped'].copy(),
+            'slowest_command': cmd_name(int(perf['slowest_command'])),
+        }
+        for key in ('buffer_update', 'buffer_interval', 'loop', 'command'):
+            h = perf[key]
+            count = int(h['count'])
+            stats[key] = {
+                'count': count,
+                'min': int(h['min']) if count else np.nan,
+                'mean': int(h['total']) / count if count else np.nan,
+                'max': int(h['max']) if count else np.nan,
+                'bins': h['bins'].copy(),
+                'edges': PERF_BIN_EDGES,
+            }
+
+        return stats
+
+    def invalidate_settings(self):
+        """
+        Forget the mirrored device settings, so that the next call of each
+        setting method is sent even if the value is unchanged.  This should
+        be called if the device may have been changed by something else
+        (this is done automatically by `reset`), unless `query_state` is
+        used to read them back.
+        """
+        self._settings.clear()
+
     def start(self):
         "Start the sync output."
-        self._cmd(b"SYNC START")
-        return self._reply()
+        return self._set("SYNC ACTIVE", 1, cmd=("SYNC START", ), limit=False)
 
     def _analog(self, V, ref=None, clip=None):
         if ref is None:
@@ -178,8 +798,7 @@ class ADSync:
 
         amp = self._analog(2*amplitude, ref=0, clip=self.ANALOG_MAX)
         off = self._analog(offset - amplitude)
-        self._cmd(b"ANA%d SCALE" % channel, amp, off)
-        return self._reply()
+        return self._set("ANA%d SCALE" % channel, amp, off)
 
     def analog_set(self, channel, V):
         '''
@@ -201,8 +820,7 @@ class ADSync:
         if V < -10:
             raise ADSyncError("Analog output out of range (too low)")
 
-        self._cmd(b"ANA%d SET" % channel, self._analog(V))
-        return self._reply()
+        return self._set("ANA%d SET" % channel, self._analog(V))
 
     def mode(self, analog_mode=1, digital_mode=0):
         """
@@ -227,18 +845,22 @@ class ADSync:
                 switch the digital signals without re-uploading.)
             3: "Swap-Or" mode.  Apply the swap and then the or operation.
         """
-        self._cmd("SYNC MODE", analog_mode, digital_mode)
-        return self._reply()
+        return self._set("SYNC MODE", analog_mode, digital_mode)
 
     def stop(self):
         "Stop the sync output."
-        self._cmd(b"SYNC STOP")
-        return self._reply()
+        return self._set("SYNC ACTIVE", 0, cmd=("SYNC STOP", ), limit=False)
 
-    def write(self, addr, data, wait=True):
+    def write(self, addr, data, wait=True, packed=None, progress=None,
+              verify=False):
         """
         Write data to the sync memory.
 
+        The data is streamed to the device in chunks of at most `WRITE_CHUNK`
+        bytes, each of which is acknowledged by the device, so the upload
+        runs at the speed of the link (USB or bluetooth) without overflowing
+        the device buffers.
+
         Parameters
         ----------
         addr : int
@@ -249,14 +871,359 @@ class ADSync:
         Keywords
         --------
         wait : bool (default: true)
-            If True, wait for the write to finish before returning.
+            Ignored, as every chunk is acknowledged by the device; kept for
+            compatibility.
+        packed : bool (default: automatic)
+            If True, the data is sent in the packed format (`SYNC PACK`,
+            requires firmware 1.1 or later), which is usually much smaller
+            for scan profiles.  If not specified, the packed format is used
+            when the device supports it and it is smaller.
+        progress : function (default: None)
+            If specified, called as `progress(written, total)` (in samples)
+            each time a chunk is acknowledged.
+        verify : bool (default: False)
+            If True, the device computes a checksum of the written memory
+            (`SYNC CRC`, requires firmware 1.4 or later), and an ADSyncError
+            is raised if it doesn't match the data.
+
+        Returns
+        -------
+        reply : bytes
+            A summary of the write, in the same format as the reply to
+            `SYNC WRITE`.  The number of bytes sent, the time taken (from the
+            call to `write`) and the data rate are stored in `write_stats`.
         """
-        self._cmd("SYNC WRITE", addr, data)
-        if wait:
-            time.sleep((len(data) * 4 / self.byte_rate))
-        return self._reply()
+        raw = np.ascontiguousarray(data).reshape(-1).view('u1')
+        total = raw.nbytes // 4
+        words = self._shadow_words(data)
+        # Until the device confirms the write, we don't know what is in memory
+        self.invalidate_shadow(addr, -(-raw.nbytes // 4))
+
+        # Each chunk is (command, first sample, number of samples, payload)
+        chunks = [
+            ("SYNC WRITE", i // 4, len(raw[i:i+self.WRITE_CHUNK]) // 4,
+             raw[i:i+self.WRITE_CHUNK])
+            for i in range(0, max(raw.nbytes, 1), self.WRITE_CHUNK)
+        ]
+        if packed or ((packed is None) and (words is not None)
+                      and (self.firmware_version >= (1, 1))):
+            samples = np.asarray(data, dtype='uint32').reshape(-1)
+            packed_chunks = self._pack_chunks(samples)
+            # Only worth it if it's smaller!
+            if packed or (sum(c[3].nbytes for c in packed_chunks)
+                          < raw.nbytes):
+                chunks = packed_chunks
+
+        extra = raw.nbytes % 4
+        summary = (b'Wrote %d samples to syncronous data, starting at '
+                   b'address %d' % (total, addr))
+        summary += (b'. (Warning: %d extra bytes written at end!)' % extra
+                    if extra else b'.')
+
+        t0 = time.perf_counter()
+        nbytes = 0
+        futures = []
+
+        def parse(reply, start, count, last):
+            if not reply.startswith(b'Wrote %d samples' % count):
+                raise ADSyncError(
+                    'unexpected reply to sync write (%s)' % repr(reply)
+                )
+            if words is not None:
+                self._shadow[addr+start:addr+start+count] = \
+                    words[start:start+count]
+                self._shadow_valid[addr+start:addr+start+count] = True
+            if progress is not None:
+                progress(start + count, total)
+            return finish() if last else reply
+
+        def check(reply):
+            if self._parse_crc(reply) != zlib.crc32(raw[:4*total]):
+                self.invalidate_shadow(addr, total)
+                raise ADSyncError('sync memory does not match the data '
+                                  'written (CRC mismatch)')
+            return finish()
+
+        def finish():
+            # This is the last reply, so all of the others are in
+            for future in futures[:-1]:
+                if future.exception() is not None:
+                    raise future.exception()
+            dt = time.perf_counter() - t0
+            self.write_stats = dict(samples=total, bytes=nbytes, seconds=dt,
+                                    rate=nbytes / dt if dt else float('inf'))
+            return summary
+
+        batched = self._batch is not None
+        with self.batch():
+            for n, (command, start, count, payload) in enumerate(chunks):
+                nbytes += len(self._cmd(command, addr + start, payload))
+                futures.append(self._reply(parse=lambda reply, start=start,
+                    count=count, last=(n == len(chunks) - 1) and not verify:
+                        parse(reply, start, count, last)))
+            if verify:
+                nbytes += len(self._cmd("SYNC CRC", addr, total))
+                futures.append(self._bin_reply(parse=check))
+
+        return futures[-1] if batched else futures[-1].result()
+
+    def _pack_chunks(self, samples):
+        # Split the data into pieces which pack into at most WRITE_CHUNK bytes
+        chunks = []
+        todo = [(0, len(samples))]
+        while todo:
+            i0, i1 = todo.pop(0)
+            payload = np.frombuffer(pack.pack(samples[i0:i1]), dtype='u1')
+            if (payload.nbytes > self.WRITE_CHUNK) and (i1 - i0 > 1):
+                n = -(-payload.nbytes // self.WRITE_CHUNK)
+                edges = np.linspace(i0, i1, n + 1).astype(int)
+                todo[0:0] = zip(edges[:-1], edges[1:])
+            else:
+                chunks.append(("SYNC PACK", int(i0), int(i1 - i0), payload))
+        return chunks
+
+    def _shadow_words(self, data):
+        # Only plain uint32 samples can be tracked in the shadow copy
+        if isinstance(data, np.ndarray) and data.dtype == np.uint32:
+            return data.reshape(-1).copy()
+        return None
 
-    def write_ad(self, addr, dig, ana, scale=1, wait=True):
+    def read(self, addr, count):
+        """
+        Read data back from the sync memory.  Requires firmware version 1.4
+        or later.  (This can not be used inside a batch.)
+
+        Parameters
+        ----------
+        addr : int
+            The first address to read (0-16383)
+        count : int
+            The number of samples to read
+
+        Returns
+        -------
+        data : numpy uint32 array
+        """
+        self._check_range(addr, count)
+        if self._batch is not None:
+            raise ADSyncError("read can not be used inside a batch")
+
+        # The device returns fewer samples than requested if they don't fit
+        #   in its output buffer, so this is done one reply at a time
+        data = np.empty(count, dtype='uint32')
+        i = 0
+        while i < count:
+            self._cmd("SYNC READ", addr + i, min(count - i, self.READ_CHUNK))
+            i += self._store_read(data, i, self._bin_reply())
+
+        return data
+
+    def _check_range(self, addr, count):
+        if addr < 0 or count < 0 or addr + count > self.MAX_ADDR:
+            raise ValueError('address range is outside of the sync memory')
+
+    def _store_read(self, data, i, reply):
+        chunk = np.frombuffer(reply, dtype='<u4')
+        if not len(chunk) or len(chunk) > len(data) - i:
+            raise ADSyncError('SYNC READ returned %d samples' % len(chunk))
+        data[i:i+len(chunk)] = chunk
+        return len(chunk)
+
+    def crc(self, addr, count):
+        """
+        Compute the CRC32 of part of the sync memory on the device.  The
+        result is the same as `zlib.crc32` of the data (as a little-endian
+        uint32 array).  Requires firmware version 1.4 or later.
+
+        Parameters
+        ----------
+        addr : int
+            The first address (0-16383)
+        count : int
+            The number of samples
+
+        Returns
+        -------
+        crc : int
+        """
+        self._check_range(addr, count)
+        self._cmd("SYNC CRC", addr, count)
+        return self._bin_reply(parse=self._parse_crc)
+
+    def _parse_crc(self, reply):
+        if len(reply) != 4:
+            raise ADSyncError('SYNC CRC returned %d bytes' % len(reply))
+        return int.from_bytes(reply, 'little')
+
+    def verify(self, addr, data):
+        """
+        Check if the sync memory contains the given data, using a checksum
+        computed on the device (see `crc`).
+
+        Parameters
+        ----------
+        addr : int
+            The first address (0-16383)
+        data : numpy array
+            The data to compare to; converted to uint32.
+
+        Returns
+        -------
+        match : bool
+        """
+        data = np.ascontiguousarray(data, dtype='<u4').reshape(-1)
+        expected = zlib.crc32(data)
+        self._check_range(addr, len(data))
+        self._cmd("SYNC CRC", addr, len(data))
+        return self._bin_reply(
+            parse=lambda reply: self._parse_crc(reply) == expected)
+
+    def check_shadow(self, addr=0, count=None):
+        """
+        Check that the host side copy of the sync memory (see `update`) still
+        matches the device, by comparing checksums of each part which is
+        known.  Any part which doesn't match is invalidated, so it will be
+        resent by the next `update`.
+
+        Keywords
+        --------
+        addr : int (default: 0)
+            The first address to check
+        count : int (default: the rest of the memory)
+            The number of samples to check
+
+        Returns
+        -------
+        match : bool
+            True if all of the known data matches.
+        """
+        with self.batch():
+            results = [self._check_shadow_run(i0, i1)
+                       for i0, i1 in self._shadow_runs(addr, count)]
+        return all(result.result() for result in results)
+
+    def _shadow_runs(self, addr, count):
+        # The (start, end) of each run of valid shadow data in a range
+        if count is None:
+            count = self.MAX_ADDR - addr
+        self._check_range(addr, count)
+        valid = np.concatenate([[False],
+                                self._shadow_valid[addr:addr+count], [False]])
+        edges = np.flatnonzero(np.diff(valid.astype('i1'))) + addr
+        return [(int(i0), int(i1)) for i0, i1 in zip(edges[::2], edges[1::2])]
+
+    def _check_shadow_run(self, i0, i1):
+        expected = zlib.crc32(self._shadow[i0:i1].astype('<u4'))
+
+        def parse(reply):
+            if self._parse_crc(reply) == expected:
+                return True
+            self.invalidate_shadow(i0, i1 - i0)
+            return False
+
+        self._cmd("SYNC CRC", i0, i1 - i0)
+        return self._bin_reply(parse=parse)
+
+    def invalidate_shadow(self, addr=0, count=None):
+        """
+        Mark the host side copy of the sync memory as unknown, so that the next
+        `update` resends the data.  This is done automatically on a reset, but
+        should be called manually if the memory was written by another
+        connection (e.g. bluetooth).
+
+        Keywords
+        --------
+        addr : int (default: 0)
+            The first address to invalidate.
+        count : int (default: to the end of the memory)
+            The number of samples to invalidate.
+        """
+        end = self.MAX_ADDR if count is None else addr + count
+        self._shadow_valid[addr:end] = False
+        # Slots in the range are no longer known to be loaded
+        for name, (start, data, rate) in list(self._slots.items()):
+            if (start < end) and (start + len(data) > addr):
+                del self._slots[name]
+
+    def update(self, addr, data, overhead=None, progress=None):
+        """
+        Write data to the sync memory, only sending the samples which differ
+        from what was previously written.  The changed samples are sent as a
+        batch of `SYNC WRITE` commands, one for each run of changes; runs
+        separated by only a few unchanged samples are merged.
+
+        Parameters
+        ----------
+        addr : int
+            The address to write to (0-16383)
+        data : numpy array
+            The data to write; converted to uint32.
+
+        Keywords
+        --------
+        overhead : int (default: WRITE_OVERHEAD)
+            The cost of an extra write command in bytes.  Runs of changes are
+            merged if the unchanged samples between them take fewer bytes
+            than this to send.
+        progress : function (default: None)
+            If specified, called as `progress(sent, total)` (in samples, where
+            `total` is the number of changed samples) as each chunk of data is
+            acknowledged by the device.
+
+        Returns
+        -------
+        count : int
+            The number of samples sent to the device.
+        """
+        data = np.asarray(data, dtype='uint32').reshape(-1)
+        runs = self._changed_runs(addr, data, overhead)
+        total = sum(i1 - i0 for i0, i1 in runs)
+
+        with self.batch():
+            sent = 0
+            for i0, i1 in runs:
+                run_progress = None
+                if progress is not None:
+                    run_progress = (lambda n, t, sent=sent:
+                                    progress(sent + n, total))
+                self.write(addr + i0, data[i0:i1], progress=run_progress)
+                sent += i1 - i0
+
+        return total
+
+    def _changed_runs(self, addr, data, overhead=None):
+        # Returns the (start, end) of each run of data which needs to be sent
+        if addr < 0 or addr + len(data) > self.MAX_ADDR:
+            raise ValueError('data does not fit in the sync memory')
+        if overhead is None:
+            overhead = self.WRITE_OVERHEAD
+
+        end = addr + len(data)
+        changed = np.flatnonzero(~self._shadow_valid[addr:end]
+                                 | (self._shadow[addr:end] != data))
+        if not len(changed):
+            return []
+
+        # Split wherever the gap is too large to be worth resending
+        split = np.flatnonzero(np.diff(changed) > overhead // 4 + 1)
+        starts = changed[np.concatenate([[0], split + 1])]
+        ends = changed[np.concatenate([split, [len(changed) - 1]])] + 1
+
+        return [(int(i0), int(i1)) for i0, i1 in zip(starts, ends)]
+
+    @classmethod
+    def _ad_data(cls, dig, ana, scale=1):
+        if len(dig) != len(ana):
+            raise ValueError("digital and analog data should have same length")
+
+        data = np.asarray(dig, 'uint32') << 16
+        data += (np.clip(ana * (0.5/scale) + 0.5, 0, 1)
+                 * (cls.ANALOG_MAX-1)).astype('uint32')
+
+        return data
+
+    def write_ad(self, addr, dig, ana, scale=1, wait=True, progress=None,
+                 verify=False):
         """
         Combine analog and digital data into single data stream and write those
         to the sync memory.
@@ -277,16 +1244,43 @@ class ADSync:
             mapped to the full range.  (I.e. for the default, -1 -> 0 and
             +1 -> 65535.)
         wait : bool (default: true)
-            If True, wait for the write to finish before returning.
+            Ignored; kept for compatibility (see `write`).
+        progress : function (default: None)
+            Progress callback (see `write`).
+        verify : bool (default: False)
+            If True, check the upload with a checksum (see `write`).
         """
-        if len(dig) != len(ana):
-            raise ValueError("digital and analog data should have same length")
+        return self.write(addr, self._ad_data(dig, ana, scale),
+                          progress=progress, verify=verify)
 
-        data = np.asarray(dig, 'uint32') << 16
-        data += (np.clip(ana * (0.5/scale) + 0.5, 0, 1)
-                 * (self.ANALOG_MAX-1)).astype('uint32')
+    def update_ad(self, addr, dig, ana, scale=1, progress=None):
+        """
+        Combine analog and digital data into single data stream, and write
+        the parts which have changed to the sync memory (see `update`).
 
-        return self.write(addr, data, wait=wait)
+        Parameters
+        ----------
+        addr : int
+            The address to write to (0-16383)
+        dig : numpy array (integer)
+            The digital data to write
+        ana : numpy array (float)
+            The analog data to write.
+
+        Keywords
+        --------
+        scale : float (default: 1)
+            The scale of the analog data (see `write_ad`).
+        progress : function (default: None)
+            Progress callback (see `update`).
+
+        Returns
+        -------
+        count : int
+            The number of samples sent to the device.
+        """
+        return self.update(addr, self._ad_data(dig, ana, scale),
+                           progress=progress)
 
     def rate(self, rate):
         """
@@ -299,8 +1293,33 @@ class ADSync:
         """
         ipart = int(rate)
         fpart = int((rate - ipart) * 1000 + 0.5)
-        self._cmd("SYNC RATE", ipart, fpart)
-        return self._reply()
+        # The actual rate (as the device reports it) is mirrored, so that
+        #   requests which round to the same rate are skipped
+        actual = float(format_float(self.actual_rate(rate)))
+        return self._set("SYNC RATE", actual, cmd=("SYNC RATE", ipart, fpart),
+                         limit=False)
+
+    @staticmethod
+    def actual_rate(rate):
+        """
+        Compute the output rate the device will produce for a requested rate,
+        which is rounded to the nearest mHz and then quantized by the clock
+        generator (see `firmware.sync_freq`).
+
+        Parameters
+        ----------
+        rate : float
+            The requested output rate in Hz.
+
+        Returns
+        -------
+        actual_rate : float
+            The actual output rate in Hz.
+        """
+        ipart = int(rate)
+        fpart = int((rate - ipart) * 1000 + 0.5)
+        return float(sync_freq(np.float32(float(np.float32(ipart))
+                                          + 1E-3 * fpart)))
 
     def addr(self, start, count):
         """
@@ -313,8 +1332,361 @@ class ADSync:
         count : int
             The total number of ouptut data points
         """
-        self._cmd("SYNC ADDR", start, count)
-        return self._reply()
+        return self._set("SYNC ADDR", start, count, limit=False)
+
+    def swap(self, start, count):
+        """
+        Switch the sync output to a new address range at the end of the
+        current cycle, so that there is no gap or partial cycle in the
+        output, and report when the old range is no longer in use with
+        `swap_pending`.  (If the output is stopped, the change is
+        immediate.)  This also commits any settings staged with `staged`.
+        Requires firmware version 1.5 or later.
+
+        Parameters
+        ----------
+        start : int
+            The first address of the output.
+        count : int
+            The total number of ouptut data points
+        """
+        return self._set("SYNC ADDR", start, count,
+                         cmd=("SYNC SWAP", start, count), limit=False)
+
+    def swap_pending(self):
+        """
+        Check if a `swap` (or any other committed change of the output
+        settings) is waiting for the end of the output cycle.
+
+        Returns
+        -------
+        pending : bool
+        """
+        self._cmd("SYNC SWAP")
+        return self._reply(
+            parse=lambda reply: self._parse_query("SYNC SWAP", reply) != (0, ))
+
+    def wait_swap(self, timeout=None):
+        """
+        Wait until a pending `swap` has happened.
+
+        Keywords
+        --------
+        timeout : float (default: see below)
+            The maximum time to wait, in seconds.  The default is the time
+            to output the entire sync memory twice at the current rate.
+        """
+        if timeout is None:
+            timeout = self._swap_timeout()
+        t0 = self._time()
+        while self.swap_pending():
+            if self._time() - t0 > timeout:
+                raise ADSyncError('timed out waiting for the sync swap')
+            self._sleep(self.SWAP_POLL)
+
+    def _time(self):
+        # The time used for polling; the emulator's serial link runs on a
+        #   virtual clock (see `ad_sync.emulator`), which waits follow
+        return self.ser.clock if hasattr(self.ser, 'advance') \
+            else time.monotonic()
+
+    def _sleep(self, seconds):
+        if hasattr(self.ser, 'advance'):
+            self.ser.advance(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _swap_timeout(self):
+        # Two full cycles of the memory, which is the longest possible cycle
+        rate = self._settings.get("SYNC RATE", ((self.FREQ_MIN, ), ))[0][0]
+        return 2 * self.MAX_ADDR / rate + self.ser.timeout
+
+    def _bank_for(self, state):
+        # Choose the bank to write, given the SYNC DUMP state, and whether the
+        #   output has to be stopped to write it
+        period = int(state['sync_cycles']) % self.MAX_ADDR or self.MAX_ADDR
+        addrs = (int(state['sync_start']) + np.arange(period)) % self.MAX_ADDR
+        in_use = np.unique(addrs // self.BANK_SIZE)
+        if len(in_use) == 1:
+            return (1 - int(in_use[0])) * self.BANK_SIZE, False
+        return 0, bool(state['sync_active'])
+
+    def update_bank(self, data, progress=None):
+        """
+        Replace the output cycle without stopping the output.  The sync
+        memory is split into two banks of `BANK_SIZE` samples: the data is
+        written to the bank which is not being output (only sending the
+        samples which have changed, as in `update`), checked against the
+        device (see `check_shadow`), and then switched to with `swap`.
+        Requires firmware version 1.5 or later.  (This can not be used inside
+        a batch.)
+
+        If the output is running from a range which spans both banks (i.e.
+        it was set up with `addr`), it is stopped while the data is written.
+
+        Parameters
+        ----------
+        data : numpy array
+            The data for the new output cycle (at most `BANK_SIZE` samples),
+            converted to uint32.
+
+        Keywords
+        --------
+        progress : function (default: None)
+            Progress callback (see `update`).
+
+        Returns
+        -------
+        start : int
+            The first address of the bank which was written.
+        """
+        data = np.asarray(data, dtype='uint32').reshape(-1)
+        if len(data) > self.BANK_SIZE:
+            raise ValueError('data is too long for a bank (max %d samples)'
+                             % self.BANK_SIZE)
+        if self._batch is not None:
+            raise ADSyncError("update_bank can not be used inside a batch")
+
+        # Until a previous swap happens, both banks may be in use
+        self.wait_swap()
+        start, restart = self._bank_for(self.state())
+        if restart:
+            self.stop()
+
+        self.update(start, data, progress=progress)
+        if not self.check_shadow(start, len(data)):
+            self.update(start, data)
+        self.swap(start, len(data))
+
+        if restart:
+            self.start()
+
+        return start
+
+    def update_bank_ad(self, dig, ana, scale=1, progress=None):
+        """
+        Combine analog and digital data into single data stream, and replace
+        the output cycle with it without stopping the output (see
+        `update_bank`).
+
+        Parameters
+        ----------
+        dig : numpy array (integer)
+            The digital data to write
+        ana : numpy array (float)
+            The analog data to write.
+
+        Keywords
+        --------
+        scale : float (default: 1)
+            The scale of the analog data (see `write_ad`).
+        progress : function (default: None)
+            Progress callback (see `update`).
+
+        Returns
+        -------
+        start : int
+            The first address of the bank which was written.
+        """
+        return self.update_bank(self._ad_data(dig, ana, scale),
+                                progress=progress)
+
+    def upload_slot(self, name, data, rate=None, progress=None):
+        """
+        Load data into a named slot of the sync memory, so that several
+        output cycles (e.g. for alignment and acquisition) can be resident at
+        once, and switched between with `select`.  If the slot already holds
+        the same data, nothing is sent.  (This can not be used inside a
+        batch.)
+
+        Space is allocated first-fit.  If no gap is big enough, the other
+        slots are moved down to close the gaps between them (only sending
+        the samples which change, as in `update`), and if that isn't enough,
+        the least recently used slots are evicted.  The address range being
+        output (if it is running) is never overwritten, so a slot can be
+        replaced while it is in use; if the host doesn't know it (e.g. after
+        `invalidate_settings`), it is read from the device first (see
+        `query_state`, which requires firmware version 1.2 or later).
+
+        The slots are forgotten on `reset`, or if their memory is
+        invalidated (see `invalidate_shadow`); data written to the memory
+        with the other methods (e.g. `write` or `update_bank`) may overwrite
+        them.
+
+        Parameters
+        ----------
+        name : hashable
+            The name of the slot.
+        data : numpy array
+            The data, converted to uint32.
+
+        Keywords
+        --------
+        rate : float (default: None)
+            If specified, the output rate which `select` sets with the slot.
+        progress : function (default: None)
+            Progress callback (see `update`).
+
+        Returns
+        -------
+        addr : int
+            The first address of the slot.
+        """
+        data = np.array(data, dtype='uint32').reshape(-1)
+        if self._batch is not None:
+            raise ADSyncError("upload_slot can not be used inside a batch")
+
+        if not self._output_known():
+            self.query_state()
+        plan = self._plan_slot(name, data, rate)
+        if plan is None:
+            return self._slots[name][0]
+
+        addr, moves = plan
+        for key, new_addr in moves.items():
+            start, old_data, old_rate = self._slots[key]
+            try:
+                self._write_slot(new_addr, old_data)
+            except BaseException:
+                self._forget_moves(moves)
+                raise
+            self._slots[key] = (new_addr, old_data, old_rate)
+
+        self._write_slot(addr, data, progress)
+        self._slots[name] = (addr, data, rate)
+        return addr
+
+    def _plan_slot(self, name, data, rate):
+        # Returns None if the slot already holds the data; otherwise, drops
+        #   the old slot and the evicted ones, and returns the new address
+        #   and the slots to move
+        slot = self._slots.get(name)
+        if (slot is not None) and np.array_equal(slot[1], data):
+            self._slots[name] = (slot[0], slot[1], rate)
+            self._slots.move_to_end(name)
+            return None
+
+        addr, moves, evicted = self._place_slot(name, len(data))
+        for key in evicted + [name]:
+            self._slots.pop(key, None)
+        return addr, moves
+
+    def _forget_moves(self, moves):
+        # A move failed, so the slots which haven't been moved yet may have
+        #   been overwritten
+        for key, new_addr in moves.items():
+            if self._slots.get(key, (None, ))[0] != new_addr:
+                self._slots.pop(key, None)
+
+    def _write_slot(self, addr, data, progress=None):
+        self.update(addr, data, progress=progress)
+        # Skipped samples are only correct if the device memory matches the
+        #   host copy; if not, the mismatched parts are resent
+        if (self.firmware_version >= (1, 4)
+                and not self.check_shadow(addr, len(data))):
+            self.update(addr, data)
+
+    def _output_known(self):
+        # Is the output range mirrored?  (Needed to protect it; see
+        #   `_place_slot`.)
+        return ("SYNC ADDR" in self._settings) and \
+            ("SYNC ACTIVE" in self._settings)
+
+    def _place_slot(self, name, count):
+        # Plan where to put a slot of `count` samples, replacing `name`.
+        #   Returns the address, the new addresses of the slots which have to
+        #   be moved ({name: addr}), and the names of the evicted slots.
+        if not (0 < count <= self.MAX_ADDR):
+            raise ValueError('slot size should be 1-%d samples'
+                             % self.MAX_ADDR)
+
+        # The range being output can't be overwritten
+        if not self._output_known():
+            raise ADSyncError('the output range is unknown (see query_state)')
+        fixed = []
+        if self._settings["SYNC ACTIVE"][0] != (0, ):
+            start, cycles = self._settings["SYNC ADDR"][0]
+            cycles = cycles % self.MAX_ADDR or self.MAX_ADDR
+            fixed.append((start, min(start + cycles, self.MAX_ADDR)))
+            if start + cycles > self.MAX_ADDR:
+                fixed.append((0, start + cycles - self.MAX_ADDR))
+
+        def overlaps(a, n, used):
+            return any((a < end) and (a + n > start) for start, end in used)
+
+        def first_fit(used, n):
+            a = 0
+            for start, end in sorted(used):
+                if start - a >= n:
+                    return a
+                a = max(a, end)
+            return a if self.MAX_ADDR - a >= n else None
+
+        slots = [(key, addr, len(data)) for key, (addr, data, rate)
+                 in self._slots.items() if key != name]
+        evicted = []
+        while True:
+            used = fixed + [(a, a + n) for key, a, n in slots]
+            addr = first_fit(used, count)
+            if addr is not None:
+                return addr, {}, evicted
+
+            # Compact: move each slot (in address order) as low as it goes,
+            #   except the ones which are being output
+            placed, moves = list(fixed), {}
+            for key, a, n in sorted(slots, key=lambda s: s[1]):
+                if not overlaps(a, n, fixed):
+                    new_addr = first_fit(placed, n)
+                    if new_addr != a:
+                        moves[key] = a = new_addr
+                placed.append((a, a + n))
+            addr = first_fit(placed, count)
+            if addr is not None:
+                return addr, moves, evicted
+
+            # Evict the least recently used slot which isn't being output
+            victims = [s for s in slots if not overlaps(s[1], s[2], fixed)]
+            if not victims:
+                raise ADSyncError('not enough free sync memory for slot %r'
+                                  % (name, ))
+            evicted.append(victims[0][0])
+            slots.remove(victims[0])
+
+    def select(self, name):
+        """
+        Switch the output to a slot loaded with `upload_slot`, with a single
+        `SYNC ADDR` command (plus `SYNC RATE`, if the slot has a rate which
+        differs from the current one).
+
+        Parameters
+        ----------
+        name : hashable
+            The name of the slot.
+        """
+        if name not in self._slots:
+            raise ValueError('no slot named %r is loaded' % (name, ))
+        addr, data, rate = self._slots[name]
+        self._slots.move_to_end(name)
+        if rate is not None:
+            self.rate(rate)
+        return self.addr(addr, len(data))
+
+    def slots(self):
+        """
+        Get the loaded slots (see `upload_slot`).
+
+        Returns
+        -------
+        slots : dict
+            The `(addr, count)` of each slot, by name, from the least to the
+            most recently used.
+        """
+        return {name: (addr, len(data))
+                for name, (addr, data, rate) in self._slots.items()}
+
+    def remove_slot(self, name):
+        "Forget a slot, so that its memory can be reused."
+        self._slots.pop(name, None)
 
     def trigger(self, count=1):
         """
@@ -345,8 +1717,145 @@ class ADSync:
         if not isinstance(mask, int):
             raise ValueError("Mask must be an integer!")
 
-        self._cmd("TRIGGER MASK", mask)
-        self._reply()
+        return self._set("TRIGGER MASK", mask)
+
+    def trigger_program(self, entries):
+        """
+        Upload a trigger program, which is run by the device at the cycle
+        boundaries once started with `trigger_start`, so that a sequence of
+        triggers has no host timing jitter.  Each entry waits `delay` cycles
+        after the end of the previous one, and then triggers the next
+        `count` cycles.  Uploading a program stops the one which is running.
+        Requires firmware version 1.11 or later.
+
+        Parameters
+        ----------
+        entries : array of ints, shape (N, 2)
+            The `(delay, count)` of each entry (at most `TRIGGER_PROG_SIZE`
+            = 256 entries).
+
+        Returns
+        -------
+        count : int
+            The number of entries received by the device.
+        """
+        entries = np.asarray(entries, dtype='int64').reshape(-1, 2)
+        if len(entries) > TRIGGER_PROG_SIZE:
+            raise ValueError('too many trigger program entries (max %d)'
+                             % TRIGGER_PROG_SIZE)
+        if entries.size and ((entries.min() < 0)
+                             or (entries.max() > 0xFFFFFFFF)):
+            raise ValueError('trigger program entries must be uint32')
+
+        if len(entries):
+            self._cmd("TRIGGER PROG", entries.astype('<u4'))
+        else:
+            self._cmd("TRIGGER PROG")
+        return self._reply(
+            parse=lambda reply: self._parse_query("TRIGGER PROG", reply)[0])
+
+    def trigger_start(self):
+        """
+        Start the trigger program.  The first delay counts from the next
+        output cycle, or if the output is stopped, from the second cycle
+        after it is started (as the first is never triggered).  Starting a
+        running program restarts it.  Requires firmware version 1.11 or
+        later.
+        """
+        self._cmd("TRIGGER START")
+        return self._reply()
+
+    def trigger_stop(self):
+        """
+        Stop the trigger program, cancel a pending `trigger_at`, and end any
+        trigger in progress.  Requires firmware version 1.11 or later.
+        """
+        self._cmd("TRIGGER STOP")
+        return self._reply()
+
+    def trigger_at(self, cycle, count=1):
+        """
+        Trigger a number of output cycles, starting with the cycle numbered
+        `cycle` by the device cycle counter (see `cycle_count`).  If that
+        cycle has already started, the trigger starts with the next one.
+        Requires firmware version 1.11 or later.
+
+        Parameters
+        ----------
+        cycle : int
+            The number of the first triggered cycle (modulo 2**32).
+
+        Keywords
+        --------
+        count : int (default: 1)
+            The number of cycles to trigger.
+        """
+        if not (isinstance(cycle, int) and isinstance(count, int)):
+            raise ValueError("Cycle and count must be integers!")
+
+        self._cmd("TRIGGER AT", cycle & 0xFFFFFFFF, count)
+        return self._reply()
+
+    def cycle_count(self):
+        """
+        Get the number of the current output cycle.  The counter advances at
+        the start of each cycle (including the first after the output is
+        started), holds while the output is stopped, and wraps at 2**32.
+        Requires firmware version 1.11 or later.
+
+        Returns
+        -------
+        cycle : int
+        """
+        self._cmd("SYNC COUNT")
+        return self._reply(parse=lambda reply: (
+            self._parse_query("SYNC COUNT", reply)[0] & 0xFFFFFFFF))
+
+    def trigger_status(self):
+        """
+        Get the progress of the trigger program and `trigger_at`.  Requires
+        firmware version 1.11 or later.
+
+        Returns
+        -------
+        status : dict
+            - `running`: True if the program has entries left to trigger
+            - `entry`: the number of entries which have triggered
+            - `entries`: the length of the program
+            - `at_pending`: True if a `trigger_at` is waiting for its cycle
+            - `remaining`: the number of cycles left to trigger after the
+              current one
+        """
+        self._cmd("TRIGGER STAT")
+
+        def parse(reply):
+            running, entry, entries, at_pending, remaining = \
+                self._parse_query("TRIGGER STAT", reply)
+            return dict(running=bool(running), entry=entry, entries=entries,
+                        at_pending=bool(at_pending), remaining=remaining)
+
+        return self._reply(parse=parse)
+
+    def _triggers_done(self, status):
+        return not (status['running'] or status['at_pending']
+                    or status['remaining'] > 0)
+
+    def wait_trigger(self, timeout=None):
+        """
+        Wait until the trigger program and any `trigger_at` have finished
+        triggering.
+
+        Keywords
+        --------
+        timeout : float (default: None)
+            The maximum time to wait, in seconds.  If None, wait
+            indefinitely.
+        """
+        t0 = self._time()
+        while not self._triggers_done(self.trigger_status()):
+            if (timeout is not None) and (self._time() - t0 > timeout):
+                raise ADSyncError('timed out waiting for the triggers')
+            self._sleep(self.TRIGGER_POLL)
 
     def led(self, r, g, b):
         """
@@ -357,8 +1866,88 @@ class ADSync:
         r, g, b : ints
             The brightness of each channel, 0-255.  Output is gamma corrected.
         """
-        self._cmd("LED", r, g, b)
-        self._reply()
+        return self._set("LED", r, g, b)
+
+    def cache(self, on=True):
+        """
+        Turn pre-rendering of the sync output on or off.  When on, the
+        device computes the output words for the whole cycle in advance, so
+        that it only has to copy them while running.  This allows higher
+        output rates, and leaves more time for serial communication.  Only
+        cycles of up to `SYNC_CACHE_SIZE` (2048) samples are pre-rendered;
+        longer ones are computed as usual.  Requires firmware version 1.8 or
+        later.
+
+        Keywords
+        --------
+        on : bool (default: True)
+        """
+        return self._set("SYNC CACHE", int(bool(on)),
+                         cmd=("SYNC CACHE", "ON" if on else "OFF"),
+                         limit=False)
+
+    def cache_ready(self):
+        """
+        Check if the sync output is currently being copied from the
+        pre-rendered cache (see `cache`).  After the output settings or data
+        change, it takes a short time for the cache to be rebuilt.
+
+        Returns
+        -------
+        ready : bool
+        """
+        self._cmd("SYNC CACHE")
+        return self._reply(
+            parse=lambda reply: self._parse_query("SYNC CACHE", reply)[1] != 0)
+
+    def dma(self, count=None, length=None):
+        """
+        Set the DMA buffers of the sync output.  These hold the output which
+        has been computed but not yet sent, so larger buffers give the
+        device more time for other work (e.g. Bluetooth, or long commands)
+        before the output runs dry, at the expense of a longer delay before
+        triggers take effect.  Changing the buffers interrupts the output
+        briefly.  Requires firmware version 1.9 or later.
+
+        Keywords
+        --------
+        count : int (default: None)
+            The number of buffers (2-32).  If None, the buffers are chosen
+            automatically to hold about 5 ms of output at the current rate
+            (the default).
+        length : int (default: None)
+            The length of each buffer, in samples (an even number from
+            16-1024).  The total size of the buffers can be at most 4096
+            samples.
+        """
+        if (count is None) != (length is None):
+            raise ValueError('count and length should both be specified, '
+                             'or neither')
+
+        if count is None:
+            self._cmd("SYNC DMA AUTO")
+        else:
+            self._cmd("SYNC DMA", count, length)
+        return self._reply()
+
+    def dma_buffers(self):
+        """
+        Get the DMA buffers of the sync output (see `dma`).
+
+        Returns
+        -------
+        count, length : int
+            The number of buffers, and their length in samples.
+        auto : bool
+            True if the buffers are chosen automatically from the rate.
+        """
+        self._cmd("SYNC DMA")
+
+        def parse(reply):
+            count, length, auto = self._parse_query("SYNC DMA", reply)
+            return count, length, bool(auto)
+
+        return self._reply(parse=parse)
 
     def _send_bin(self, data):
         if isinstance(data, np.ndarray):
@@ -380,9 +1969,11 @@ class ADSync:
         if channel not in (1, 2):
             raise ADSyncError("channel must be 1 or 2")
 
-        if isinstance(data, (str, bytes)):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if isinstance(data, bytes):
             # Convert to an aray, so that _cmd sends it as binary
-            data = np.fromstring(data, dtype='u1')
+            data = np.frombuffer(data, dtype='u1')
         elif not isinstance(data, np.ndarray):
             raise ValueError(
                 "data should be a string, bytes object or numpy array"
@@ -461,7 +2052,9 @@ class ADSync:
         if channel not in (1, 2):
             raise ADSyncError("channel must be 1 or 2")
         self._cmd("SER%d AVAIL" % channel)
-        reply = self._reply()
+        return self._reply(parse=self._parse_avail)
+
+    def _parse_avail(self, reply):
         try:
             return(int(reply))
         except ValueError:
@@ -483,7 +2076,7 @@ class ADSync:
             given name.  If None is passed, disable the bluetooth connection
         """
         if name:
-            name = np.fromstring(name, dtype='u1')
+            name = np.frombuffer(name.encode('utf-8'), dtype='u1')
         else:
             name = None
         self._cmd("BLUETOOTH", name)
@@ -491,6 +2084,8 @@ class ADSync:
 
     def close(self):
         "Close the serial port associated with the device."
+        self.invalidate_shadow()
+        self.invalidate_settings()
         self.ser.close()
 
     def __del__(self):
@@ -498,6 +2093,10 @@ class ADSync:
 
 
 class SmoothRamp:
+    # Samples are evaluated in blocks of this size, to bound the size of the
+    #   temporary arrays
+    BLOCK = 1 << 16
+
     def __init__(self, t0=0, ts=1, tr=0.5, tj=None, rate=None):
         '''Create a smooth ramp function.
 
@@ -518,7 +2117,9 @@ class SmoothRamp:
         After creating a ramp function, you can call it like a function, where
         the input is the times at which to compute the ramp.  Optionally, you
         can specify a keyword `d=[0-3]` in the function call, which outputs a
-        derivative of the ramp function.
+        derivative of the ramp function, and `out` (an array with the same
+        shape as the input), which receives the result.  Float32 input is
+        evaluated in float32.
         '''
         if tj is None:
             self.tj = tr / 8
@@ -561,32 +2162,49 @@ class SmoothRamp:
 
         self.T = self.tl + self.tr
 
-    def __call__(self, t, d=0):
-        dt = (np.asarray(t) % self.T)
-        sort = np.argsort(dt)
-        unsort = np.argsort(sort)
-        t = dt[sort]
-        x = np.zeros_like(dt)
-        i0 = 0
-
-        for (dt, x0, v, a, j) in self.profile:
-            try:
-                i1 = np.where(t > dt)[0][0]
-            except:
-                i1 = len(t)
-            tt = t[i0:i1]
-            if d == 0:
-                x[i0:i1] = x0 + v*tt + (a/2)*tt**2 + (j/6) * tt**3
-            elif d == 1:
-                x[i0:i1] = v + a*tt + (j/2)*tt**2
-            elif d == 2:
-                x[i0:i1] = a + j*tt
-            elif d == 3:
-                x[i0:i1] = j
-            else:
-                raise ValueError('derivative (d) should be 0--3')
-
-            t -= dt
-            i0 = i1
-
-        return np.array(x[unsort])
+        # The end time of each stage; a sample at a boundary belongs to the
+        #   earlier stage
+        self._ends = np.cumsum([p[0] for p in self.profile])
+        self._starts = self._ends - [p[0] for p in self.profile]
+        # Polynomial coefficients (in the time since the start of the stage)
+        #   of each derivative, indexed by [d, stage, power]
+        self._coef = np.zeros((4, len(self.profile), 4))
+        for i, (dt, x0, v, a, j) in enumerate(self.profile):
+            self._coef[0, i] = (x0, v, a/2, j/6)
+            self._coef[1, i] = (v, a, j/2, 0)
+            self._coef[2, i] = (a, j, 0, 0)
+            self._coef[3, i] = (j, 0, 0, 0)
+
+    def __call__(self, t, d=0, out=None):
+        if d not in (0, 1, 2, 3):
+            raise ValueError('derivative (d) should be 0--3')
+
+        t = np.asarray(t)
+        dtype = np.result_type(t, self.T)
+        if out is None:
+            out = np.empty(t.shape, dtype)
+        elif (out.shape != t.shape) or not out.flags.c_contiguous:
+            raise ValueError('out should be a contiguous array with the same '
+                             'shape as t')
+
+        ends = self._ends.astype(dtype)
+        starts = self._starts.astype(dtype)
+        coef = self._coef[d].astype(dtype)
+        last = len(ends) - 1
+        t, x = t.reshape(-1), out.reshape(-1)
+
+        for i0 in range(0, len(t), self.BLOCK):
+            tt = t[i0:i0 + self.BLOCK] % dtype.type(self.T)
+            # Samples past the last boundary (by rounding) are in the last
+            #   stage
+            stage = np.minimum(np.searchsorted(ends, tt), last)
+            tt -= starts[stage]
+
+            # Horner's rule, skipping the powers which are always zero
+            xx = coef[stage, 3 - d]
+            for n in range(2 - d, -1, -1):
+                xx *= tt
+                xx += coef[stage, n]
+            x[i0:i0 + self.BLOCK] = xx
+
+        return out
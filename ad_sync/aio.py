@@ -0,0 +1,492 @@
+"""
+An asyncio interface to the synchronizer board.
+
+`AsyncADSync` has the same methods as `ADSync`, but instead of blocking
+until the device replies, each command returns an awaitable future:
+
+    sync = await AsyncADSync.open("emu://")
+    await sync.led(0, 255, 0)
+    rate, mode = await asyncio.gather(sync.rate(1000), sync.mode(1, 0))
+
+Commands are sent as soon as they are issued, without waiting for the
+previous replies (but never more than `WINDOW` bytes ahead of them), and the
+replies are matched to the commands in order.  The blocking serial calls are
+made in worker threads, so the event loop is free to run other tasks in the
+meantime.
+
+Cancelling a future before its command is sent removes the command from the
+queue; if it has already been sent, the reply is read and discarded.
+"""
+
+import asyncio
+import collections
+import numpy as np
+from . import ADSync, ADSyncError
+
+
+class _Incomplete(Exception):
+    pass
+
+
+class _ReplyBuffer:
+    # Received data, with the subset of the serial port methods used by the
+    #   reply parsers.  If the requested data hasn't all arrived yet, they
+    #   raise _Incomplete.
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.data = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        del self.data[:self.pos]
+        self.pos = 0
+        self.data += data
+
+    def read(self, size=1):
+        if self.pos + size > len(self.data):
+            raise _Incomplete()
+        data = bytes(self.data[self.pos:self.pos + size])
+        self.pos += size
+        return data
+
+    def read_until(self, expected=b'\n'):
+        i = self.data.find(expected, self.pos)
+        if i < 0:
+            raise _Incomplete()
+        return self.read(i + len(expected) - self.pos)
+
+    def readline(self):
+        return self.read_until(b'\n')
+
+
+class AsyncADSync(ADSync):
+    '''
+    asyncio version of `ADSync`.  This should be created with
+    `await AsyncADSync.open(port)` rather than called directly, so that the
+    background tasks are started.  (It can also be used as an async context
+    manager, which closes the connection on exit.)
+
+    All of the `ADSync` command methods return awaitables; `batch` has no
+    effect, as commands are always pipelined.  `reset`, `update`,
+    `update_ad`, `update_bank`, `update_bank_ad`, `upload_slot`,
+    `wait_swap`, `wait_trigger`, `query_state`, `read`, `check_shadow` and
+    `aclose` are coroutines.  Settings which haven't changed are skipped as
+    in `ADSync`, but `max_rate` is not supported.
+    '''
+    def __init__(self, port, baud=921600, timeout=0.5, debug=False):
+        super().__init__(port, baud=baud, timeout=timeout, debug=debug)
+        # Commands are always queued, which the ADSync methods see as an
+        #   open batch.  (Nothing is ever added to this.)
+        self._batch = []
+        self._rx = _ReplyBuffer()
+        self._queue = collections.deque()
+        self._sent = collections.deque()
+        self._in_flight = 0
+        self._last_io = 0
+        self._tasks = []
+        self._serial_readers = {}
+
+    @classmethod
+    async def open(cls, port, **kwargs):
+        """
+        Connect to a device, and start the background I/O tasks.
+
+        Parameters
+        ----------
+        port : string
+            The serial port address of the device, or pyserial URL.
+
+        Other keywords are passed to `ADSync`.
+        """
+        loop = asyncio.get_running_loop()
+        self = await loop.run_in_executor(None, lambda: cls(port, **kwargs))
+        self._loop = loop
+        self._wake_writer = asyncio.Event()
+        self._wake_reader = asyncio.Event()
+        self._tasks = [loop.create_task(self._writer()),
+                       loop.create_task(self._reader())]
+        self._firmware_version = self._parse_version(await self.idn())
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    @property
+    def _input(self):
+        return self._rx
+
+    @property
+    def firmware_version(self):
+        "The firmware version of the device (queried by `open`)."
+        return self._firmware_version
+
+    def _completed(self, reply):
+        future = self._loop.create_future()
+        future.set_result(reply)
+        return future
+
+    def _result(self, read, parse=None):
+        future = self._loop.create_future()
+        self._queue.append((self._last_cmd, read, parse, future))
+        self._wake_writer.set()
+        return future
+
+    async def _writer(self):
+        loop = self._loop
+        while True:
+            # Send as much as fits in the window; a command larger than the
+            #   window is sent on its own.
+            pending, in_flight = [], self._in_flight
+            while self._queue:
+                cmd, read, parse, future = self._queue[0]
+                if future.cancelled():
+                    # Never sent, so it can just be dropped
+                    self._queue.popleft()
+                elif in_flight and (in_flight + len(cmd) > self.WINDOW):
+                    break
+                else:
+                    pending.append(self._queue.popleft())
+                    in_flight += len(cmd)
+
+            if not pending:
+                self._wake_writer.clear()
+                await self._wake_writer.wait()
+                continue
+
+            if not self._sent:
+                # No replies are expected, so anything received is stale
+                self._rx.clear()
+                if self.ser.in_waiting:
+                    self.ser.reset_input_buffer()
+
+            data = b''.join(cmd for cmd, read, parse, future in pending)
+            self._sent.extend(pending)
+            self._in_flight = in_flight
+            await loop.run_in_executor(None, self.ser.write, data)
+            self._last_io = loop.time()
+            self._wake_reader.set()
+
+            if self.debug:
+                print("Wrote to device: ", data)
+
+    def _read_available(self):
+        return self.ser.read(max(1, self.ser.in_waiting))
+
+    async def _reader(self):
+        loop = self._loop
+        while True:
+            if not self._sent:
+                self._wake_reader.clear()
+                await self._wake_reader.wait()
+                continue
+
+            data = await loop.run_in_executor(None, self._read_available)
+            if data:
+                self._last_io = loop.time()
+                self._rx.feed(data)
+                self._match_replies()
+            elif (loop.time() - self._last_io > self.ser.timeout
+                    + self._in_flight / self.byte_rate):
+                self._complete(ADSyncError('no reply from device'))
+
+    def _match_replies(self):
+        while self._sent:
+            cmd, read, parse, future = self._sent[0]
+            pos = self._rx.pos
+            try:
+                reply = read(cmd)
+            except _Incomplete:
+                self._rx.pos = pos
+                break
+            except ADSyncError as e:
+                self._complete(e)
+            else:
+                self._complete(reply)
+
+    def _complete(self, reply):
+        # Resolve the future for the oldest command sent
+        cmd, read, parse, future = self._sent.popleft()
+        self._in_flight -= len(cmd)
+        self._wake_writer.set()
+
+        if future.cancelled():
+            return
+
+        try:
+            if isinstance(reply, Exception):
+                raise reply
+            if parse is not None:
+                reply = parse(reply)
+        except asyncio.CancelledError:
+            future.cancel()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(reply)
+
+    def _cancel_all(self):
+        # Cancel every command which hasn't been answered
+        for cmd, read, parse, future in self._queue:
+            future.cancel()
+        for cmd, read, parse, future in self._sent:
+            future.cancel()
+        self._queue.clear()
+        self._sent.clear()
+        self._in_flight = 0
+        self._rx.clear()
+
+    async def reset(self):
+        """
+        Reset the device.  Any commands waiting for a reply are cancelled.
+
+        Note: this works by activing the RTS bit on the serial port, which
+        will *not* work over bluetooth!
+        """
+        self.invalidate_shadow()
+        self.invalidate_settings()
+        self._cancel_all()
+        self.ser.rts = True
+        await asyncio.sleep(0.5)
+        self.ser.rts = False
+        await asyncio.sleep(1.0)
+        # The boot messages will be discarded before the next command
+
+    async def update(self, addr, data, overhead=None, progress=None):
+        """
+        Write data to the sync memory, only sending the samples which differ
+        from what was previously written.  (See `ADSync.update`.)
+
+        Returns
+        -------
+        count : int
+            The number of samples sent to the device.
+        """
+        data = np.asarray(data, dtype='uint32').reshape(-1)
+        runs = self._changed_runs(addr, data, overhead)
+        total = sum(i1 - i0 for i0, i1 in runs)
+
+        writes, sent = [], 0
+        for i0, i1 in runs:
+            run_progress = None
+            if progress is not None:
+                run_progress = (lambda n, t, sent=sent:
+                                progress(sent + n, total))
+            writes.append(self.write(addr + i0, data[i0:i1],
+                                     progress=run_progress))
+            sent += i1 - i0
+
+        await asyncio.gather(*writes)
+        return total
+
+    async def wait_swap(self, timeout=None):
+        """
+        Wait until a pending `swap` has happened.  (See `ADSync.wait_swap`.)
+        """
+        if timeout is None:
+            timeout = self._swap_timeout()
+        t0 = self._time()
+        while await self.swap_pending():
+            if self._time() - t0 > timeout:
+                raise ADSyncError('timed out waiting for the sync swap')
+            await self._sleep(self.SWAP_POLL)
+
+    async def wait_trigger(self, timeout=None):
+        """
+        Wait until the trigger program and any `trigger_at` have finished
+        triggering.  (See `ADSync.wait_trigger`.)
+        """
+        t0 = self._time()
+        while not self._triggers_done(await self.trigger_status()):
+            if (timeout is not None) and (self._time() - t0 > timeout):
+                raise ADSyncError('timed out waiting for the triggers')
+            await self._sleep(self.TRIGGER_POLL)
+
+    def _time(self):
+        # See `ADSync._time`
+        return self.ser.clock if hasattr(self.ser, 'advance') \
+            else self._loop.time()
+
+    async def _sleep(self, seconds):
+        if hasattr(self.ser, 'advance'):
+            self.ser.advance(seconds)
+            await asyncio.sleep(0)
+        else:
+            await asyncio.sleep(seconds)
+
+    async def update_bank(self, data, progress=None):
+        """
+        Replace the output cycle without stopping the output.  (See
+        `ADSync.update_bank`.)
+
+        Returns
+        -------
+        start : int
+            The first address of the bank which was written.
+        """
+        data = np.asarray(data, dtype='uint32').reshape(-1)
+        if len(data) > self.BANK_SIZE:
+            raise ValueError('data is too long for a bank (max %d samples)'
+                             % self.BANK_SIZE)
+
+        await self.wait_swap()
+        start, restart = self._bank_for(await self.state())
+        if restart:
+            await self.stop()
+
+        await self.update(start, data, progress=progress)
+        if not await self.check_shadow(start, len(data)):
+            await self.update(start, data)
+        await self.swap(start, len(data))
+
+        if restart:
+            await self.start()
+
+        return start
+
+    async def upload_slot(self, name, data, rate=None, progress=None):
+        """
+        Load data into a named slot of the sync memory.  (See
+        `ADSync.upload_slot`.)
+
+        Returns
+        -------
+        addr : int
+            The first address of the slot.
+        """
+        data = np.array(data, dtype='uint32').reshape(-1)
+        if not self._output_known():
+            await self.query_state()
+        plan = self._plan_slot(name, data, rate)
+        if plan is None:
+            return self._slots[name][0]
+
+        addr, moves = plan
+        for key, new_addr in moves.items():
+            start, old_data, old_rate = self._slots[key]
+            try:
+                await self._write_slot(new_addr, old_data)
+            except BaseException:
+                self._forget_moves(moves)
+                raise
+            self._slots[key] = (new_addr, old_data, old_rate)
+
+        await self._write_slot(addr, data, progress)
+        self._slots[name] = (addr, data, rate)
+        return addr
+
+    async def _write_slot(self, addr, data, progress=None):
+        await self.update(addr, data, progress=progress)
+        if (self.firmware_version >= (1, 4)
+                and not await self.check_shadow(addr, len(data))):
+            await self.update(addr, data)
+
+    async def query_state(self):
+        """
+        Read all of the settings from the device, and update the host side
+        mirror of them.  (See `ADSync.query_state`.)
+        """
+        if self.firmware_version >= (1, 3):
+            return self._store_state(self._state_replies(await self.state()))
+        if self.firmware_version < (1, 2):
+            raise ADSyncError("query_state requires firmware version >= 1.2")
+
+        futures = []
+        for key in self.SETTINGS:
+            self._cmd(key)
+            futures.append(self._reply())
+        replies = await asyncio.gather(*futures)
+
+        return self._store_state(dict(zip(self.SETTINGS, replies)))
+
+    async def read(self, addr, count):
+        """
+        Read data back from the sync memory.  (See `ADSync.read`.)
+        """
+        self._check_range(addr, count)
+        data = np.empty(count, dtype='uint32')
+        i = 0
+        while i < count:
+            self._cmd("SYNC READ", addr + i, min(count - i, self.READ_CHUNK))
+            i += self._store_read(data, i, await self._bin_reply())
+
+        return data
+
+    async def check_shadow(self, addr=0, count=None):
+        """
+        Check that the host side copy of the sync memory matches the device.
+        (See `ADSync.check_shadow`.)
+        """
+        results = await asyncio.gather(*[
+            self._check_shadow_run(i0, i1)
+            for i0, i1 in self._shadow_runs(addr, count)])
+        return all(results)
+
+    def serial_reader(self, channel, interval=0.01):
+        """
+        Start a background task which drains one of the tunneled serial
+        ports.  If the task is already running, the same queue is returned.
+
+        Parameters
+        ----------
+        channel : int (1-2)
+
+        Keywords
+        --------
+        interval : float (default: 0.01)
+            The time between polls of the device, in seconds, when no data is
+            available.
+
+        Returns
+        -------
+        queue : asyncio.Queue
+            A queue which receives the data (as bytes) as it is read.
+        """
+        if channel not in self._serial_readers:
+            queue = asyncio.Queue()
+            task = self._loop.create_task(
+                self._drain_serial(channel, queue, interval))
+            self._serial_readers[channel] = (task, queue)
+
+        return self._serial_readers[channel][1]
+
+    def stop_serial_reader(self, channel):
+        "Stop the background reader for a tunneled serial port."
+        task, queue = self._serial_readers.pop(channel, (None, None))
+        if task is not None:
+            task.cancel()
+
+    async def _drain_serial(self, channel, queue, interval):
+        while True:
+            try:
+                data = await self.ser_read(channel)
+            except ADSyncError:
+                data = b''
+
+            if data:
+                queue.put_nowait(data)
+            else:
+                await asyncio.sleep(interval)
+
+    async def aclose(self):
+        "Stop the background tasks and close the serial port."
+        tasks = self._tasks + [task for task, queue in
+                               self._serial_readers.values()]
+        self._tasks = []
+        self._serial_readers = {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.close()
+
+    def close(self):
+        "Close the serial port; `aclose` should be used instead if possible."
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
+        self._cancel_all()
+        super().close()
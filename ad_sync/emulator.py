@@ -0,0 +1,1387 @@
+"""
+A pure Python emulator of the synchronizer board.
+
+The command processing is a direct port of the firmware `CommandQueue`
+(see `firmware/src/commands.cpp`), so it accepts exactly the same command
+grammar and returns the same replies (including errors).  It can be used to
+exercise `ADSync` or the GUI without any hardware attached:
+
+    sync = ADSync("emu://")
+
+The "emu://" transport models the serial link timing: every byte costs
+10 bits at the configured baud rate, and each direction has a fixed
+latency.  Nothing actually sleeps; instead the time is accumulated on a
+virtual clock (`sync.ser.clock`), so that upload throughput and command
+latency can be measured deterministically.  The emulated device follows the
+same clock (e.g. for the output cycle count, `SYNC COUNT`), and waits in
+`ADSync` (e.g. `wait_trigger`) advance it rather than sleeping.
+
+URL format: `emu://[name][?latency=seconds][&loopback=1]`
+    - Connections with the same name share the same emulated device (so the
+      device state survives a reconnect).  If no name is given, a new device
+      is created for each connection.
+    - `latency` is the one way USB latency, in seconds (default: 0.0005)
+    - If `loopback` is specified, the tunneled serial ports are connected
+      TX -> RX, so that anything written to them can be read back.
+
+Alternatively, `serve_pty` exposes an emulated device on a pseudo terminal,
+for programs which need a real serial device.  (Run
+`python -m ad_sync.emulator` to start one from the command line.)
+"""
+
+import collections
+import threading
+import time
+import urllib.parse
+import zlib
+import numpy as np
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError
+from . import firmware, pack
+
+# Character types
+WHITESPACE, EOL, ALPHA, DIGIT, BINSTART = range(5)
+
+# States of the input character processor
+IDLE, READ_WORD, READ_INT, READ_BIN, READ_BIN_LEN, CMD_ERROR = range(6)
+TARGET_NONE, TARGET_SYNC_DATA, TARGET_SERIAL1, TARGET_SERIAL2, \
+    TARGET_BT_NAME, TARGET_SYNC_PACKED, TARGET_TRIGGER_PROG = range(7)
+
+# Command words, in the same order as the CMD_NAMES enum in "commands.h"
+CMD_NAMES = firmware.CMD_NAMES
+CMD_INVALID = len(CMD_NAMES)
+# The first four characters of each word, packed into an integer
+CMD_WORDS = [int.from_bytes(name[:4].encode('ascii'), 'big')
+             for name in CMD_NAMES]
+
+MAX_CMD_INTS = 4
+
+# Error types, and the corresponding strings
+NO_ERROR, ERR_UNKNOWN_COMMAND, ERR_INVALID_COMMAND, ERR_EXTRA_BIN_DATA, \
+    ERR_INVALID_ARG, ERR_MALFORMED_ARG, ERR_INVALID_ADDR, \
+    ERR_INVALID_BIN_DATA_LEN, ERR_TOO_MANY_ARGS, ERR_INVALID_FREQ, \
+    ERR_MISSING_ARG, ERR_WRONG_NUM_ARGS1, ERR_WRONG_NUM_ARGS2, \
+    ERR_BT_NAME_TOO_LONG, ERR_INVALID_PACKED_DATA = range(15)
+
+ERROR_STR = (
+    "mystery error (this should never happen)",
+    "unknown command",
+    "invalid command",
+    "included binary data, but command does not support it",
+    "invalid argument value",
+    "malformed argument (only integer arguments accepted)",
+    "invalid address",
+    "invalid binary data length",
+    "too many arguments",
+    "invalid freq (should be >=30 and <=700000)",
+    "missing argument",
+    "wrong number of arguments (should be 1)",
+    "wrong number of arguments (should be 2)",
+    "bluetooth name too long (64 chars max)",
+    "invalid packed data",
+)
+
+
+def cmd_code(*words):
+    '''
+    Return the integer command code for a sequence of command words, as
+    computed by the `CMD2`/`CMD3`/`CMD4` macros in the firmware.
+    '''
+    code = 0
+    for word in words:
+        code = (code << 8) + CMD_NAMES.index(word)
+    return code
+
+
+def char_type(c):
+    if c == 10: return EOL
+    if c == 62: return BINSTART
+    if c <= 32: return WHITESPACE
+    if (c >= 48) and (c <= 57): return DIGIT
+    else: return ALPHA
+
+
+def _int32(x):
+    # Integers are output with itoa, so arguments >= 2^31 are negative.
+    x &= 0xFFFFFFFF
+    return x - (1 << 32) if x & 0x80000000 else x
+
+
+class CircularBuffer:
+    '''
+    Fixed size byte buffer, which (like the firmware version) drops data and
+    sets the `overflow` flag if it is full.  The number of bytes lost is
+    counted in `dropped`.
+    '''
+    def __init__(self, size=firmware.SER_BUFFER_SIZE):
+        self.size = size
+        self.buffer = bytearray()
+        self.overflow = 0
+        self.dropped = 0
+
+    @property
+    def available(self):
+        return len(self.buffer)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif isinstance(data, int):
+            data = bytes((data, ))
+        n = min(len(data), self.size - len(self.buffer))
+        self.buffer += data[:n]
+        if n != len(data):
+            self.overflow = 1
+            self.dropped += len(data) - n
+        return n
+
+    def read(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = len(self.buffer)
+        data = bytes(self.buffer[:max_bytes])
+        del self.buffer[:max_bytes]
+        return data
+
+    def to_stream(self, buf, max_bytes=None):
+        n = min(buf.size - buf.available, self.available)
+        if max_bytes is not None:
+            n = min(n, max_bytes)
+        return buf.write(self.read(n))
+
+    def flush(self):
+        self.buffer = bytearray()
+        self.overflow = 0
+
+
+class TunnelPort:
+    '''
+    One of the auxiliary (tunneled) serial ports of the emulated device.
+
+    Data transmitted by the device is appended to `transmitted`; data can be
+    sent to the device with `receive`.  If `loopback` is True, anything
+    transmitted is also received (as if TX and RX are connected).
+    '''
+    def __init__(self, loopback=False):
+        self.loopback = loopback
+        self.baud = 9600
+        self.transmitted = bytearray()
+        self.input = CircularBuffer()
+        self.output = CircularBuffer()
+        self._pending = bytearray()
+
+    def receive(self, data):
+        "Send data to the device through this port."
+        self._pending += data
+        self.update()
+
+    def update(self):
+        # Equivalent of the to_stream/from_stream calls in the main loop
+        data = self.output.read()
+        self.transmitted += data
+        if self.loopback:
+            self._pending += data
+        n = self.input.write(bytes(self._pending))
+        del self._pending[:n]
+
+
+class CommandQueue:
+    '''
+    Port of the firmware command processor.  Characters are fed in with
+    `process_char` (or `process`, which is equivalent but faster for binary
+    data), and the replies are placed in `output_buffer`.
+    '''
+    def __init__(self, device):
+        self.device = device
+        self.output_buffer = CircularBuffer()
+        self.unpacker = pack.Unpacker()
+        self.word = 0
+        self.word_i = 0
+        self.reset()
+
+        # Dispatch table for execute_command; equivalent to the switch
+        #   statement in the firmware.
+        self.commands = {
+            cmd_code("*IDN"): self._idn,
+            cmd_code("LED"): self._led,
+            cmd_code("SER1", "WRITE"): lambda: self._ser_write(1),
+            cmd_code("SER2", "WRITE"): lambda: self._ser_write(2),
+            cmd_code("SER1", "AVAIL"): lambda: self._ser_avail(1),
+            cmd_code("SER2", "AVAIL"): lambda: self._ser_avail(2),
+            cmd_code("SER1", "READ"): lambda: self._ser_read(1),
+            cmd_code("SER2", "READ"): lambda: self._ser_read(2),
+            cmd_code("SER1", "RATE"): lambda: self._ser_rate(1),
+            cmd_code("SER2", "RATE"): lambda: self._ser_rate(2),
+            cmd_code("SER1", "FLUSH"): lambda: self._ser_flush(1),
+            cmd_code("SER2", "FLUSH"): lambda: self._ser_flush(2),
+            cmd_code("SYNC", "STAT"): self._sync_stat,
+            cmd_code("SYNC", "WRITE"): self._sync_write,
+            cmd_code("SYNC", "PACK"): self._sync_pack,
+            cmd_code("SYNC", "READ"): self._sync_read,
+            cmd_code("SYNC", "CRC"): self._sync_crc,
+            cmd_code("ANA0", "SET"): lambda: self._ana_set(0),
+            cmd_code("ANA1", "SET"): lambda: self._ana_set(1),
+            cmd_code("ANA0", "SCALE"): lambda: self._ana_scale(0),
+            cmd_code("ANA1", "SCALE"): lambda: self._ana_scale(1),
+            cmd_code("SYNC", "MODE"): self._sync_mode,
+            cmd_code("SYNC", "ADDR"): self._sync_addr,
+            cmd_code("SYNC", "START"): self._sync_start,
+            cmd_code("SYNC", "STOP"): self._sync_stop,
+            cmd_code("SYNC", "SWAP"): self._sync_swap,
+            cmd_code("SYNC", "CACHE"): self._sync_cache,
+            cmd_code("SYNC", "CACHE", "ON"): lambda: self._sync_cache(1),
+            cmd_code("SYNC", "CACHE", "OFF"): lambda: self._sync_cache(0),
+            cmd_code("SYNC", "DMA"): self._sync_dma,
+            cmd_code("SYNC", "DMA", "AUTO"): self._sync_dma_auto,
+            cmd_code("SYNC", "PERF"): self._sync_perf,
+            cmd_code("SYNC", "STAGE"): self._sync_stage,
+            cmd_code("SYNC", "COMMIT"): self._sync_commit,
+            cmd_code("SYNC", "ACTIVE"): self._sync_active,
+            cmd_code("SYNC", "DUMP"): self._sync_dump,
+            cmd_code("SYNC", "RATE"): self._sync_rate,
+            cmd_code("TRIGGER", "MASK"): self._trigger_mask,
+            cmd_code("TRIGGER"): self._trigger,
+            cmd_code("TRIGGER", "PROG"): self._trigger_prog,
+            cmd_code("TRIGGER", "START"): self._trigger_start,
+            cmd_code("TRIGGER", "STOP"): self._trigger_stop,
+            cmd_code("TRIGGER", "STAT"): self._trigger_stat,
+            cmd_code("TRIGGER", "AT"): self._trigger_at,
+            cmd_code("SYNC", "COUNT"): self._sync_count,
+            cmd_code("BLUETOOTH"): self._bluetooth,
+        }
+
+    def reset(self):
+        self.cycle = IDLE
+        self.error = NO_ERROR
+        self.command = 0
+        self.args = [0] * (MAX_CMD_INTS + 1)
+        self.num_args = 0
+        self.bin_data_len = 0
+        self.bin_target = TARGET_NONE
+        self.sync_ptr = 0
+        self.bin_data_written = 0
+        self.unpacker.reset()
+
+    def output_int(self, x):
+        return self.output_buffer.write(str(_int32(int(x))))
+
+    def output_eol(self):
+        return self.output_buffer.write("\n")
+
+    def output_ok(self):
+        return self.output_buffer.write("ok.\n")
+
+    def output_error(self):
+        nbytes = self.output_buffer.write("ERROR: ")
+        nbytes += self.output_buffer.write(ERROR_STR[self.error])
+        nbytes += self.output_eol()
+        return nbytes
+
+    def output_float(self, x):
+        return self.output_buffer.write(firmware.format_float(x))
+
+    def finish_word(self):
+        word_id = CMD_INVALID
+        for i in range(1, len(CMD_WORDS)):
+            if CMD_WORDS[i] == self.word:
+                word_id = i
+                break
+
+        self.command = ((self.command << 8) + word_id) & 0xFFFFFFFF
+        self.word_i = 0
+        self.word = 0
+
+        self.cycle = IDLE
+
+    def execute_command(self):
+        if self.cycle == READ_WORD:
+            self.finish_word()
+
+        if self.error:
+            self.output_error()
+        else:
+            func = self.commands.get(self.command)
+            if func is None:
+                self.error = ERR_INVALID_COMMAND
+                self.output_error()
+            else:
+                func()
+
+        self.reset()
+
+    def _fail(self, error):
+        self.error = error
+        self.output_error()
+
+    # Command implementations; these mirror the cases in execute_command
+    def _idn(self):
+        self.output_buffer.write(
+            "USB analog/digital synchronizer (version %d.%d).\n" %
+            (firmware.VERSION_MAJOR, firmware.VERSION_MINOR)
+        )
+
+    def _query(self, name, *values):
+        # Reply to a query (a setting command without arguments)
+        self.output_buffer.write(name)
+        for x in values:
+            self.output_buffer.write(" ")
+            self.output_int(x)
+        self.output_eol()
+
+    def _led(self):
+        if self.num_args == 0:
+            self._query("LED", *self.device.led)
+            return
+
+        self.device.led = tuple(
+            max(min(_int32(x), 255), 0) for x in self.args[:3]
+        )
+        self.output_ok()
+
+    def _ser_write(self, n):
+        self.output_buffer.write("Wrote ")
+        self.output_int(self.bin_data_written)
+        self.output_buffer.write(" bytes to serial %d.\n" % n)
+
+    def _ser_avail(self, n):
+        self.output_int(self.device.ser[n].input.available)
+        self.output_eol()
+
+    def _ser_read(self, n):
+        ser_input = self.device.ser[n].input
+        nb = min(ser_input.available,
+            (firmware.SER_BUFFER_SIZE - self.output_buffer.available) - 10)
+        if self.num_args >= 1:
+            nb = min(self.args[0], nb)
+
+        self.output_buffer.write(">")
+        self.output_int(nb)
+        self.output_buffer.write(">")
+        ser_input.to_stream(self.output_buffer, nb)
+        self.output_eol()
+
+    def _ser_rate(self, n):
+        if self.num_args != 1:
+            self._fail(ERR_WRONG_NUM_ARGS1)
+        else:
+            self.device.ser[n].baud = self.args[0]
+            self.output_ok()
+
+    def _ser_flush(self, n):
+        self.device.ser[n].input.flush()
+        self.device.ser[n].output.flush()
+        self.output_ok()
+
+    def _sync_stat(self):
+        self.output_buffer.write("I2S: wrote ")
+        self.output_int(self.device.dma[1] // 2 * 8)
+        self.output_buffer.write(" bytes ")
+        self.output_int(0)
+        self.output_buffer.write(" us ago (")
+        self.output_int(0)
+        self.output_buffer.write(" us to update buffer, ")
+        self.output_int(0)
+        self.output_buffer.write(" us max, ")
+        self.output_int(0)
+        self.output_buffer.write(" underruns)\n")
+
+    def _sync_write(self):
+        # Note: the data is actually written in process_char!
+        self.output_buffer.write("Wrote ")
+        self.output_int(self.bin_data_written // 4)
+        self.output_buffer.write(
+            " samples to syncronous data, starting at address ")
+        self.output_int(self.args[0])
+        if self.bin_data_written % 4:
+            self.output_buffer.write(
+                ". (Warning: %d extra bytes written at end!)\n")
+        else:
+            self.output_buffer.write(".\n")
+
+    def _sync_pack(self):
+        # Note: the data is decoded in process_char!
+        if self.unpacker.state != pack.PACK_DONE:
+            self._fail(ERR_INVALID_PACKED_DATA)
+        else:
+            self.output_buffer.write("Wrote ")
+            self.output_int(self.unpacker.total)
+            self.output_buffer.write(
+                " samples to syncronous data, starting at address ")
+            self.output_int(self.args[0])
+            self.output_buffer.write(".\n")
+
+    def _sync_range(self):
+        # The (start, end) sample range of SYNC READ/CRC, or None if invalid
+        start, count = self.args[:2]
+        if ((self.num_args == 2) and (start < firmware.SYNC_DATA_SIZE) and
+                (count <= firmware.SYNC_DATA_SIZE - start)):
+            return start, start + count
+        self._fail(ERR_INVALID_ADDR)
+        return None
+
+    def _sync_read(self):
+        r = self._sync_range()
+        if r is not None:
+            # Only as many samples as fit in the output buffer are returned
+            n = min(r[1] - r[0], (firmware.SER_BUFFER_SIZE
+                                  - self.output_buffer.available - 16) // 4)
+            n = max(n, 0)
+            self.output_buffer.write(">")
+            self.output_int(4 * n)
+            self.output_buffer.write(">")
+            self.output_buffer.write(
+                self.device.sync_data[r[0]:r[0] + n].tobytes())
+            self.output_eol()
+
+    def _sync_crc(self):
+        r = self._sync_range()
+        if r is not None:
+            crc = zlib.crc32(self.device.sync_data[r[0]:r[1]].tobytes())
+            self.output_buffer.write(">4>")
+            self.output_buffer.write(crc.to_bytes(4, 'little'))
+            self.output_eol()
+
+    def _ana_set(self, n):
+        if self.num_args == 0:
+            self._query("ANA%d SET" % n, self.device.ana_set[n])
+        elif self.num_args != 1:
+            self._fail(ERR_WRONG_NUM_ARGS1)
+        else:
+            self.device.ana_set[n] = self.args[0] & 0xFFFF
+            self.device.analog_update |= 1 << n
+            self.output_ok()
+
+    def _ana_scale(self, n):
+        if self.num_args == 0:
+            self._query("ANA%d SCALE" % n, self.device.ana_multiplier[n],
+                        self.device.ana_offset[n])
+        elif self.num_args != 2:
+            self._fail(ERR_WRONG_NUM_ARGS2)
+        else:
+            self.device.ana_multiplier[n] = self.args[0]
+            self.device.ana_offset[n] = self.args[1]
+            self.device.stage_settings()
+            self.output_ok()
+
+    def _sync_mode(self):
+        dev = self.device
+        if self.num_args == 0:
+            self.output_buffer.write("SYNC MODE ")
+            self.output_int(dev.analog_sync_mode)
+            self.output_buffer.write(" ")
+            self.output_int(dev.digital_sync_mode)
+            self.output_eol()
+        elif self.args[0] < 4:
+            dev.analog_sync_mode = self.args[0]
+            dev.digital_sync_mode = _int32(self.args[1])
+            dev.stage_settings()
+            self.output_ok()
+        else:
+            self._fail(ERR_INVALID_ARG)
+
+    def _sync_addr(self):
+        if self.num_args == 0:
+            self._query("SYNC ADDR", self.device.sync_start,
+                        self.device.sync_cycles)
+        elif ((self.num_args == 2) and
+                (self.args[0] < firmware.SYNC_DATA_SIZE) and
+                (self.args[1] < firmware.SYNC_DATA_SIZE)):
+            self.device.sync_start = self.args[0]
+            self.device.sync_cycles = self.args[1]
+            self.device.stage_settings()
+            self.output_ok()
+        else:
+            self._fail(ERR_INVALID_ADDR)
+
+    def _sync_swap(self):
+        # The output timing isn't modeled, so the end of the current cycle
+        #   has always passed by the time of the next command; changes are
+        #   never left pending.
+        if self.num_args == 0:
+            self._query("SYNC SWAP", 0)
+        elif ((self.num_args == 2) and
+                (self.args[0] < firmware.SYNC_DATA_SIZE) and
+                (self.args[1] < firmware.SYNC_DATA_SIZE)):
+            self.device.sync_start = self.args[0]
+            self.device.sync_cycles = self.args[1]
+            self.device.settings_hold = 0
+            self.device.latch_settings()
+            self.output_ok()
+        else:
+            self._fail(ERR_INVALID_ADDR)
+
+    def _sync_cache(self, on=None):
+        # Pre-rendering only changes the timing, which isn't modeled, so
+        #   the cache is ready as soon as it is enabled.
+        if on is None:
+            self._query("SYNC CACHE", self.device.cache_enabled,
+                        self.device.cache_ready)
+        else:
+            self.device.cache_enabled = on
+            self.output_ok()
+
+    def _sync_dma(self):
+        dev = self.device
+        if self.num_args == 0:
+            self._query("SYNC DMA", *dev.dma, dev.dma_auto)
+        elif self.num_args == 2:
+            dma = tuple(_int32(x) for x in self.args[:2])
+            if firmware.dma_valid(*dma):
+                dev.dma = dma
+                dev.dma_auto = 0
+                self.output_ok()
+            else:
+                self._fail(ERR_INVALID_ARG)
+        else:
+            self._fail(ERR_WRONG_NUM_ARGS2)
+
+    def _sync_dma_auto(self):
+        self.device.dma_auto = 1
+        self.device.update_dma_auto()
+        self.output_ok()
+
+    def _sync_stage(self):
+        self.device.settings_hold = 1
+        self.output_ok()
+
+    def _sync_commit(self):
+        self.device.settings_hold = 0
+        self.device.latch_settings()
+        self.output_ok()
+
+    def _sync_start(self):
+        self.device.start()
+        self.output_ok()
+
+    def _sync_stop(self):
+        self.device.stop()
+        self.output_ok()
+
+    def _sync_count(self):
+        self._query("SYNC COUNT", self.device.cycle_count)
+
+    def _sync_active(self):
+        self._query("SYNC ACTIVE", self.device.sync_active)
+
+    def _sync_dump(self):
+        dev = self.device
+        state = np.zeros((), dtype=firmware.SYNC_STATE)
+        state['sync_start'] = dev.sync_start
+        state['sync_cycles'] = dev.sync_cycles
+        state['sync_rate'] = dev.rate
+        state['ana_multiplier'] = [x & 0xFFFFFFFF for x in dev.ana_multiplier]
+        state['ana_offset'] = [x & 0xFFFFFFFF for x in dev.ana_offset]
+        state['trigger_mask'] = dev.trigger_mask & 0xFFFFFFFF
+        state['trigger_count'] = dev.trigger_count
+        # The output timing isn't modeled; these match SYNC STAT
+        state['last_bytes_written'] = dev.dma[1] // 2 * 8
+        state['ana_set'] = dev.ana_set
+        buffers = [dev.ser[n].input if i % 2 == 0 else dev.ser[n].output
+                   for i, n in enumerate((1, 1, 2, 2))]
+        state['ser_fill'] = [buf.available for buf in buffers]
+        state['analog_sync_mode'] = dev.analog_sync_mode
+        state['digital_sync_mode'] = dev.digital_sync_mode & 0xFF
+        state['sync_active'] = dev.sync_active
+        state['led'] = dev.led
+        state['ser_overflow'] = sum(bool(buf.overflow) << i
+                                    for i, buf in enumerate(buffers))
+        state['cache'] = dev.cache_enabled + (dev.cache_ready << 1)
+        state['dma_buf_count'], state['dma_buf_len'] = dev.dma
+        state['dma_auto'] = dev.dma_auto
+        state['cycle_count'] = dev.cycle_count & 0xFFFFFFFF
+        running, entry = dev.trigger_prog_status()
+        state['trigger_prog'] = running + (dev.trigger_at_pending << 1)
+
+        self.output_buffer.write(">")
+        self.output_int(state.nbytes)
+        self.output_buffer.write(">")
+        self.output_buffer.write(state.tobytes())
+        self.output_eol()
+
+    def _sync_perf(self):
+        # The timing isn't modeled, so the histograms are always empty
+        dev = self.device
+        perf = np.zeros((), dtype=firmware.SYNC_PERF)
+        t = dev.clock()
+        perf['interval'] = min(int((t - dev.perf_start) * 1E6), 0xFFFFFFFF)
+        dev.perf_start = t
+        buffers = [dev.ser[1].input, dev.ser[1].output, dev.ser[2].input,
+                   dev.ser[2].output, self.output_buffer]
+        perf['ser_dropped'] = [buf.dropped for buf in buffers]
+
+        self.output_buffer.write(">")
+        self.output_int(perf.nbytes)
+        self.output_buffer.write(">")
+        self.output_buffer.write(perf.tobytes())
+        self.output_eol()
+
+    def _sync_rate(self):
+        if self.num_args == 0:
+            self.output_buffer.write("SYNC RATE = ")
+            self.output_float(self.device.rate)
+            self.output_buffer.write(" Hz\n")
+        elif self.num_args in (1, 2):
+            freq = np.float32(self.args[0])
+            if self.num_args == 2:
+                freq = np.float32(float(freq) + 1E-3 * self.args[1])
+
+            if (freq < firmware.MIN_FREQ) or (freq > firmware.MAX_FREQ):
+                self._fail(ERR_INVALID_FREQ)
+            else:
+                self.device.restart_cycle_count()
+                self.device.rate = firmware.sync_freq(freq)
+                self.device.update_dma_auto()
+                self.output_buffer.write("SYNC RATE = ")
+                self.output_float(self.device.rate)
+                self.output_buffer.write(" Hz\n")
+        else:
+            self._fail(ERR_WRONG_NUM_ARGS2)
+
+    def _trigger_mask(self):
+        if self.num_args == 0:
+            self._query("TRIGGER MASK", self.device.trigger_mask)
+        elif self.num_args == 1:
+            self.device.trigger_mask = self.args[0]
+            self.device.stage_settings()
+            self.output_ok()
+        else:
+            self._fail(ERR_WRONG_NUM_ARGS1)
+
+    def _trigger(self):
+        if self.num_args <= 1:
+            if self.num_args == 0:
+                self.device.trigger_count = 1
+            else:
+                self.device.trigger_count = _int32(self.args[0])
+            self.output_ok()
+        else:
+            self._fail(ERR_WRONG_NUM_ARGS1)
+
+    def _trigger_prog(self):
+        if self.bin_data_written % firmware.TRIGGER_ENTRY.itemsize:
+            self._fail(ERR_INVALID_BIN_DATA_LEN)
+        else:
+            dev = self.device
+            dev.trigger_prog_len = \
+                self.bin_data_written // firmware.TRIGGER_ENTRY.itemsize
+            self._query("TRIGGER PROG", dev.trigger_prog_len)
+
+    def _trigger_start(self):
+        self.device.trigger_prog_run = self.device.next_boundary()
+        self.output_ok()
+
+    def _trigger_stop(self):
+        dev = self.device
+        dev.stop_trigger_prog()
+        dev.trigger_at = None
+        dev.trigger_count = 0
+        self.output_ok()
+
+    def _trigger_stat(self):
+        dev = self.device
+        self._query("TRIGGER STAT", *dev.trigger_prog_status(),
+                    dev.trigger_prog_len, dev.trigger_at_pending,
+                    dev.trigger_remaining())
+
+    def _trigger_at(self):
+        if self.num_args in (1, 2):
+            count = self.args[1] if self.num_args == 2 else 1
+            self.device.trigger_at = (self.args[0], count,
+                                      self.device.next_boundary())
+            self.output_ok()
+        else:
+            self._fail(ERR_WRONG_NUM_ARGS2)
+
+    def _bluetooth(self):
+        name = bytes(self.device.bt_buffer[:self.bin_data_written])
+        self.device.bt_name = name
+        if name:
+            self.output_buffer.write("Bluetooth enabled with name: ")
+            self.output_buffer.write(name)
+            self.output_eol()
+        else:
+            self.output_buffer.write("Bluetooth disabled.\n")
+
+    def _bin_start(self):
+        # Select the target for binary data; called when the second ">" is
+        #   received.
+        dev = self.device
+        self.cycle = READ_BIN
+        if self.error:
+            self.bin_target = TARGET_NONE
+        elif self.command == cmd_code("SER1", "WRITE"):
+            self.bin_target = TARGET_SERIAL1
+        elif self.command == cmd_code("SER2", "WRITE"):
+            self.bin_target = TARGET_SERIAL2
+        elif self.command == cmd_code("SYNC", "WRITE"):
+            if (self.num_args == 1) and \
+                    (self.args[0] < firmware.SYNC_DATA_SIZE):
+                self.bin_target = TARGET_SYNC_DATA
+                self.sync_ptr = self.args[0] * 4
+            else:
+                self.bin_target = TARGET_NONE
+                self.error = ERR_INVALID_ADDR
+        elif self.command == cmd_code("SYNC", "PACK"):
+            if (self.num_args == 1) and \
+                    (self.args[0] < firmware.SYNC_DATA_SIZE):
+                self.bin_target = TARGET_SYNC_PACKED
+                self.unpacker.start(dev.sync_data[self.args[0]:])
+            else:
+                self.bin_target = TARGET_NONE
+                self.error = ERR_INVALID_ADDR
+        elif self.command == cmd_code("BLUETOOTH"):
+            self.bin_target = TARGET_BT_NAME
+        elif self.command == cmd_code("TRIGGER", "PROG"):
+            if self.bin_data_len <= len(dev.trigger_prog_bytes):
+                # The running program (if any) is stopped before it is
+                #   overwritten
+                dev.stop_trigger_prog()
+                self.bin_target = TARGET_TRIGGER_PROG
+            else:
+                self.bin_target = TARGET_NONE
+                self.error = ERR_INVALID_BIN_DATA_LEN
+        else:
+            self.cycle = CMD_ERROR
+            self.error = ERR_EXTRA_BIN_DATA
+
+    def _unpack(self, data):
+        self.unpacker.write(data)
+        if self.unpacker.state > pack.PACK_DONE:
+            if self.unpacker.state == pack.PACK_OVERFLOW:
+                self.error = ERR_INVALID_ADDR
+            else:
+                self.error = ERR_INVALID_PACKED_DATA
+            self.bin_target = TARGET_NONE
+
+    def process_char(self, c):
+        if isinstance(c, (bytes, str)):
+            c = ord(c)
+
+        # Handle binary read first, as this may be called many times
+        if self.cycle == READ_BIN:
+            dev = self.device
+            if self.bin_target == TARGET_SYNC_DATA:
+                if self.sync_ptr >= len(dev.sync_bytes):
+                    self.error = ERR_INVALID_ADDR
+                    self.bin_target = TARGET_NONE
+                else:
+                    dev.sync_bytes[self.sync_ptr] = c
+                    self.sync_ptr += 1
+            elif self.bin_target == TARGET_SYNC_PACKED:
+                self._unpack(bytes((c, )))
+            elif self.bin_target == TARGET_TRIGGER_PROG:
+                dev.trigger_prog_bytes[self.bin_data_written] = c
+            elif self.bin_target == TARGET_SERIAL1:
+                dev.ser[1].output.write(c)
+            elif self.bin_target == TARGET_SERIAL2:
+                dev.ser[2].output.write(c)
+            elif self.bin_target == TARGET_BT_NAME:
+                if self.bin_data_written >= firmware.BT_NAME_MAX_LENGTH:
+                    self.error = ERR_BT_NAME_TOO_LONG
+                    self.bin_target = TARGET_NONE
+                else:
+                    dev.bt_buffer[self.bin_data_written] = c
+
+            self.bin_data_written += 1
+            if self.bin_data_written >= self.bin_data_len:
+                self.cycle = IDLE
+
+            return
+
+        ct = char_type(c)
+
+        # Are we reading a binary length?  In this case, don't process
+        #  normally, just accept digits and whitespace.
+        if self.cycle == READ_BIN_LEN:
+            if ct == DIGIT:
+                self.bin_data_len = self.bin_data_len * 10 + (c - 48)
+            elif ct == BINSTART:
+                self._bin_start()
+            else:
+                self.cycle = CMD_ERROR
+                self.error = ERR_INVALID_BIN_DATA_LEN
+
+            return
+
+        if ct == EOL:
+            self.execute_command()
+            return
+        elif ct == BINSTART:
+            self.bin_data_len = 0
+            self.cycle = READ_BIN_LEN
+            return
+        else:
+            # If idle, determine how to process the character based on what
+            #   it is.
+            if self.cycle == IDLE:
+                if ct == DIGIT:
+                    self.cycle = READ_INT
+                    if self.num_args < len(self.args):
+                        self.args[self.num_args] = 0
+                    self.num_args += 1
+                elif ct == ALPHA:
+                    self.cycle = READ_WORD
+                    self.word_i = 0
+                    self.word = 0
+                elif ct == WHITESPACE:
+                    return
+
+            if self.cycle == READ_WORD:
+                if ct == WHITESPACE:
+                    self.finish_word()
+                else:
+                    if (c >= 97) and (c <= 122):
+                        c -= 32 # Capitalize
+                    if self.word_i < 4:
+                        self.word = ((self.word << 8) + c) & 0xFFFFFFFF
+                    self.word_i += 1
+            elif self.cycle == READ_INT:
+                if ct == WHITESPACE:
+                    self.cycle = IDLE
+                elif ct == DIGIT:
+                    if self.num_args <= MAX_CMD_INTS:
+                        i = self.num_args - 1
+                        self.args[i] = \
+                            (self.args[i] * 10 + (c - 48)) & 0xFFFFFFFF
+                    else:
+                        self.cycle = CMD_ERROR
+                        self.error = ERR_TOO_MANY_ARGS
+                else:
+                    self.cycle = CMD_ERROR
+                    self.error = ERR_MALFORMED_ARG
+
+    def process(self, data, start=0):
+        '''
+        Process characters from `data`, beginning at index `start`.  Stops
+        after the end of the data or after the first command which outputs
+        something, whichever comes first.
+
+        Returns
+        -------
+        end : int
+            The index of the first unprocessed character.
+        '''
+        i = start
+        n = len(data)
+        while i < n:
+            if (self.cycle == READ_BIN) and \
+                    (self.bin_target == TARGET_SYNC_DATA) and \
+                    (self.sync_ptr < len(self.device.sync_bytes)):
+                # Fast path for writing sync data; equivalent to calling
+                #   process_char on each byte.  (A byte past the end of the
+                #   memory is left to process_char, which flags the error.)
+                sync_bytes = self.device.sync_bytes
+                m = min(n - i, self.bin_data_len - self.bin_data_written,
+                        len(sync_bytes) - self.sync_ptr)
+                sync_bytes[self.sync_ptr:self.sync_ptr+m] = \
+                    np.frombuffer(data, 'u1', m, i)
+                self.sync_ptr += m
+                self.bin_data_written += m
+                i += m
+                if self.bin_data_written >= self.bin_data_len:
+                    self.cycle = IDLE
+                continue
+
+            if (self.cycle == READ_BIN) and \
+                    (self.bin_target == TARGET_SYNC_PACKED):
+                # Same for packed data
+                m = min(n - i, self.bin_data_len - self.bin_data_written)
+                self._unpack(data[i:i+m])
+                self.bin_data_written += m
+                i += m
+                if self.bin_data_written >= self.bin_data_len:
+                    self.cycle = IDLE
+                continue
+
+            c = data[i]
+            i += 1
+            self.process_char(c)
+            if self.output_buffer.available:
+                break
+
+        return i
+
+
+class Emulator:
+    '''
+    An emulated synchronizer board.  The device state mirrors the global
+    variables in the firmware.
+
+    Keywords
+    --------
+    loopback : bool (default: False)
+        If True, the tunneled serial ports are connected TX -> RX.
+    clock : function (default: time.monotonic)
+        Returns the current time on the device, in seconds.  (The "emu://"
+        connections replace this with their virtual clock.)
+    '''
+    # Named instances, shared between emu:// connections
+    instances = {}
+
+    def __init__(self, loopback=False, clock=time.monotonic):
+        self.loopback = loopback
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.reset(boot_message=False)
+
+    @classmethod
+    def get(cls, name, **kwargs):
+        "Return a named emulator instance, creating it if needed."
+        if name not in cls.instances:
+            cls.instances[name] = cls(**kwargs)
+        return cls.instances[name]
+
+    def reset(self, boot_message=True):
+        "Reset the device to its power on state."
+        with self.lock:
+            self.sync_data = np.zeros(firmware.SYNC_DATA_SIZE, dtype='<u4')
+            self.sync_bytes = self.sync_data.view('u1')
+            self.sync_start = 0
+            self.sync_cycles = 1024
+            self.sync_active = 0
+            self.analog_sync_mode = 1
+            self.digital_sync_mode = 0
+            self.analog_update = 0
+            self.ana_set = [1 << 15, 1 << 15]
+            self.ana_multiplier = [1 << 16, 1 << 16]
+            self.ana_offset = [0, 0]
+            self.trigger_count = 0
+            self.trigger_mask = 0
+            self.led = (0, 0, 0)
+            self.bt_name = b''
+            self.bt_buffer = bytearray(firmware.BT_NAME_MAX_LENGTH + 1)
+            self.rate = firmware.sync_freq(102400.0)
+            self.ser = {n: TunnelPort(self.loopback) for n in (1, 2)}
+            self.commands = CommandQueue(self)
+            self.settings_hold = 0
+            self.cache_enabled = 0
+            self.dma_auto = 1
+            self.dma = firmware.dma_auto(self.rate)
+            self.perf_start = self.clock()
+            self.cycle_base = 0
+            self.cycle_t0 = None
+            self.trigger_prog = np.zeros(firmware.TRIGGER_PROG_SIZE,
+                                         dtype=firmware.TRIGGER_ENTRY)
+            self.trigger_prog_bytes = self.trigger_prog.view('u1')
+            self.trigger_prog_len = 0
+            self.trigger_prog_run = None
+            self.trigger_prog_entry = 0
+            self.trigger_at = None
+            self.output = {}
+            self.latch_settings()
+
+            if boot_message:
+                self.commands.output_buffer.write(
+                    "I2S driver installed succesfully.\n"
+                    "Output task running on CPU core 0\n"
+                )
+
+    # The output cycles aren't rendered as time passes, so the cycle counter
+    #   (and the trigger program) are computed from the time since SYNC START,
+    #   as if the output never underruns.
+    @property
+    def cycle_count(self):
+        "The number of the current output cycle (`SYNC COUNT`)."
+        if self.cycle_t0 is None:
+            return self.cycle_base
+        period = firmware._period(self.output['sync_cycles'])
+        elapsed = self.clock() - self.cycle_t0
+        return self.cycle_base + int(elapsed * float(self.rate) / period)
+
+    def restart_cycle_count(self):
+        "Called before the cycle period changes, so the count is continuous."
+        if self.cycle_t0 is not None:
+            self.cycle_base = self.cycle_count
+            self.cycle_t0 = self.clock()
+
+    def start(self):
+        "Start the output (`SYNC START`)."
+        if not self.sync_active:
+            # The first cycle gets a new number
+            self.cycle_base = self.cycle_count + 1
+            self.cycle_t0 = self.clock()
+        self.sync_active = 1
+
+    def stop(self):
+        "Stop the output (`SYNC STOP`)."
+        self.cycle_base = self.cycle_count
+        self.cycle_t0 = None
+        self.sync_active = 0
+
+    def next_boundary(self):
+        '''
+        The number of the first cycle which can be triggered by a command
+        received now: the next one, or if the output is stopped, the second
+        one after it is started.
+        '''
+        return self.cycle_count + (1 if self.sync_active else 2)
+
+    def trigger_prog_status(self):
+        '''
+        Returns
+        -------
+        running : int
+            1 if the trigger program has entries which haven't triggered yet.
+        entry : int
+            The number of entries which have triggered.
+        '''
+        if self.trigger_prog_run is None:
+            return 0, self.trigger_prog_entry
+        entry = int(np.sum(self._trigger_prog_cycles() <= self.cycle_count))
+        return int(entry < self.trigger_prog_len), entry
+
+    def _trigger_prog_cycles(self):
+        # The cycle at which each entry of the running program triggers
+        prog = self.trigger_prog[:self.trigger_prog_len]
+        ends = self.trigger_prog_run + np.cumsum(
+            prog['delay'].astype('u8') + prog['count'])
+        return ends - prog['count']
+
+    def trigger_remaining(self):
+        '''
+        The number of cycles still to be triggered by the trigger program or
+        `TRIGGER AT`, after the current one.  (Counts set by `TRIGGER` are
+        not included, since the emulator doesn't count them down.)
+        '''
+        cycle = self.cycle_count
+        bursts = []
+        if self.trigger_prog_run is not None:
+            counts = self.trigger_prog['count'][:self.trigger_prog_len]
+            bursts += zip(self._trigger_prog_cycles(), counts)
+        if self.trigger_at is not None:
+            at, count, first = self.trigger_at
+            bursts.append((max(at, first), count))
+
+        # The last burst to start replaces any before it
+        started = [(int(c), int(n)) for c, n in bursts if c <= cycle]
+        if not started:
+            return 0
+        c, n = max(started)
+        return max(0, c + n - 1 - cycle)
+
+    def stop_trigger_prog(self):
+        "Stop the trigger program, keeping the number of entries triggered."
+        self.trigger_prog_entry = self.trigger_prog_status()[1]
+        self.trigger_prog_run = None
+
+    @property
+    def trigger_at_pending(self):
+        "Is a `TRIGGER AT` still waiting for its cycle?"
+        if self.trigger_at is None:
+            return 0
+        cycle, count, first = self.trigger_at
+        return int(self.cycle_count < max(cycle, first))
+
+    def update_dma_auto(self):
+        "Called after the rate changes, to pick the DMA buffers in auto mode."
+        if self.dma_auto:
+            self.dma = firmware.dma_auto(self.rate)
+
+    def stage_settings(self):
+        "Called after an output setting is changed (see `latch_settings`)."
+        if not self.settings_hold:
+            self.latch_settings()
+
+    def latch_settings(self):
+        '''
+        Copy the output settings into `output`, which is used by `render`.
+        (The firmware does this at the end of an output cycle, but the
+        output timing isn't modeled, so here it happens immediately.)  While
+        the settings are held (`SYNC STAGE`), nothing is latched.
+        '''
+        if self.settings_hold:
+            return
+        if self.output:
+            self.restart_cycle_count()
+        if self.analog_sync_mode != self.output.get('analog_sync_mode'):
+            self.analog_update |= (~self.analog_sync_mode) & 0b11
+        self.output = dict(
+            sync_start=self.sync_start, sync_cycles=self.sync_cycles,
+            analog_sync_mode=self.analog_sync_mode,
+            digital_sync_mode=self.digital_sync_mode,
+            scales=tuple(zip(self.ana_multiplier, self.ana_offset)),
+            trigger_mask=self.trigger_mask,
+        )
+
+    @property
+    def cache_ready(self):
+        "Would the firmware use the pre-rendered output (`SYNC CACHE`)?"
+        cycles = self.output['sync_cycles'] % firmware.SYNC_DATA_SIZE
+        return int(bool(self.cache_enabled) and
+                   0 < cycles <= firmware.SYNC_CACHE_SIZE)
+
+    def render(self, samples=None, trigger_schedule=None, decode=False):
+        '''
+        Compute the sync output for the current device state; see
+        `ad_sync.firmware.render` for details.  Settings which are staged
+        but not yet committed are not included.
+        '''
+        with self.lock:
+            out = self.output
+            return firmware.render(
+                self.sync_data, out['sync_start'], out['sync_cycles'],
+                modes=(out['analog_sync_mode'], out['digital_sync_mode']),
+                scales=out['scales'], trigger_schedule=trigger_schedule,
+                trigger_mask=out['trigger_mask'], samples=samples,
+                ana_set=tuple(self.ana_set), decode=decode
+            )
+
+    def process(self, data, start=0):
+        '''
+        Process serial input from the host.  See `CommandQueue.process`.
+
+        Returns
+        -------
+        end : int
+            The index of the first unprocessed character in `data`.
+        output : bytes
+            Output sent back to the host by the last command processed.
+        '''
+        with self.lock:
+            end = self.commands.process(data, start)
+            for port in self.ser.values():
+                port.update()
+            return end, self.commands.output_buffer.read()
+
+
+class Serial(SerialBase):
+    '''
+    A pyserial compatible connection to an emulated device, which
+    implements the "emu://" URL handler.  (See the module documentation.)
+
+    Reads and writes never block.  Instead, the arrival time of each byte on
+    either side of the link is computed, and `clock` tracks the time as seen
+    by the host.  Reading data which has not yet arrived advances the clock;
+    if no data will arrive, the read returns early and the clock is advanced
+    by the timeout.  The device sees each command at the time it arrives.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.emulator = None
+        self.latency = 0.0005
+        self.clock = 0.0
+        self._device_time = 0.0
+        super().__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        if self._port is None:
+            raise SerialException(
+                "Port must be configured before it can be used.")
+
+        self.from_url(self.port)
+        self._tx_free = self.clock
+        self._rx_free = self.clock
+        # Received data: (byte string, arrival time of the first byte)
+        self._rx = collections.deque()
+        self.is_open = True
+
+    def from_url(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "emu":
+            raise SerialException(
+                'expected a string in the form "emu://[name][?options]": '
+                'not starting with emu:// ({!r})'.format(parts.scheme))
+
+        options = urllib.parse.parse_qs(parts.query, True)
+        loopback = 'loopback' in options
+        if 'latency' in options:
+            self.latency = float(options['latency'][0])
+
+        if parts.netloc:
+            self.emulator = Emulator.get(parts.netloc, loopback=loopback,
+                                         clock=self._device_clock)
+        else:
+            self.emulator = Emulator(loopback=loopback,
+                                     clock=self._device_clock)
+
+        # A shared device keeps its time from the previous connection
+        self.clock = self._device_time = self.emulator.clock()
+        self.emulator.clock = self._device_clock
+
+    def _device_clock(self):
+        # The time on the device: when the command being processed arrived,
+        #   or if the host has waited since then, the host's time
+        return max(self.clock, self._device_time)
+
+    def advance(self, seconds):
+        "Advance the clock, in place of sleeping."
+        self.clock += seconds
+
+    def _reconfigure_port(self):
+        pass
+
+    @property
+    def byte_time(self):
+        "Time to transfer one byte (8N1 -> 10 bits) over the link."
+        return 10.0 / self._baudrate
+
+    def _receive(self, data, t):
+        # Queue data sent by the device at (device) time t
+        if data:
+            t0 = max(t + self.latency, self._rx_free) + self.byte_time
+            self._rx.append((bytes(data), t0))
+            self._rx_free = t0 + (len(data) - 1) * self.byte_time
+
+    def _arrived(self):
+        # Number of received bytes which have arrived at the current time
+        n = 0
+        for data, t0 in self._rx:
+            if t0 > self.clock:
+                break
+            n += min(len(data), int((self.clock - t0) / self.byte_time) + 1)
+        return n
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        return self._arrived()
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+        data = bytearray()
+        while size > 0 and self._rx:
+            chunk, t0 = self._rx[0]
+            n = min(size, len(chunk))
+            data += chunk[:n]
+            self.clock = max(self.clock, t0 + (n - 1) * self.byte_time)
+            if n == len(chunk):
+                self._rx.popleft()
+            else:
+                self._rx[0] = (chunk[n:], t0 + n * self.byte_time)
+            size -= n
+
+        if size > 0 and self._timeout:
+            # The rest of the data will never come!
+            self.clock += self._timeout
+
+        return bytes(data)
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+        data = bytes(data)
+        start = max(self.clock, self._tx_free)
+        self._tx_free = start + len(data) * self.byte_time
+        # Time (on the device) at which byte i has been received
+        arrival = lambda i: start + self.latency + (i + 1) * self.byte_time
+
+        i = 0
+        while i < len(data):
+            self._device_time = arrival(i)
+            i, output = self.emulator.process(data, i)
+            self._receive(output, arrival(i - 1))
+
+        return len(data)
+
+    def flush(self):
+        self.clock = max(self.clock, self._tx_free)
+
+    def reset_input_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        n = self._arrived()
+        while n and self._rx:
+            chunk, t0 = self._rx.popleft()
+            if n < len(chunk):
+                self._rx.appendleft((chunk[n:], t0 + n * self.byte_time))
+            n -= min(n, len(chunk))
+
+    def reset_output_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def _update_break_state(self):
+        pass
+
+    def _update_rts_state(self):
+        # RTS is connected to the reset pin of the microcontroller
+        if self.is_open and self._rts_state:
+            self.emulator.reset()
+            # Anything still in flight is lost, and the host has to wait for
+            #   the reboot anyway, so the boot message has arrived in full.
+            self._rx.clear()
+            self._rx_free = self.clock
+            banner = self.emulator.commands.output_buffer.read()
+            self._rx_free -= (len(banner) + 1) * self.byte_time
+            self._receive(banner, self._rx_free - self.latency)
+
+    def _update_dtr_state(self):
+        pass
+
+    @property
+    def cts(self):
+        return self._rts_state
+
+    @property
+    def dsr(self):
+        return self._dtr_state
+
+    @property
+    def ri(self):
+        return False
+
+    @property
+    def cd(self):
+        return True
+
+
+def serve_pty(emulator=None):
+    '''
+    Serve an emulated device on a pseudo terminal (Unix only).  The device
+    is run in a background (daemon) thread, in real time.
+
+    Keywords
+    --------
+    emulator : Emulator (default: new instance)
+        The device to serve.
+
+    Returns
+    -------
+    port : str
+        The device name of the pseudo terminal, which can be opened as a
+        regular serial port.
+    '''
+    import os
+    import tty
+
+    if emulator is None:
+        emulator = Emulator()
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+
+    def run():
+        while True:
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                return
+            i = 0
+            while i < len(data):
+                i, output = emulator.process(data, i)
+                if output:
+                    os.write(master, output)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    return port
+
+
+if __name__ == "__main__":
+    port = serve_pty()
+    print(f"Emulated synchronizer running on {port} (ctrl-C to quit)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,425 @@
+"""
+Python mirrors of the constants and numerical routines in the firmware.
+
+Everything here should be kept consistent with the C++ code in
+`firmware/include` and `firmware/src`; where the firmware does single
+precision math, it is replicated exactly with numpy float32 operations.
+"""
+
+import numpy as np
+
+# firmware/include/main.h
+VERSION_MAJOR = 1
+VERSION_MINOR = 11
+SER_BUFFER_SIZE = 1024
+SYNC_DATA_SIZE = 16384
+I2S_WRITE_BUFFER_SIZE = 64
+I2S_BIT_DEPTH = 24
+MIN_FREQ = 30
+MAX_FREQ = 700000
+BT_NAME_MAX_LENGTH = 256
+SYNC_CACHE_SIZE = 2048
+DMA_BUF_COUNT_MIN = 2
+DMA_BUF_COUNT_MAX = 32
+DMA_BUF_LEN_MIN = 16
+DMA_BUF_LEN_MAX = 1024
+DMA_SAMPLES_MAX = 4096
+DMA_AUTO_TIME_US = 5000
+TRIGGER_PROG_SIZE = 256
+
+# firmware/include/perf.h
+PERF_BINS = 20
+
+# firmware/include/sync.h
+DAC_SPI_CH0 = 0b011000 << 16
+DAC_SPI_CH1 = 0b011001 << 16
+DAC_SHIFT = 8
+
+APLL_MIN = 350000000
+APLL_MAX = 560000000
+APLL_XTAL = 40000000
+
+APLL_DIV = (
+    ( 0,  2,  2), ( 1,  2,  2), ( 2,  2,  2), ( 4,  2,  2), ( 6,  2,  2),
+    ( 5,  3,  2), (12,  2,  2), ( 3,  5,  3), ( 5,  7,  2), (30,  2,  2),
+    (26,  3,  2), (20,  5,  2), (30,  3,  3), (23,  5,  3), ( 2, 61,  2),
+    ( 4, 53,  2), (21, 18,  2), (20,  7,  7), (25, 26,  2), (27, 21,  3),
+    (31, 36,  2), (24, 17,  7), (23, 23,  7), (26, 17, 11), (21, 37,  8),
+    (21, 55,  7), ( 5, 47, 35), (29, 23, 21), (31, 59, 10), (29, 43, 19),
+    (30, 49, 21), (25, 61, 26), (30, 60, 29), (29, 57, 41), (27, 58, 56),
+    (31, 63, 63)
+)
+
+# firmware/include/commands.h: command words, in the same order as the
+#   CMD_NAMES enum
+CMD_NAMES = (
+    "", "SYNC", "READ", "WRITE", "ADDR", "START", "STOP", "COUNT", "RATE",
+    "ANA0", "ANA1", "SER1", "SER2", "TRIGGER", "MASK", "AVAIL", "FLUSH",
+    "LED", "ON", "OFF", "STAT", "SET", "SCALE", "MODE", "*IDN", "BLUETOOTH",
+    "PACK", "ACTIVE", "DUMP", "CRC", "SWAP", "STAGE", "COMMIT", "CACHE",
+    "DMA", "AUTO", "PERF", "PROG", "AT",
+)
+
+# firmware/include/commands.h: the reply to SYNC DUMP
+SYNC_STATE = np.dtype([
+    ('sync_start', '<u4'),
+    ('sync_cycles', '<u4'),
+    ('sync_rate', '<f4'),
+    ('ana_multiplier', '<u4', 2),
+    ('ana_offset', '<u4', 2),
+    ('trigger_mask', '<u4'),
+    ('trigger_count', '<i4'),
+    ('buffer_update_time', '<u4'),
+    ('last_update_age', '<u4'),
+    ('last_bytes_written', '<u4'),
+    ('ana_set', '<u2', 2),
+    ('ser_fill', '<u2', 4),
+    ('analog_sync_mode', 'u1'),
+    ('digital_sync_mode', 'u1'),
+    ('sync_active', 'u1'),
+    ('led', 'u1', 3),
+    ('ser_overflow', 'u1'),
+    ('settings_pending', 'u1'),
+    ('buffer_update_time_max', '<u4'),
+    ('cache', 'u1'),
+    ('underruns', '<u4'),
+    ('dma_buf_count', '<u2'),
+    ('dma_buf_len', '<u2'),
+    ('dma_auto', 'u1'),
+    ('cycle_count', '<u4'),
+    ('trigger_prog', 'u1'),
+])
+
+# firmware/include/main.h: an entry of the trigger program (TRIGGER PROG)
+TRIGGER_ENTRY = np.dtype([
+    ('delay', '<u4'),
+    ('count', '<u4'),
+])
+
+# firmware/include/commands.h and perf.h: the reply to SYNC PERF
+PERF_HIST = np.dtype([
+    ('count', '<u4'),
+    ('min', '<u4'),
+    ('max', '<u4'),
+    ('total', '<u8'),
+    ('bins', '<u4', PERF_BINS),
+])
+
+SYNC_PERF = np.dtype([
+    ('interval', '<u4'),
+    ('underruns', '<u4'),
+    ('slowest_command', '<u4'),
+    ('buffer_update', PERF_HIST),
+    ('buffer_interval', PERF_HIST),
+    ('loop', PERF_HIST),
+    ('command', PERF_HIST),
+    ('ser_dropped', '<u4', 5),
+])
+
+# The shortest time (in us) counted by each bin of a PERF_HIST
+PERF_BIN_EDGES = np.array([0] + [1 << i for i in range(PERF_BINS - 1)])
+
+_f32 = np.float32
+
+# Computed in init_sync()
+APLL_DIV_MIN = [
+    _f32(APLL_MIN) / _f32(2 * (2 + odiv) * N * M) for (odiv, N, M) in APLL_DIV
+]
+
+
+def sync_freq(freq):
+    '''
+    Compute the actual sample rate the firmware will output for a requested
+    frequency.  This is an exact (float32) port of `sync_freq` in
+    `firmware/src/sync.cpp`.
+
+    Parameters
+    ----------
+    freq : float
+        The requested frequency in Hz.  (Note that the firmware converts
+        this to a float32 before calling `sync_freq`!)
+
+    Returns
+    -------
+    actual_freq : numpy.float32
+        The output rate in samples/s.
+    '''
+    freq = _f32(freq)
+    clock_freq = _f32(min(max(freq, _f32(MIN_FREQ)), _f32(MAX_FREQ)))
+    clock_freq = clock_freq * _f32(2) * _f32(I2S_BIT_DEPTH)
+
+    # Default to minimum frequency case.
+    odiv, N, M = 31, 63, 63
+    for i, div_min in enumerate(APLL_DIV_MIN):
+        if clock_freq > div_min:
+            odiv, N, M = APLL_DIV[i]
+            break
+
+    div_ratio = _f32(2 * (odiv + 2) * N * M)
+    mult = clock_freq * div_ratio / _f32(APLL_XTAL)
+    sdm = int(float((mult - _f32(4)) * _f32(1 << 16)) + 0.5) & 0xFFFFFFFF
+    sdm2 = (sdm >> 16) & 0xFF
+    sdm1 = (sdm >> 8) & 0xFF
+    sdm0 = sdm & 0xFF
+
+    # This part is done in double precision (the constants are doubles!)
+    actual_clk = _f32(
+        float(_f32(APLL_XTAL))
+        * (4.0 + float(sdm2) + float(sdm1) / 256.0 + float(sdm0) / 65536.0)
+        / float(div_ratio)
+    )
+
+    return actual_clk / _f32(48)
+
+
+def cmd_name(code):
+    '''
+    Convert a command code (as packed by the `CMD2`/`CMD3`/`CMD4` macros)
+    back into its words, e.g. `"SYNC WRITE"`.
+    '''
+    words = []
+    while code:
+        word = code & 0xFF
+        words.insert(0, CMD_NAMES[word] if word < len(CMD_NAMES) else '?')
+        code >>= 8
+    return ' '.join(words)
+
+
+def dma_valid(count, length):
+    '''
+    Check if a DMA buffer configuration is accepted by `SYNC DMA` (see
+    `set_dma` in `firmware/src/sync.cpp`).
+    '''
+    return (DMA_BUF_COUNT_MIN <= count <= DMA_BUF_COUNT_MAX
+            and DMA_BUF_LEN_MIN <= length <= DMA_BUF_LEN_MAX
+            and length % 2 == 0 and count * length <= DMA_SAMPLES_MAX)
+
+
+def dma_auto(rate):
+    '''
+    Compute the DMA buffers the firmware picks for an output rate in auto
+    mode (`update_dma_auto` in `firmware/src/sync.cpp`).
+
+    Parameters
+    ----------
+    rate : float
+        The actual output rate, as returned by `sync_freq`.
+
+    Returns
+    -------
+    count, length : int
+        The number of DMA buffers, and their length in samples.
+    '''
+    default = 4 * 2 * I2S_WRITE_BUFFER_SIZE
+    needed = _f32(float(rate) * (DMA_AUTO_TIME_US * 1E-6))
+    total = default
+    while total < needed and total < DMA_SAMPLES_MAX:
+        total *= 2
+    count = 8 if total > default else 4
+    return count, total // count
+
+
+def trigger_schedule(program, start=1):
+    '''
+    Compute which cycles are triggered by a trigger program (see
+    `schedule_triggers` in `firmware/src/sync.cpp`), for use with `render`.
+
+    Parameters
+    ----------
+    program : sequence of (delay, count)
+        The trigger program entries.  Each entry waits `delay` cycles, and
+        then triggers the next `count` cycles.
+
+    Keywords
+    --------
+    start : int (default: 1)
+        The index of the cycle from which the first delay is counted.  The
+        default is correct for a program started (`TRIGGER START`) before
+        the output, as the first cycle is never triggered.
+
+    Returns
+    -------
+    schedule : bool array
+        Whether or not each cycle is triggered, up to the end of the last
+        entry.
+    '''
+    program = np.asarray(program, dtype='u8').reshape(-1, 2)
+    # Each entry starts when the previous one ends
+    ends = start + np.cumsum(program.sum(axis=1))
+    schedule = np.zeros(int(ends[-1]) if len(ends) else start, dtype=bool)
+    for end, count in zip(ends, program[:, 1]):
+        schedule[int(end - count):int(end)] = True
+
+    return schedule
+
+
+def format_float(x):
+    '''
+    Format a number the way the firmware does (`CommandQueue::output_float`),
+    with 7 significant figures and the fractional part truncated.
+    '''
+    x = _f32(x)
+    ipart = int(x)
+    s = str(ipart)
+    dp = 7 - len(s)
+    if dp > 0:
+        frac = x - _f32(ipart)
+        for i in range(dp):
+            frac = frac * _f32(10)
+        s += '.' + str(int(frac)).rjust(dp, '0')
+
+    return s
+
+
+def _period(cycles):
+    # update_sync wraps when the address reaches (start + cycles), modulo the
+    #   memory size, so a count of 0 cycles through the entire memory.
+    return int(cycles) if (cycles % SYNC_DATA_SIZE) else SYNC_DATA_SIZE
+
+
+def _render_cycle(data, start, period, modes, scales, ana_set, trigger_mask,
+                  triggered):
+    # Compute one full cycle of I2S words, as in update_sync
+    analog_mode, digital_mode = modes
+    addr = (start + np.arange(period)) % SYNC_DATA_SIZE
+    d = data[addr].astype('u8')
+
+    if analog_mode == 0:
+        ad = np.full(period, DAC_SPI_CH0 + (int(ana_set[0]) & 0xFFFF),
+                     dtype='u8')
+    else:
+        if analog_mode == 3:
+            channel = addr % 2
+        else:
+            channel = np.full(period, analog_mode - 1)
+
+        ad = np.empty(period, dtype='u8')
+        for n, header in enumerate((DAC_SPI_CH0, DAC_SPI_CH1)):
+            mult, offset = (np.uint64(int(x) & 0xFFFFFFFF) for x in scales[n])
+            a = d[channel == n] & 0xFFFF
+            # The firmware does this with uint32 math, so wrap as needed
+            a = (((a * mult) & 0xFFFFFFFF) >> 16) + offset
+            ad[channel == n] = np.minimum(a & 0xFFFFFFFF, 65535) + header
+
+    dd = (d >> 16) & 0xFFFF
+    # If triggered, all channels output.
+    # If not, we need to zero the triggered channels
+    if not triggered:
+        dd &= ~np.uint64(int(trigger_mask) & 0xFFFF) & 0xFFFF
+
+    # Swap mode
+    if digital_mode & 0b10:
+        dd = ((dd & 0xFF00) >> 8) + ((dd & 0x00FF) << 8)
+
+    # OR output mode -- note that (like the firmware) this ORs in bits 8-15
+    #   of the *raw* sync data, which is the high byte of the analog sample!
+    if digital_mode & 0b01:
+        dd |= (d & 0xFF00) >> 8
+
+    return (dd << 40) + (ad << DAC_SHIFT)
+
+
+def render(sync_data, start=0, cycles=1024, modes=(1, 0),
+           scales=((1 << 16, 0), (1 << 16, 0)), trigger_schedule=None,
+           trigger_mask=0, samples=None, ana_set=(1 << 15, 1 << 15),
+           decode=False):
+    '''
+    Compute the output of the sync generator, bit for bit, as produced by
+    `update_sync` in `firmware/src/sync.cpp`.  The output starts with the
+    first sample after `SYNC START`.
+
+    Parameters
+    ----------
+    sync_data : uint32 array
+        The contents of the device sync memory.  If it is shorter than the
+        device memory (16384 samples), it is zero padded.
+
+    Keywords
+    --------
+    start : int (default: 0)
+        The first address of the output cycle (`SYNC ADDR`).
+    cycles : int (default: 1024)
+        The number of samples in the output cycle (`SYNC ADDR`).  Addresses
+        wrap around at the end of the memory.
+    modes : (int, int) (default: (1, 0))
+        The analog and digital modes (`SYNC MODE`)
+    scales : ((int, int), (int, int)) (default: ((65536, 0), (65536, 0))
+        The integer multiplier and offset of each analog channel, as sent by
+        `ANA[0/1] SCALE`.
+    trigger_schedule : None, int, or array of bool (default: None)
+        Which output cycles are triggered.  If None, no cycles are triggered.
+        If an int is specified, this is the number of triggered cycles from
+        a `TRIGGER` command sent before the output was started.  (Note that
+        the first cycle is never triggered in this case, as the trigger starts
+        at the end of the current cycle.)  If an array, this indicates
+        whether or not each cycle is triggered.
+    trigger_mask : int (default: 0)
+        The trigger mask (`TRIGGER MASK`)
+    samples : int (default: all cycles in trigger_schedule, or else 1 cycle)
+        The number of output samples to compute.
+    ana_set : (int, int) (default: (32768, 32768))
+        The values set by `ANA[0/1] SET`.  These are used for fixed analog
+        outputs, and are taken to be the initial state of the DACs when
+        decoding.
+    decode : bool (default: False)
+        If True, decode the output into the digital and analog outputs of
+        the board, rather than returning the raw I2S words.
+
+    Returns
+    -------
+    words : uint64 array (if decode=False)
+        The I2S words in the order they are written to the DMA buffer.
+    digital, analog : uint16 arrays (if decode=True)
+        The digital outputs (shape `(samples, )`) and the value of each DAC
+        channel after each sample (shape `(2, samples)`).
+
+    Note that the one-off DAC updates which happen when a fixed analog value
+    is changed (and the DAC setup sequence after boot) are not modeled.
+    '''
+    data = np.zeros(SYNC_DATA_SIZE, dtype='u4')
+    sync_data = np.asarray(sync_data, dtype='u4')[:SYNC_DATA_SIZE]
+    data[:len(sync_data)] = sync_data
+
+    period = _period(cycles)
+
+    if trigger_schedule is None:
+        trigger_schedule = np.zeros(1, dtype=bool)
+    elif np.ndim(trigger_schedule) == 0:
+        count = int(trigger_schedule)
+        trigger_schedule = np.arange(count + 1) > 0
+    else:
+        trigger_schedule = np.asarray(trigger_schedule, dtype=bool)
+
+    if samples is None:
+        samples = len(trigger_schedule) * period
+
+    # Every cycle is one of two variants, so compute each once...
+    table = np.array([
+        _render_cycle(data, start, period, modes, scales, ana_set,
+                      trigger_mask, triggered)
+        for triggered in (False, True)
+    ])
+
+    # ... and then tile them.  Cycles past the end of the schedule are
+    #   not triggered.
+    num_cycles = -(-samples // period)
+    triggered = np.zeros(num_cycles, dtype='u1')
+    n = min(num_cycles, len(trigger_schedule))
+    triggered[:n] = trigger_schedule[:n]
+    words = table[triggered].reshape(-1)[:samples]
+
+    if not decode:
+        return words
+
+    digital = ((words >> 40) & 0xFFFF).astype('u2')
+
+    ad = (words >> DAC_SHIFT) & 0xFFFFFF
+    header = ad & 0xFF0000
+    analog = np.empty((2, samples), dtype='u2')
+    i = np.arange(samples)
+    for n, h in enumerate((DAC_SPI_CH0, DAC_SPI_CH1)):
+        # Index of the last update of this channel; -1 if not updated yet
+        last = np.maximum.accumulate(np.where(header == h, i, -1))
+        analog[n] = np.where(last >= 0, ad[last] & 0xFFFF, ana_set[n])
+
+    return digital, analog
@@ -1,4 +1,3 @@
-import numpy as np
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox, QGridLayout,
         QMainWindow, QVBoxLayout, QLabel, QProgressBar, QPushButton, QWidget,
@@ -8,10 +7,12 @@ from PyQt5.QtGui import (QIcon)
 import sys
 import os
 import serial.tools.list_ports
-from .. import ADSync, SmoothRamp
+from .. import ADSync, ADSyncError
+from ..profile import ScanSpec, compile_scan
 import json
-import re
 import time
+import threading
+import collections
 
 # Set the name in the menubar.
 if sys.platform.startswith('darwin'):
@@ -27,6 +28,115 @@ if sys.platform.startswith('darwin'):
         pass
 
 
+class DeviceWorker(QtCore.QObject):
+    '''
+    Owns the connection to the synchronizer, and does all of the device I/O
+    in a background thread so that the GUI never waits for a reply.
+
+    Jobs are functions which take the `ADSync` object, queued with `submit`.
+    If a job has a key, it replaces any queued job with the same key which
+    hasn't started yet, so that only the latest of a rapid series of updates
+    (e.g. from dragging a control) is sent.  Results and errors are posted
+    back with the `finished` and `failed` signals.
+    '''
+    finished = QtCore.pyqtSignal(object, object) # callback, result
+    failed = QtCore.pyqtSignal(object, object) # callback, exception
+    progress = QtCore.pyqtSignal(int, int) # samples sent, total
+    _wake = QtCore.pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.sync = None
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._count = 0
+
+        self.thread = QtCore.QThread()
+        self.moveToThread(self.thread)
+        self._wake.connect(self._run)
+        self.thread.start()
+
+    def submit(self, func, key=None, done=None, error=None):
+        '''
+        Queue a job, which is called as `func(sync)` in the worker thread.
+        If `done` is specified, it is called with the result (in the main
+        thread); if the job raises an exception, `error` is called with it
+        instead.
+        '''
+        with self._lock:
+            if key is None:
+                self._count += 1
+                key = self._count
+            # The latest job with a key goes to the back of the queue
+            self._jobs.pop(key, None)
+            self._jobs[key] = (func, done, error)
+
+        self._wake.emit()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._jobs:
+                    return
+                key, (func, done, error) = self._jobs.popitem(last=False)
+
+            try:
+                result = func(self.sync)
+            except Exception as e:
+                self.failed.emit(error, e)
+            else:
+                if done is not None:
+                    self.finished.emit(done, result)
+
+    def open(self, port, done=None, error=None):
+        '''
+        Close the current connection, and connect to the synchronizer on a
+        new port (if `port` is not None).  The result is the IDN string.
+        '''
+        def connect(sync):
+            if self.sync is not None:
+                self.sync.close()
+                self.sync = None
+
+            if port is None:
+                return None
+
+            sync = ADSync(port)
+            try:
+                idn = sync.idn().decode('utf-8')
+                if 'synchronizer' not in idn.lower():
+                    raise ADSyncError(f'no sync board at {port}')
+                # Read back the settings, so that only the ones which differ
+                #   from the GUI are sent
+                if sync.firmware_version >= (1, 2):
+                    sync.query_state()
+                # Pre-render the output where possible, for faster rates
+                if sync.firmware_version >= (1, 8):
+                    sync.cache(True)
+            except:
+                sync.close()
+                raise
+
+            self.sync = sync
+            return idn
+
+        # Any updates for the old connection are no longer needed
+        with self._lock:
+            self._jobs.clear()
+        self.submit(connect, key='open', done=done, error=error)
+
+    def stop(self):
+        "Stop the worker thread (after the current job), and disconnect."
+        with self._lock:
+            self._jobs.clear()
+        self.thread.quit()
+        self.thread.wait()
+
+        if self.sync is not None:
+            self.sync.close()
+            self.sync = None
+
+
 class ConfigTab(QWidget):
     def __init__(self, parent=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -361,10 +471,8 @@ class SerialTab(ConfigTab):
         self.gridloc += 1
 
     def send_command(self, command):
-        self.read_serial()
-        self.serial_output.insertHtml(f'<font color="#00F">\u1405 {command}</font><br>')
-        # if hasattr(self.parent, "scan_controls"):
-        # time.sleep(0.1)
+        # Anything already received is shown before the command is echoed
+        self.read_serial(echo=command)
         self.parent.scan_controls.serial_write(self.port, command.encode('utf-8') + b"\r\n")
 
     def custom_command(self):
@@ -392,14 +500,19 @@ class SerialTab(ConfigTab):
         # if hasattr(self.parent, "scan_controls"):
         self.parent.scan_controls.serial_baud(self.port, rate)
 
-    def read_serial(self, max_bytes=256):
-        # if hasattr(self.parent, "scan_controls"):
-        read = self.parent.scan_controls.serial_read(self.port, max_bytes)
-        if read is not None:
-            try:
-                self.serial_output.insertHtml(read.decode('utf-8').replace('\n', '<br>'))
-            except:
-                self.serial_output.insertHtml(f'<nr><font color="#F00">!! corrupted input: {repr(read)} !!</font><br>')
+    def read_serial(self, max_bytes=256, echo=None):
+        # The reply arrives later, from the device worker
+        def show(read):
+            if read is not None:
+                try:
+                    self.serial_output.insertHtml(read.decode('utf-8').replace('\n', '<br>'))
+                except:
+                    self.serial_output.insertHtml(f'<nr><font color="#F00">!! corrupted input: {repr(read)} !!</font><br>')
+            if echo is not None:
+                self.serial_output.insertHtml(f'<font color="#00F">\u1405 {echo}</font><br>')
+
+        if not self.parent.scan_controls.serial_read(self.port, max_bytes, show):
+            show(None)
 
     def clear_output(self):
         self.serial_output.clear()
@@ -410,10 +523,15 @@ class ScanControls(ConfigTab):
 
     def _build(self):
         self.current_port = None
-        self.sync = None
+        self.connected = False
         self.active = False
         self.analog_scale = 1
 
+        # All communication with the board happens in this worker's thread
+        self.device = DeviceWorker()
+        self.device.finished.connect(self.device_finished)
+        self.device.failed.connect(self.device_failed)
+
         self.port_select = self.add_combobox(
             'Syncronizer Serial Port:',
             update=self.select_port, name='sync_port',
@@ -489,6 +607,12 @@ class ScanControls(ConfigTab):
 
         self.upload_button.setIcon(self.style().standardIcon(QStyle.SP_DialogApplyButton))
 
+        self.upload_progress = QProgressBar()
+        self.upload_progress.setVisible(False)
+        self.device.progress.connect(self.show_progress)
+        self.grid.addWidget(self.upload_progress, self.gridloc, 0, 1, 2)
+        self.gridloc += 1
+
         self.vps = self.add_display(
             'Volume Rate:',
             tip='The number of volumes captured per second.'
@@ -547,198 +671,193 @@ class ScanControls(ConfigTab):
         if port == self.current_port:
             return
 
-        self.current_port = None
-        if self.sync is not None:
-            self.sync.close()
+        self.current_port = port
+        self.connected = False
+
+        def connected(idn):
+            if port != self.current_port:
+                return # A different port was selected in the meantime
+            self.connected = True
+            self.parent.statusBar().showMessage(f"Connected to sync board at {port}.")
+            self.update_scale()
+            self.update_align()
+            self.update_control_display()
+
+        def failed(e):
+            if port != self.current_port:
+                return
+            if isinstance(e, ADSyncError):
+                self.parent.statusBar().showMessage(f"ERROR: no sync board at {port}!")
+            else:
+                self.parent.statusBar().showMessage(f"ERROR: could not open {port}!")
+            self.current_port = None
+            self.port_select.setCurrentIndex(0)
 
         if port is None:
-            self.sync = None
+            self.device.open(None)
             self.parent.statusBar().showMessage('Synchronizer not connected.')
         else:
-            try:
-                self.sync = ADSync(port)
-                idn = self.sync.idn().decode('utf-8')
-                if 'synchronizer' in idn.lower():
-                    self.current_port = port
-                    self.parent.statusBar().showMessage(f"Connected to sync board at {port}.")
-                    self.update_scale()
-                    self.update_align()
-                else:
-                    self.parent.statusBar().showMessage(f"ERROR: no sync board at {port}!")
-                    self.sync.close()
-                    self.sync = None
-                    self.port_select.setCurrentIndex(0)
-            except:
-                self.parent.statusBar().showMessage(f"ERROR: could not open {port}!")
-                if hasattr(self.sync, 'close'):
-                    self.sync.close()
-                self.sync = None
-                self.port_select.setCurrentIndex(0)
+            self.device.open(port, done=connected, error=failed)
+            self.parent.statusBar().showMessage(f"Connecting to {port}...")
 
         self.update_control_display()
 
+    def device_finished(self, callback, result):
+        callback(result)
+
+    def device_failed(self, callback, e):
+        if callback is not None:
+            callback(e)
+        elif isinstance(e, ADSyncError):
+            self.parent.statusBar().showMessage('Syncronizer responded incorrectly (disconnected?).')
+            print(f"WARNING: synchronizer command failed\n ({e})")
+        else:
+            print("Unexpected error:", repr(e))
+            self.parent.statusBar().showMessage('ERROR: synchronizer command failed!')
+
+    def show_progress(self, sent, total):
+        self.upload_progress.setRange(0, total)
+        self.upload_progress.setValue(sent)
+
+
+    def scan_spec(self):
+        "The scan described by the current settings (see `ad_sync.profile`)."
+        return ScanSpec(
+            frame_rate=1E3 * self.frame_rate.value(),
+            fpv=self.fpv.value(),
+            t0=1E-3 * self.ramp_t0.value(),
+            tr=1E-3 * self.ramp_tr.value(),
+            channels=2 if self.two_color.isChecked() else 1,
+            galvo_delay=1E-3 * self.galvo_delay.value(),
+            flipped=self.flipped.isChecked(),
+            continuous=self.cont_frames.isChecked(),
+            double_pulse=(self.double_pulse_1.isChecked(),
+                          self.double_pulse_2.isChecked()),
+        )
 
     def upload_profile(self):
-        frame_rate = 1E3 * self.frame_rate.value()
-        t0 = 1E-3 * self.ramp_t0.value()
-        channels = 2 if self.two_color.isChecked() else 1
-        fpv = self.fpv.value()
-        tr = 1E-3 * self.ramp_tr.value()
-
-        ft0 = int(np.ceil(t0 * frame_rate))
-        ftr = int(np.ceil(tr * frame_rate))
-        total_frames = ft0 + fpv * channels + ftr
-
-        # Ensure that each laser fires the same number of times per profile
-        if total_frames % channels:
-            extra_frames = channels - (total_frames % channels) # Round up
-            ftr += extra_frames
-            total_frames += extra_frames
-
-        if self.sync is None:
+        if not self.connected:
             self.update_control_display()
             return
 
-        oversample1 = int((ADSync.FREQ_MAX) // frame_rate)
-        oversample2 = int(ADSync.MAX_ADDR // total_frames)
-        oversample = min(oversample1, oversample2)
-        sample_rate = frame_rate * oversample
-
-        samples = total_frames * oversample
-        dig = np.zeros(samples, dtype='u2')
-
-        if self.cont_frames.isChecked():
-            camera_pulses = np.arange(total_frames) * oversample
-        else:
-            camera_pulses = (ft0 + np.arange(fpv*channels)) * oversample
-
-        dig[camera_pulses] += 1 << 0 # Channel 0 is camera
-        dig[camera_pulses] += 1 << 8 # Channel 8 is camera in align mode
-
-        laser_pulses = np.arange(0, total_frames, channels) * oversample
-        i0 = ft0 * oversample # sample # of first laser pulse in scan
-        i1 = i0 + (fpv - 1) * channels * oversample # sample # of last laser pulse in scan
-        im = (i0 + i1) // 2 # Mid point; may not align with frame, but thats ok
-        align_pulses = np.array([i0, im, i1], dtype='i')
-
-        if oversample > 3:
-            double_pulses = (
-                self.double_pulse_1.isChecked(),
-                self.double_pulse_2.isChecked()
-            )
-            ignore_dp = False
-        else:
-            double_pulses = (False, False)
-            ignore_dp = self.double_pulse_1.isChecked() or self.double_pulse_2.isChecked()
-
-        for i in range(channels):
-            dig[laser_pulses + i*oversample] += 1 << (i+1) # Channel i+1 is laser i+1
-            if double_pulses[i]:
-                dig[laser_pulses + i*oversample + 2] += 1 << (i+1) # Channel i+1 is laser i+1
-            dig[align_pulses + i*oversample] += 1 << (i+9) # Channel (i+1) in swap mode (alignment)
-
-        t_a = (np.arange(samples) - 0.5) / sample_rate + self.galvo_delay.value() * 1E-3
-        t_d = np.arange(samples) / sample_rate
-
-        analog = SmoothRamp(t0=ft0, ts=fpv*channels, tr=ftr)(t_a * frame_rate)
-        self.analog_scale = abs(analog).max()
-        analog /= self.analog_scale
-
-        dig[ft0 * oversample] += 1 << 3 # Volume start signal (triggered)
-        dig[ft0 * oversample] += 1 << 11 # Volume start signal in alignment mode
-        dig[ft0 * oversample] += 1 << 4 # Volume start signal (not triggered)
-        dig[ft0 * oversample] += 1 << 12 # Volume start signal in alignment mode
-
-
-        if self.flipped.isChecked():
-            analog *= -1
-
+        # Compiled profiles are cached, so switching between settings is cheap
         try:
-            self.sync.stop()
-            self.sync.led(255, 0, 255)
-            self.sync.rate(sample_rate)
-            self.sync.trigger_mask(1<<3)
-            response = self.sync.write_ad(0, dig, analog)
-
-            m = re.match(b'Wrote (\d+) samples', response)
+            profile = compile_scan(self.scan_spec())
+        except ValueError as e:
+            self.parent.statusBar().showMessage(f'Invalid scan profile: {e}')
+            return
+        self.analog_scale = profile.analog_scale
+        ignore_dp = profile.double_pulse_ignored
 
-            self.sync.addr(0, samples)
-            self.update_scale()
-            self.update_active()
+        def upload(sync):
+            sync.led(255, 0, 255)
+            profile.upload(sync, progress=self.device.progress.emit)
 
-            if m and int(m.group(1)) == samples:
-                self.upload_button.setEnabled(False)
-                if ignore_dp:
-                    self.parent.statusBar().showMessage('Scan profile uploaded, but double pulse ignored.')
-                else:
-                    self.parent.statusBar().showMessage('Scan profile successfully uploaded!')
+        def uploaded(result):
+            self.upload_progress.setVisible(False)
+            if ignore_dp:
+                self.parent.statusBar().showMessage('Scan profile uploaded, but double pulse ignored.')
             else:
-                self.parent.statusBar().showMessage('Syncronizer responded incorrectly to upload (disconnected?).')
-                print(f"WARNING: unexpected response to sync data upload\n (received '{response.decode('utf-8')}')")
-        except:
-            print("Unexpected error:", sys.exc_info()[0])
-            self.parent.statusBar().showMessage('ERROR: synchronizer failed to upload!')
+                self.parent.statusBar().showMessage('Scan profile successfully uploaded!')
 
-        self.parent.main_controls.vps.setText(f'{frame_rate / total_frames:.1f} Hz')
-        self.parent.main_controls.duty_cycle.setText(f'{100 * fpv*channels / total_frames:.1f} %')
+        def failed(e):
+            self.upload_progress.setVisible(False)
+            self.upload_button.setEnabled(True)
+            if isinstance(e, ADSyncError):
+                self.parent.statusBar().showMessage('Syncronizer responded incorrectly to upload (disconnected?).')
+                print(f"WARNING: sync data upload failed\n ({e})")
+            else:
+                print("Unexpected error:", repr(e))
+                self.parent.statusBar().showMessage('ERROR: synchronizer failed to upload!')
+
+        self.upload_button.setEnabled(False)
+        self.upload_progress.setValue(0)
+        self.upload_progress.setVisible(True)
+        self.parent.statusBar().showMessage('Uploading scan profile...')
+        self.device.submit(upload, done=uploaded, error=failed)
+        self.update_scale()
+        self.update_active()
+
+        frame_rate = profile.spec.frame_rate
+        self.parent.main_controls.vps.setText(f'{profile.volume_rate:.1f} Hz')
+        self.parent.main_controls.duty_cycle.setText(f'{100 * profile.duty_cycle:.1f} %')
         self.parent.main_controls.max_exposure.setText(f'{1E6 / frame_rate  - 0.5:.1f} \u03bcs')
 
 
+    # The widget values are read here, in the main thread, and only the
+    #   device commands are queued.  Keyed jobs replace any queued update of
+    #   the same setting which hasn't been sent yet.
+
     def update_scale(self):
-        if self.sync is not None:
+        if self.connected:
             scale = self.parent.main_controls.scan_range.value() / 2 * self.analog_scale
             offset = self.parent.main_controls.scan_offset.value()
-            self.sync.analog_scale(0, scale, offset)
+            self.device.submit(lambda sync: sync.analog_scale(0, scale, offset),
+                               key='analog_scale')
 
     def update_align(self):
-        if self.sync is not None:
-            self.sync.mode(1, 2 if self.parent.main_controls.align_mode.isChecked() else 0)
+        if self.connected:
+            digital_mode = 2 if self.parent.main_controls.align_mode.isChecked() else 0
+            self.device.submit(lambda sync: sync.mode(1, digital_mode), key='mode')
         self.update_active() # Updates the LED colors
 
     def update_active(self):
-        if self.sync is not None:
-            if self.parent.main_controls.output_active.isChecked():
-                if self.parent.main_controls.led_active.isChecked():
-                    if self.parent.main_controls.align_mode.isChecked():
-                        self.sync.led(0, 0, 255)
-                    else:
-                        self.sync.led(0, 255, 0)
-                else:
-                    self.sync.led(0, 0, 0)
+        if not self.connected:
+            return
 
-                self.sync.start()
-            else:
-                self.sync.led(0, 0, 0)
-                self.sync.stop()
+        active = self.parent.main_controls.output_active.isChecked()
+        if not active or not self.parent.main_controls.led_active.isChecked():
+            led = (0, 0, 0)
+        elif self.parent.main_controls.align_mode.isChecked():
+            led = (0, 0, 255)
+        else:
+            led = (0, 255, 0)
+        digital_mode = 2 if self.parent.main_controls.align_mode.isChecked() else 0
+
+        def send(sync):
+            # Send all three commands in one go, rather than waiting for each reply
+            with sync.batch():
+                sync.led(*led)
+                if active:
+                    sync.start()
+                else:
+                    sync.stop()
+                sync.mode(1, digital_mode)
 
-            self.sync.mode(1, 2 if self.parent.main_controls.align_mode.isChecked() else 0)
+        self.device.submit(send, key='active')
 
     def trigger(self):
-        if self.sync is not None:
-            self.sync.trigger()
+        if self.connected:
+            self.device.submit(lambda sync: sync.trigger())
 
     def serial_write(self, port, command):
-        if self.sync is not None:
-            write = self.sync.ser_write(port, command)
-            if self._SER_DEBUG:
-                print(port, '<-', repr(command), repr(write))
-        else:
-            return None
-
-    def serial_read(self, port, max_bytes):
-        if self.sync is not None:
-            response = self.sync.ser_read(port, max_bytes)
-            if self._SER_DEBUG:
-                print(port, '->', repr(response))
-            return response
+        if self.connected:
+            def write(sync):
+                write = sync.ser_write(port, command)
+                if self._SER_DEBUG:
+                    print(port, '<-', repr(command), repr(write))
+            self.device.submit(write)
+
+    def serial_read(self, port, max_bytes, done):
+        # Returns False if not connected; otherwise `done` is called with the
+        #   data when it arrives
+        if self.connected:
+            def read(sync):
+                response = sync.ser_read(port, max_bytes)
+                if self._SER_DEBUG:
+                    print(port, '->', repr(response))
+                return response
+            self.device.submit(read, done=done)
+            return True
         else:
-            return None
+            return False
 
     def serial_baud(self, port, baudrate):
-        if self.sync is not None:
+        if self.connected:
             if self._SER_DEBUG:
                 print(port, ':', baudrate)
-            self.sync.ser_baud(port, baudrate)
+            self.device.submit(lambda sync: sync.ser_baud(port, baudrate),
+                               key=('ser_baud', port))
             return True
         else:
             return False
@@ -747,21 +866,14 @@ class ScanControls(ConfigTab):
         if not self.active:
             return
 
-        frame_rate = 1E3 * self.frame_rate.value()
-        t0 = 1E-3 * self.ramp_t0.value()
-        channels = 2 if self.two_color.isChecked() else 1
-        fpv = self.fpv.value() * channels
-        tr = 1E-3 * self.ramp_tr.value()
-
-        ft0 = int(np.ceil(t0 * frame_rate))
-        ftr = int(np.ceil(tr * frame_rate))
-        total_frames = ft0 + fpv + ftr
+        spec = self.scan_spec()
+        ft0, ftr, total_frames = spec.frames()
 
-        self.vps.setText(f'{frame_rate / total_frames:.1f} Hz')
-        self.duty_cycle.setText(f'{100 * fpv / total_frames:.1f} %')
+        self.vps.setText(f'{spec.frame_rate / total_frames:.1f} Hz')
+        self.duty_cycle.setText(f'{100 * spec.fpv * spec.channels / total_frames:.1f} %')
 
         if hasattr(self, 'upload_button'):
-            if self.sync is not None:
+            if self.connected:
                 self.upload_button.setEnabled(True)
             else:
                 self.upload_button.setEnabled(False)
@@ -807,6 +919,10 @@ class MainWindow(QMainWindow):
         self.tabs.addTab(self.serial2, "Serial 2")
         self.tabs.setCurrentIndex(1)
 
+    def closeEvent(self, event):
+        self.scan_controls.device.stop()
+        super().closeEvent(event)
+
     def save_settings(self):
         settings = {}
         self.main_controls.get_settings(settings)
@@ -0,0 +1,394 @@
+"""
+Compact encoding of sync data, used by the `SYNC PACK` command.
+
+Scan profiles are very redundant: the digital channels are mostly zero (or
+repeat with the frame period), and the analog channel is smooth.  The packed
+format stores the two halves of each sample separately:
+
+    [varint N] [digital ops ...] [analog ops ...]
+
+N is the number of samples.  The digital section is a series of ops which
+produce exactly N digital (high 16 bit) values, followed by the analog
+section, which produces N analog (low 16 bit) values.  Each section only
+replaces its half of the samples, so if the memory is being output, the
+analog channel keeps its old values until the analog section arrives.
+
+Each op starts with a header byte: the top two bits are the op code, and the
+low six bits are the number of samples minus one.  If the low bits are all
+set (63), the count is instead 64 plus a varint which follows the header.
+Varints are unsigned LEB128 (7 bits per byte, low bits first, high bit set on
+all but the last byte).
+
+Digital ops:
+    - `0` LIT: count little-endian uint16 values follow.
+    - `1` RUN: one uint16 value follows, which is repeated count times.
+    - `2` COPY: a varint distance (d >= 1) follows; each sample is a copy of
+      the one d samples before it.  (d may be less than the count, in which
+      case the last d samples are repeated.)
+
+Analog ops are coded relative to the linear prediction `2 a[i-1] - a[i-2]`
+(with a[-1] = a[-2] = 0 at the start of the section), modulo 2^16:
+    - `0` ZERO: count samples which exactly match the prediction.
+    - `1` SMALL: the difference from the prediction is in [-2, 1], stored as
+      (diff + 2) with 2 bits per sample, four samples per byte, low bits first.
+    - `2` BYTE: the difference is stored as an int8, one byte per sample.
+    - `3` RAW: the sample is stored directly as a little-endian uint16.
+
+The firmware decodes the stream as it arrives (see `firmware/src/pack.cpp`);
+`Unpacker` is a direct port of that decoder.
+"""
+
+import numpy as np
+from .firmware import SYNC_DATA_SIZE
+
+DIG_LIT, DIG_RUN, DIG_COPY = range(3)
+ANA_ZERO, ANA_SMALL, ANA_BYTE, ANA_RAW = range(4)
+
+# Decoder states, as in "pack.h"
+PACK_NONE, PACK_COUNT, PACK_HEADER, PACK_EXT, PACK_ARG, PACK_DATA, \
+    PACK_DONE, PACK_OVERFLOW, PACK_INVALID = range(9)
+
+# Minimum number of samples for which a digital run or copy is used instead
+#   of literal values.
+_MIN_MATCH = 3
+# Maximum number of distances tried for digital copies
+_MAX_DISTANCES = 8
+# (level, minimum length) for merging short runs of analog ops into their
+#   neighbors; below these lengths the extra op header costs more than it saves
+_ANA_MERGE = ((ANA_ZERO, 8), (ANA_SMALL, 3), (ANA_BYTE, 3))
+
+
+def _varint(x):
+    out = bytearray()
+    while x >= 0x80:
+        out.append((x & 0x7F) | 0x80)
+        x >>= 7
+    out.append(x)
+    return bytes(out)
+
+
+def _header(op, count):
+    if count < 64:
+        return bytes(((op << 6) + count - 1, ))
+    else:
+        return bytes(((op << 6) + 63, )) + _varint(count - 64)
+
+
+def _match_lengths(match):
+    # For each index, the number of consecutive True values starting there
+    n = len(match)
+    i = np.arange(n)
+    stop = np.where(match, n, i)
+    return np.minimum.accumulate(stop[::-1])[::-1] - i
+
+
+def _runs(x):
+    # Start/end indices of the runs of equal values in x
+    edges = np.flatnonzero(x[1:] != x[:-1]) + 1
+    return np.concatenate([[0], edges]), np.concatenate([edges, [len(x)]])
+
+
+def _pack_digital(dig):
+    n = len(dig)
+    out = []
+
+    # Length of the run of equal values at each sample...
+    same = np.zeros(n, dtype=bool)
+    same[:-1] = dig[1:] == dig[:-1]
+    best_len = _match_lengths(same) + 1
+    best_dist = np.zeros(n, dtype=int)
+
+    # ... and the longest copy for the most common distances between edges
+    edges = np.flatnonzero(dig[1:] != dig[:-1]) + 1
+    dist = np.concatenate([edges[k:] - edges[:-k]
+                           for k in range(1, min(len(edges), 9))] + [[]])
+    dist, counts = np.unique(dist.astype(int), return_counts=True)
+    for d in dist[np.argsort(-counts, kind='stable')][:_MAX_DISTANCES]:
+        match = np.zeros(n, dtype=bool)
+        match[d:] = dig[d:] == dig[:-d]
+        length = _match_lengths(match)
+        better = length > best_len
+        best_len[better] = length[better]
+        best_dist[better] = d
+
+    good = np.flatnonzero(best_len >= _MIN_MATCH)
+    i = lit = 0
+    while i < n:
+        j = np.searchsorted(good, i)
+        if j == len(good):
+            break
+        i = good[j]
+        if i > lit:
+            out.append(_header(DIG_LIT, i - lit))
+            out.append(dig[lit:i].astype('<u2').tobytes())
+
+        count = int(best_len[i])
+        if best_dist[i]:
+            out.append(_header(DIG_COPY, count) + _varint(int(best_dist[i])))
+        else:
+            out.append(_header(DIG_RUN, count)
+                       + dig[i:i+1].astype('<u2').tobytes())
+        i = lit = i + count
+
+    if n > lit:
+        out.append(_header(DIG_LIT, n - lit))
+        out.append(dig[lit:].astype('<u2').tobytes())
+
+    return out
+
+
+def _pack_analog(ana):
+    n = len(ana)
+    out = []
+
+    a = np.zeros(n + 2, dtype='i8')
+    a[2:] = ana
+    diff = ((a[2:] - 2 * a[1:-1] + a[:-2] + 0x8000) & 0xFFFF) - 0x8000
+
+    level = np.full(n, ANA_RAW)
+    level[(diff >= -128) & (diff <= 127)] = ANA_BYTE
+    level[(diff >= -2) & (diff <= 1)] = ANA_SMALL
+    level[diff == 0] = ANA_ZERO
+
+    # Short runs are cheaper to send with one of the neighboring ops
+    for max_level, min_len in _ANA_MERGE:
+        low = level <= max_level
+        for start, end in zip(*_runs(low)):
+            if low[start] and (end - start) < min_len:
+                neighbors = level[[i for i in (start-1, end) if 0 <= i < n]]
+                if len(neighbors):
+                    level[start:end] = neighbors.max()
+
+    for start, end in zip(*_runs(level)):
+        op = level[start]
+        out.append(_header(op, end - start))
+        if op == ANA_SMALL:
+            codes = np.zeros(-(-(end - start) // 4) * 4, dtype='u1')
+            codes[:end-start] = diff[start:end] + 2
+            codes = codes.reshape(-1, 4) << np.array([0, 2, 4, 6], dtype='u1')
+            out.append(np.bitwise_or.reduce(codes, axis=1).tobytes())
+        elif op == ANA_BYTE:
+            out.append(diff[start:end].astype('i1').tobytes())
+        elif op == ANA_RAW:
+            out.append(ana[start:end].astype('<u2').tobytes())
+
+    return out
+
+
+def pack(data):
+    '''
+    Encode sync data in the packed format.
+
+    Parameters
+    ----------
+    data : array
+        The sync data; converted to uint32.
+
+    Returns
+    -------
+    packed : bytes
+    '''
+    data = np.asarray(data, dtype='u4').reshape(-1)
+    out = [_varint(len(data))]
+    if len(data):
+        out += _pack_digital((data >> 16).astype('u2'))
+        out += _pack_analog((data & 0xFFFF).astype('u2'))
+    return b''.join(out)
+
+
+def unpack(packed, max_samples=None):
+    '''
+    Decode packed sync data.
+
+    Parameters
+    ----------
+    packed : bytes
+
+    Keywords
+    --------
+    max_samples : int (default: the size of the device memory)
+        The maximum number of samples to decode.
+
+    Returns
+    -------
+    data : uint32 array
+    '''
+    if max_samples is None:
+        max_samples = SYNC_DATA_SIZE
+    dest = np.zeros(max_samples, dtype='u4')
+    unpacker = Unpacker()
+    unpacker.start(dest)
+    unpacker.write(packed)
+    if unpacker.state != PACK_DONE:
+        raise ValueError('invalid packed data')
+    return dest[:unpacker.total]
+
+
+class Unpacker:
+    '''
+    Streaming decoder for packed sync data; a port of `PackDecoder` in the
+    firmware.  The decoded samples are written into `dest` as they arrive.
+    '''
+    def __init__(self):
+        self.dest = None
+        self.reset()
+
+    def reset(self):
+        self.state = PACK_NONE
+
+    def start(self, dest):
+        "Begin decoding a new stream into the uint32 array `dest`."
+        self.dest = dest
+        self.state = PACK_COUNT
+        self.total = 0
+        self.section = 0
+        self.pos = 0
+        self.op = 0
+        self.count = 0
+        self.value = 0
+        self.shift = 0
+        self.byte_i = 0
+        self.a1 = self.a2 = 0
+
+    def _varint(self, c):
+        # Returns True when the varint is complete
+        if self.shift > 28:
+            self.state = PACK_INVALID
+            return False
+        self.value += (c & 0x7F) << self.shift
+        self.shift += 7
+        return not (c & 0x80)
+
+    def _begin_op(self):
+        if (self.count < 1) or (self.count > self.total - self.pos):
+            self.state = PACK_INVALID
+        elif self.section == 0:
+            if self.op == DIG_COPY:
+                self.value = self.shift = 0
+                self.state = PACK_ARG
+            elif self.op == 3:
+                self.state = PACK_INVALID
+            else:
+                self.value = self.byte_i = 0
+                self.state = PACK_DATA
+        elif self.op == ANA_ZERO:
+            for i in range(self.count):
+                self._put_ana(2 * self.a1 - self.a2)
+            self._end_op()
+        else:
+            self.value = self.byte_i = 0
+            self.state = PACK_DATA
+
+    def _end_op(self):
+        if self.pos < self.total:
+            self.state = PACK_HEADER
+        elif self.section == 0:
+            self.section = 1
+            self.pos = 0
+            self.state = PACK_HEADER
+        else:
+            self.state = PACK_DONE
+
+    def _put_dig(self, x):
+        self.dest[self.pos] = (int(self.dest[self.pos]) & 0xFFFF) | (x << 16)
+        self.pos += 1
+
+    def _put_ana(self, x):
+        x &= 0xFFFF
+        self.dest[self.pos] = (int(self.dest[self.pos]) & 0xFFFF0000) + x
+        self.a2 = self.a1
+        self.a1 = x
+        self.pos += 1
+
+    def _data(self, c):
+        if self.section == 0:
+            self.value += c << (8 * self.byte_i)
+            self.byte_i += 1
+            if self.byte_i == 2:
+                if self.op == DIG_RUN:
+                    dest = self.dest[self.pos:self.pos + self.count]
+                    dest[:] = (dest & 0xFFFF) | (self.value << 16)
+                    self.pos += self.count
+                    self.count = 0
+                else:
+                    self._put_dig(self.value)
+                    self.count -= 1
+                self.value = self.byte_i = 0
+
+        elif self.op == ANA_SMALL:
+            for i in range(min(self.count, 4)):
+                diff = ((c >> (2 * i)) & 0b11) - 2
+                self._put_ana(2 * self.a1 - self.a2 + diff)
+                self.count -= 1
+
+        elif self.op == ANA_BYTE:
+            diff = c - 256 if c & 0x80 else c
+            self._put_ana(2 * self.a1 - self.a2 + diff)
+            self.count -= 1
+
+        else:
+            self.value += c << (8 * self.byte_i)
+            self.byte_i += 1
+            if self.byte_i == 2:
+                self._put_ana(self.value)
+                self.count -= 1
+                self.value = self.byte_i = 0
+
+        if self.count == 0:
+            self._end_op()
+
+    def write(self, data):
+        "Decode the bytes in `data`."
+        for c in bytes(data):
+            state = self.state
+            if state == PACK_DATA:
+                self._data(c)
+
+            elif state == PACK_HEADER:
+                self.op = c >> 6
+                self.count = (c & 63) + 1
+                if self.count == 64:
+                    self.value = self.shift = 0
+                    self.state = PACK_EXT
+                else:
+                    self._begin_op()
+
+            elif state == PACK_EXT:
+                if self._varint(c):
+                    self.count = 64 + self.value
+                    self.value = 0
+                    self._begin_op()
+
+            elif state == PACK_ARG:
+                if self._varint(c):
+                    d = self.value
+                    self.value = 0
+                    if (d < 1) or (d > self.pos):
+                        self.state = PACK_INVALID
+                    else:
+                        src = self.pos - d
+                        # Repeats the last d samples, like a byte by byte copy
+                        index = src + np.arange(self.count) % d
+                        dest = self.dest[self.pos:self.pos + self.count]
+                        dest[:] = (dest & 0xFFFF) | \
+                            (self.dest[index] & 0xFFFF0000)
+                        self.pos += self.count
+                        self._end_op()
+
+            elif state == PACK_COUNT:
+                if self._varint(c):
+                    self.total = self.value
+                    self.value = 0
+                    if self.total > len(self.dest):
+                        self.state = PACK_OVERFLOW
+                    elif self.total == 0:
+                        self.state = PACK_DONE
+                    else:
+                        self.state = PACK_HEADER
+
+            elif state == PACK_DONE:
+                # Trailing data
+                self.state = PACK_INVALID
+
+            if self.state >= PACK_OVERFLOW:
+                break
@@ -0,0 +1,472 @@
+"""
+Compile scan descriptions into sync output profiles, without the GUI.
+
+A `ScanSpec` describes a volumetric scan (camera frame rate, frames per
+volume, ramp timing and pulse options), and `compile_scan` turns it into the
+digital and analog data for the synchronizer, exactly as the GUI's "Upload
+Scan Profile" does:
+
+    spec = ScanSpec(frame_rate=75000, fpv=512, channels=2)
+    profile = compile_scan(spec)
+    profile.upload(sync)
+
+Compiled profiles are cached (the last `CACHE_SIZE` specs), so switching
+back and forth between configurations doesn't recompute them.  The settings
+saved by the GUI (File -> Save Scan Settings) can be loaded with
+`ScanSpec.from_settings`.
+
+By default each frame gets as many samples as the rate and memory allow.  If
+`ScanSpec.max_error` is set, `plan_scan` instead picks the fewest samples per
+frame which keep the actual frame rate (after the device's clock is
+quantized) within that relative error, which makes the profile much smaller:
+
+    profile = compile_scan(spec.replace(max_error=1E-6))
+    print(profile.oversample, profile.actual_frame_rate)
+
+Digital channels:
+    - 0: camera
+    - 1, 2: laser 1 and 2
+    - 3: volume start (triggered; the trigger mask is set by `upload`)
+    - 4: volume start (not triggered)
+    - 8-12: the same signals in alignment mode (`SYNC MODE` digital mode 2
+      swaps them onto channels 0-4); the lasers only fire at the start,
+      middle and end of the scan.
+"""
+
+import functools
+import zlib
+import numpy as np
+from . import ADSync, SmoothRamp
+
+# The number of compiled profiles which are kept by compile_scan
+CACHE_SIZE = 32
+
+# The fewest samples per frame which plan_scan uses (with 1, the camera
+#   pulses would run together)
+MIN_OVERSAMPLE = 2
+
+
+class ScanSpec:
+    '''
+    A description of a volumetric scan.  Specs are immutable and hashable,
+    so that they can be used as keys.
+
+    Keywords
+    --------
+    frame_rate : float (default: 75000)
+        The camera frame rate, in Hz.
+    fpv : int (default: 512)
+        The number of active frames per volume (for each color).
+    t0 : float (default: 0.2E-3)
+        The time from the start of the ramp to the first active frame, in s,
+        so that the galvo has settled into a linear ramp.
+    tr : float (default: 1.5E-3)
+        The time for the ramp to return to the start, in s.
+    channels : int (default: 1)
+        The number of colors (1 or 2); with 2, the lasers alternate frames.
+    galvo_delay : float (default: 0.2E-3)
+        The analog output is shifted this much earlier, in s, to compensate
+        for the galvo response.
+    flipped : bool (default: False)
+        If True, the scan direction is reversed.
+    continuous : bool (default: False)
+        If True, the camera is triggered through the entire scan cycle
+        (otherwise only during the active frames).
+    double_pulse : (bool, bool) (default: (False, False))
+        If set, the corresponding laser fires two pulses per frame.  (This
+        is ignored if the frame is too short; see
+        `ScanProfile.double_pulse_ignored`.)
+    max_error : float (default: None)
+        If specified, the profile uses the fewest samples per frame which
+        give a frame rate within this relative error of `frame_rate` (see
+        `plan_scan`); otherwise it uses as many as possible.
+    '''
+    FIELDS = ('frame_rate', 'fpv', 't0', 'tr', 'channels', 'galvo_delay',
+              'flipped', 'continuous', 'double_pulse', 'max_error')
+
+    def __init__(self, frame_rate=75000, fpv=512, t0=0.2E-3, tr=1.5E-3,
+                 channels=1, galvo_delay=0.2E-3, flipped=False,
+                 continuous=False, double_pulse=(False, False),
+                 max_error=None):
+        if channels not in (1, 2):
+            raise ValueError('channels should be 1 or 2')
+        if frame_rate <= 0:
+            raise ValueError('frame_rate should be positive')
+        if (max_error is not None) and max_error < 0:
+            raise ValueError('max_error should not be negative')
+
+        values = (float(frame_rate), int(fpv), float(t0), float(tr),
+                  int(channels), float(galvo_delay), bool(flipped),
+                  bool(continuous), tuple(bool(x) for x in double_pulse),
+                  None if max_error is None else float(max_error))
+        for name, value in zip(self.FIELDS, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_settings(cls, settings):
+        '''
+        Create a spec from the scan settings saved by the GUI (a dict, as
+        read from the JSON file).  Settings which are missing take the GUI
+        defaults, and other keys are ignored.
+        '''
+        s = dict(frame_rate_khz=75, frames_per_volume=512, ramp_t0_ms=0.2,
+                 ramp_tr_ms=1.5, two_color=False, galvo_delay=0.2,
+                 scan_flipped=False, continuous_frame_capture=False,
+                 double_pulse_1=False, double_pulse_2=False)
+        s.update(settings)
+        return cls(
+            frame_rate=1E3 * s['frame_rate_khz'], fpv=s['frames_per_volume'],
+            t0=1E-3 * s['ramp_t0_ms'], tr=1E-3 * s['ramp_tr_ms'],
+            channels=2 if s['two_color'] else 1,
+            galvo_delay=1E-3 * s['galvo_delay'], flipped=s['scan_flipped'],
+            continuous=s['continuous_frame_capture'],
+            double_pulse=(s['double_pulse_1'], s['double_pulse_2'])
+        )
+
+    def replace(self, **kwargs):
+        "Return a copy of the spec with some of the fields changed."
+        values = {name: getattr(self, name) for name in self.FIELDS}
+        values.update(kwargs)
+        return type(self)(**values)
+
+    def key(self):
+        "The values of all the fields, as a tuple."
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    def frames(self):
+        '''
+        Compute the length of each part of the scan cycle, in frames.
+
+        Returns
+        -------
+        ft0, ftr : int
+            The number of frames before the active frames, and in the return
+            (which is rounded up so that each laser fires the same number of
+            times per cycle).
+        total_frames : int
+            The total frames per cycle.
+        '''
+        ft0 = int(np.ceil(self.t0 * self.frame_rate))
+        ftr = int(np.ceil(self.tr * self.frame_rate))
+        total_frames = ft0 + self.fpv * self.channels + ftr
+
+        if total_frames % self.channels:
+            extra_frames = self.channels - (total_frames % self.channels)
+            ftr += extra_frames
+            total_frames += extra_frames
+
+        return ft0, ftr, total_frames
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ScanSpec is immutable (use replace)')
+
+    def __eq__(self, other):
+        return isinstance(other, ScanSpec) and (self.key() == other.key())
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return 'ScanSpec(%s)' % ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.FIELDS)
+
+
+class ScanProfile:
+    '''
+    A compiled scan (returned by `compile_scan`).  The arrays are shared by
+    every user of the cache, so they are read only.
+
+    Attributes
+    ----------
+    spec : ScanSpec
+    sample_rate : float
+        The requested output rate, in Hz.
+    actual_rate : float
+        The rate the device will actually output, in Hz (see
+        `ADSync.actual_rate`).
+    actual_frame_rate : float
+        The resulting camera frame rate, in Hz.
+    dig : uint16 array
+        The digital output of each sample.
+    ana : float array
+        The analog output of each sample, normalized to -1 to 1 (see
+        `analog_scale`).
+    addr, count : int
+        The address range of the output cycle, if written with `write_ad`.
+    oversample : int
+        The number of samples per frame.
+    analog_scale : float
+        The peak amplitude of the ramp before it was normalized; the analog
+        scale sent to the device should be multiplied by this.
+    double_pulse_ignored : bool
+        True if double pulses were requested, but the frames are too short
+        for them.
+    volume_rate : float
+        The number of volumes per second (at the requested frame rate).
+    duty_cycle : float
+        The fraction of frames in each cycle which are active.
+    '''
+    def __init__(self, spec, sample_rate, dig, ana, oversample, analog_scale,
+                 double_pulse_ignored, actual_rate):
+        ft0, ftr, total_frames = spec.frames()
+        self.spec = spec
+        self.sample_rate = sample_rate
+        self.actual_rate = actual_rate
+        self.actual_frame_rate = actual_rate / oversample
+        self.dig = dig
+        self.ana = ana
+        self.addr = 0
+        self.count = len(dig)
+        self.oversample = oversample
+        self.analog_scale = analog_scale
+        self.double_pulse_ignored = double_pulse_ignored
+        self.volume_rate = spec.frame_rate / total_frames
+        self.duty_cycle = spec.fpv * spec.channels / total_frames
+
+        for x in (self.dig, self.ana):
+            x.flags.writeable = False
+        self._sync_data = None
+
+    def sync_data(self):
+        "The data written to the sync memory (see `ADSync.write_ad`)."
+        if self._sync_data is None:
+            self._sync_data = ADSync._ad_data(self.dig, self.ana)
+            self._sync_data.flags.writeable = False
+        return self._sync_data
+
+    def upload(self, sync, progress=None, slot=None):
+        '''
+        Set up the device to output the scan (see `upload_data`).
+
+        Parameters
+        ----------
+        sync : ADSync
+            The device.
+
+        Keywords
+        --------
+        progress : function (default: None)
+            Progress callback (see `ADSync.update`).
+        slot : hashable (default: None)
+            If specified, the name of a memory slot to load the scan into
+            (see `upload_data`).
+
+        Returns
+        -------
+        start : int
+            The first address of the output cycle.
+        '''
+        return upload_data(sync, self.sync_data(), self.sample_rate,
+                           self.addr, progress=progress, slot=slot)
+
+
+def upload_data(sync, data, sample_rate, addr=0, crc=None, progress=None,
+                slot=None):
+    '''
+    Set up the device to output a scan: the rate, trigger mask and sync
+    data.  If the device is already outputting the same data (checked with
+    `SYNC CRC`, firmware 1.4 or later), nothing is written.  Otherwise, only
+    the samples which differ from the last upload are sent.  If possible
+    (firmware 1.5 or later, and a profile which fits in a bank), the data is
+    written to the bank which isn't being output and swapped in, so the scan
+    doesn't stop; if not, the output is stopped first and the data is
+    written at `addr`.  (The analog scale and output state are left to the
+    caller.)
+
+    If `slot` is specified, the data is instead loaded into that named slot
+    of the memory (see `ADSync.upload_slot`; this is skipped if the slot
+    already holds it) and selected, so several scans can be kept on the
+    device and switched between with `ADSync.select`.
+
+    Parameters
+    ----------
+    sync : ADSync
+        The device.
+    data : uint32 array
+        The sync data (see `ScanProfile.sync_data`).
+    sample_rate : float
+        The output rate, in Hz.
+
+    Keywords
+    --------
+    addr : int (default: 0)
+        The address to write to, if the output is stopped.
+    crc : int (default: computed from data)
+        The `zlib.crc32` of the data.
+    progress : function (default: None)
+        Progress callback (see `ADSync.update`).
+    slot : hashable (default: None)
+        The name of the memory slot to use.
+
+    Returns
+    -------
+    start : int
+        The first address of the output cycle.
+    '''
+    if slot is not None:
+        start = sync.upload_slot(slot, data, rate=sample_rate,
+                                 progress=progress)
+        sync.trigger_mask(1 << 3)
+        sync.select(slot)
+        return start
+
+    count = len(data)
+    if sync.firmware_version >= (1, 4):
+        state = sync.state()
+        start = int(state['sync_start'])
+        if ((int(state['sync_cycles']) == count)
+                and (start + count <= sync.MAX_ADDR)):
+            if crc is None:
+                crc = zlib.crc32(np.ascontiguousarray(data, dtype='<u4'))
+            if sync.crc(start, count) == crc:
+                sync.rate(sample_rate)
+                sync.trigger_mask(1 << 3)
+                return start
+
+    live = (sync.firmware_version >= (1, 5) and count <= sync.BANK_SIZE)
+    if not live:
+        sync.stop()
+    sync.rate(sample_rate)
+    sync.trigger_mask(1 << 3)
+    if live:
+        return sync.update_bank(data, progress=progress)
+
+    sync.update(addr, data, progress=progress)
+    # Skipped samples are only correct if the device memory matches the host
+    #   copy; if not, the mismatched parts are resent
+    if (sync.firmware_version >= (1, 4)
+            and not sync.check_shadow(addr, count)):
+        sync.update(addr, data)
+    sync.addr(addr, count)
+    return addr
+
+
+def plan_scan(spec):
+    '''
+    Choose the number of samples per frame and the output rate for a scan.
+
+    If `spec.max_error` is None, the frames are sampled as finely as the rate
+    and memory allow.  Otherwise this finds the smallest profile whose frame
+    rate is within `max_error` (relative) of `spec.frame_rate`, using the
+    exact rate the device outputs (see `ADSync.actual_rate`); for each number
+    of samples per frame, the requests 1 mHz either side of the nominal rate
+    are also tried, in case they quantize more closely.  At least
+    `MIN_OVERSAMPLE` samples per frame are used, or 4 if double pulses are
+    requested (unless the frames are too short for them anyway).
+
+    Parameters
+    ----------
+    spec : ScanSpec
+
+    Returns
+    -------
+    oversample : int
+        The number of samples per frame.
+    sample_rate : float
+        The output rate to request, in Hz.
+    actual_rate : float
+        The rate the device will output, in Hz.
+    '''
+    ft0, ftr, total_frames = spec.frames()
+    frame_rate = spec.frame_rate
+
+    # As many samples per frame as the rate and memory allow
+    oversample1 = int(ADSync.FREQ_MAX // frame_rate)
+    oversample2 = int(ADSync.MAX_ADDR // total_frames)
+    max_oversample = min(oversample1, oversample2)
+    if max_oversample < 1:
+        raise ValueError('scan is too long or too fast for the device')
+
+    if spec.max_error is None:
+        sample_rate = frame_rate * max_oversample
+        return (max_oversample, sample_rate,
+                ADSync.actual_rate(sample_rate))
+
+    # The second pulse is 2 samples after the first, so it needs room
+    min_oversample = 4 if any(spec.double_pulse) else MIN_OVERSAMPLE
+    min_oversample = min(min_oversample, max_oversample)
+
+    best = None
+    for oversample in range(min_oversample, max_oversample + 1):
+        nominal = frame_rate * oversample
+        for sample_rate in (nominal, nominal - 1E-3, nominal + 1E-3):
+            actual_rate = ADSync.actual_rate(sample_rate)
+            error = abs(actual_rate / oversample - frame_rate) / frame_rate
+            if (best is None) or error < best[0]:
+                best = (error, oversample, sample_rate, actual_rate)
+        if best[0] <= spec.max_error:
+            return best[1:]
+
+    raise ValueError('no sample rate gives a frame rate within %g of %.9g '
+                     'Hz (the closest is %.9g Hz)'
+                     % (spec.max_error, frame_rate, best[3] / best[1]))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile_scan(spec):
+    '''
+    Compile a scan into the data for the synchronizer.  The results are
+    cached, so compiling the same spec again returns the same profile.
+
+    Parameters
+    ----------
+    spec : ScanSpec
+
+    Returns
+    -------
+    profile : ScanProfile
+    '''
+    ft0, ftr, total_frames = spec.frames()
+    frame_rate, fpv, channels = spec.frame_rate, spec.fpv, spec.channels
+    if fpv < 1:
+        raise ValueError('scan should have at least one frame per volume')
+
+    oversample, sample_rate, actual_rate = plan_scan(spec)
+
+    samples = total_frames * oversample
+    dig = np.zeros(samples, dtype='u2')
+
+    if spec.continuous:
+        camera_pulses = np.arange(total_frames) * oversample
+    else:
+        camera_pulses = (ft0 + np.arange(fpv*channels)) * oversample
+
+    dig[camera_pulses] += 1 << 0 # Channel 0 is camera
+    dig[camera_pulses] += 1 << 8 # Channel 8 is camera in align mode
+
+    laser_pulses = np.arange(0, total_frames, channels) * oversample
+    i0 = ft0 * oversample # sample # of first laser pulse in scan
+    i1 = i0 + (fpv - 1) * channels * oversample # sample # of last laser pulse in scan
+    im = (i0 + i1) // 2 # Mid point; may not align with frame, but thats ok
+    align_pulses = np.array([i0, im, i1], dtype='i')
+
+    # The second pulse is 2 samples after the first, so it needs room
+    if oversample > 3:
+        double_pulses = spec.double_pulse
+        double_pulse_ignored = False
+    else:
+        double_pulses = (False, False)
+        double_pulse_ignored = any(spec.double_pulse)
+
+    for i in range(channels):
+        dig[laser_pulses + i*oversample] += 1 << (i+1) # Channel i+1 is laser i+1
+        if double_pulses[i]:
+            dig[laser_pulses + i*oversample + 2] += 1 << (i+1)
+        dig[align_pulses + i*oversample] += 1 << (i+9) # Channel (i+1) in swap mode (alignment)
+
+    t_a = (np.arange(samples) - 0.5) / sample_rate + spec.galvo_delay
+
+    analog = SmoothRamp(t0=ft0, ts=fpv*channels, tr=ftr)(t_a * frame_rate)
+    analog_scale = abs(analog).max()
+    analog /= analog_scale
+
+    dig[ft0 * oversample] += 1 << 3 # Volume start signal (triggered)
+    dig[ft0 * oversample] += 1 << 11 # Volume start signal in alignment mode
+    dig[ft0 * oversample] += 1 << 4 # Volume start signal (not triggered)
+    dig[ft0 * oversample] += 1 << 12 # Volume start signal in alignment mode
+
+    if spec.flipped:
+        analog *= -1
+
+    return ScanProfile(spec, sample_rate, dig, analog, oversample,
+                       analog_scale, double_pulse_ignored, actual_rate)
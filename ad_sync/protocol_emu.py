@@ -0,0 +1,5 @@
+"""
+pyserial URL handler for "emu://" ports; see `ad_sync.emulator`.
+"""
+
+from .emulator import Serial
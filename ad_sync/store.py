@@ -0,0 +1,239 @@
+"""
+A persistent on-disk cache of compiled scan profiles.
+
+Acquisition scripts which cycle through a fixed set of scan configurations
+can keep the compiled sync data between runs, instead of recompiling each
+one every time:
+
+    store = ProfileStore()
+    profile = store.compile(ScanSpec.from_settings(json.load(f)))
+    profile.upload(sync)
+
+Each profile is saved as a `.npy` file of sync data (which is loaded memory
+mapped) and a `.json` file of everything else, named by a hash of the scan
+spec.  The store is limited in size; the least recently used profiles are
+deleted to make room.
+
+The CRC of the data is stored with it, so if the device is already outputting
+a profile, `upload` finds this with one `SYNC CRC` command and doesn't touch
+the data at all.
+"""
+
+import hashlib
+import json
+import os
+import zlib
+import numpy as np
+from .profile import ScanSpec, compile_scan, upload_data
+
+# Changing this invalidates all of the stored profiles; it should be
+#   incremented whenever compile_scan changes its output.
+STORE_VERSION = 2
+
+
+def default_path():
+    "The default location of the store: `ad_sync/profiles` in the user cache."
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'ad_sync', 'profiles')
+
+
+class StoredProfile:
+    '''
+    A compiled scan profile loaded from a `ProfileStore`.  This has the same
+    attributes as `ad_sync.profile.ScanProfile`, except for the digital and
+    analog arrays (use `sync_data`), plus:
+
+    Attributes
+    ----------
+    key : str
+        The hash of the scan spec, which names the files.
+    crc : int
+        The `zlib.crc32` of the sync data.
+    '''
+    def __init__(self, path, key):
+        self.key = key
+        self.path = os.path.join(path, key)
+        with open(self.path + '.json', 'r') as f:
+            meta = json.load(f)
+
+        self.spec = ScanSpec(**meta.pop('spec'))
+        for name, value in meta.items():
+            setattr(self, name, value)
+        self._sync_data = None
+
+    def sync_data(self):
+        "The data written to the sync memory, as a read only memory map."
+        if self._sync_data is None:
+            self._sync_data = np.load(self.path + '.npy', mmap_mode='r')
+        return self._sync_data
+
+    def upload(self, sync, progress=None, slot=None):
+        '''
+        Set up the device to output the scan, optionally in a named memory
+        slot (see `ad_sync.profile.upload_data`).
+
+        Returns
+        -------
+        start : int
+            The first address of the output cycle.
+        '''
+        return upload_data(sync, self.sync_data(), self.sample_rate,
+                           self.addr, crc=self.crc, progress=progress,
+                           slot=slot)
+
+
+class ProfileStore:
+    '''
+    A directory of compiled scan profiles.
+
+    Keywords
+    --------
+    path : str (default: see `default_path`)
+        The directory, which is created if needed.
+    max_bytes : int (default: 64 MB)
+        The maximum total size of the stored files.  When this is exceeded,
+        the least recently used profiles are deleted.
+    '''
+    # The metadata saved with each profile (apart from the spec)
+    META = ('sample_rate', 'actual_rate', 'actual_frame_rate', 'addr',
+            'count', 'oversample', 'analog_scale', 'double_pulse_ignored',
+            'volume_rate', 'duty_cycle')
+
+    def __init__(self, path=None, max_bytes=64 << 20):
+        self.path = default_path() if path is None else path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def _spec(spec):
+        # Accept the settings saved by the GUI in place of a spec
+        if isinstance(spec, dict):
+            return ScanSpec.from_settings(spec)
+        return spec
+
+    def key(self, spec):
+        '''
+        The hash of a scan spec (or of the scan settings saved by the GUI,
+        which are converted with `ScanSpec.from_settings`, so that unrelated
+        settings don't change the hash).
+        '''
+        spec = self._spec(spec)
+        text = json.dumps([STORE_VERSION, list(spec.FIELDS), spec.key()])
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+    def load(self, spec):
+        '''
+        Load a stored profile.
+
+        Returns
+        -------
+        profile : StoredProfile, or None if it isn't stored.
+        '''
+        key = self.key(spec)
+        fn = os.path.join(self.path, key)
+        if not (os.path.exists(fn + '.json') and os.path.exists(fn + '.npy')):
+            return None
+
+        try:
+            profile = StoredProfile(self.path, key)
+        except (OSError, ValueError, TypeError, KeyError):
+            # Damaged (or from an incompatible version); it will be replaced
+            return None
+
+        # The modification time marks the use, for the eviction order
+        for ext in ('.json', '.npy'):
+            os.utime(fn + ext)
+        return profile
+
+    def save(self, profile):
+        '''
+        Save a compiled profile (from `ad_sync.profile.compile_scan`), and
+        delete old profiles if the store is too big.
+
+        Returns
+        -------
+        profile : StoredProfile
+        '''
+        key = self.key(profile.spec)
+        data = np.ascontiguousarray(profile.sync_data(), dtype='<u4')
+        meta = {name: getattr(profile, name) for name in self.META}
+        meta['sample_rate'] = float(meta['sample_rate'])
+        meta['analog_scale'] = float(meta['analog_scale'])
+        meta['crc'] = zlib.crc32(data)
+        meta['spec'] = dict(zip(profile.spec.FIELDS, profile.spec.key()))
+
+        # Written under temporary names and then renamed, so that a partly
+        #   written profile is never loaded
+        fn = os.path.join(self.path, key)
+        with open(fn + '.npy.tmp', 'wb') as f:
+            np.save(f, data)
+        with open(fn + '.json.tmp', 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(fn + '.npy.tmp', fn + '.npy')
+        os.replace(fn + '.json.tmp', fn + '.json')
+
+        self.evict(keep=key)
+        return StoredProfile(self.path, key)
+
+    def compile(self, spec):
+        '''
+        Load a profile if it is stored, otherwise compile it (see
+        `ad_sync.profile.compile_scan`) and store it.
+
+        Parameters
+        ----------
+        spec : ScanSpec, or dict of the scan settings saved by the GUI
+
+        Returns
+        -------
+        profile : StoredProfile
+        '''
+        profile = self.load(spec)
+        if profile is None:
+            profile = self.save(compile_scan(self._spec(spec)))
+        return profile
+
+    def _entries(self):
+        # {key: (last use, total bytes)} of the stored profiles
+        entries = {}
+        for fn in os.listdir(self.path):
+            key, ext = os.path.splitext(fn)
+            if ext not in ('.json', '.npy'):
+                continue
+            st = os.stat(os.path.join(self.path, fn))
+            used, size = entries.get(key, (0, 0))
+            entries[key] = (max(used, st.st_mtime), size + st.st_size)
+        return entries
+
+    def size(self):
+        "The total size of the stored profiles, in bytes."
+        return sum(size for used, size in self._entries().values())
+
+    def evict(self, keep=None):
+        '''
+        Delete the least recently used profiles until the store fits in
+        `max_bytes`.  The profile named by `keep` is never deleted.
+        '''
+        entries = self._entries()
+        total = sum(size for used, size in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][0]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= entries[key][1]
+
+    def remove(self, key):
+        "Delete a stored profile, by key."
+        for ext in ('.json', '.npy'):
+            try:
+                os.remove(os.path.join(self.path, key + ext))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        "Delete all of the stored profiles."
+        for key in self._entries():
+            self.remove(key)
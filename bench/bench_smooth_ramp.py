@@ -0,0 +1,100 @@
+"""
+Benchmark of `SmoothRamp` evaluation.
+
+Checks that `SmoothRamp.__call__` matches the original sort based
+implementation (`reference_ramp`, below) for every derivative, and times
+both.  Run with:
+
+    python bench/bench_smooth_ramp.py [samples ...]
+
+(This uses the package in this tree, even if it isn't installed.)
+
+The default sizes are 10^6, 10^7 and 10^8 samples.  (The reference needs
+about 6 GB of memory at 10^8 samples; pass smaller sizes if that is too
+much.)
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ad_sync import SmoothRamp
+
+
+def reference_ramp(ramp, t, d=0):
+    # SmoothRamp.__call__ before it was rewritten to use searchsorted
+    dt = (np.asarray(t) % ramp.T)
+    sort = np.argsort(dt)
+    unsort = np.argsort(sort)
+    t = dt[sort]
+    x = np.zeros_like(dt)
+    i0 = 0
+
+    for (dt, x0, v, a, j) in ramp.profile:
+        try:
+            i1 = np.where(t > dt)[0][0]
+        except:
+            i1 = len(t)
+        tt = t[i0:i1]
+        if d == 0:
+            x[i0:i1] = x0 + v*tt + (a/2)*tt**2 + (j/6) * tt**3
+        elif d == 1:
+            x[i0:i1] = v + a*tt + (j/2)*tt**2
+        elif d == 2:
+            x[i0:i1] = a + j*tt
+        elif d == 3:
+            x[i0:i1] = j
+        else:
+            raise ValueError('derivative (d) should be 0--3')
+
+        t -= dt
+        i0 = i1
+
+    return np.array(x[unsort])
+
+
+def timed(func, repeat=3):
+    # Best of several runs, in seconds
+    best = np.inf
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+# The ramp used by the GUI for a typical scan
+ramp = SmoothRamp(t0=0.02, ts=16, tr=2)
+
+# Correctness: random times over several periods, so that the input is
+#   unsorted, plus the exact stage boundaries
+rng = np.random.default_rng(0)
+t = rng.uniform(-ramp.T, 3 * ramp.T, 100000)
+t = np.concatenate([t, ramp._ends, ramp._starts])
+for d in range(4):
+    expected = reference_ramp(ramp, t, d)
+    scale = np.abs(expected).max()
+    for dtype, tol in (('f8', 1E-9), ('f4', 1E-4)):
+        x = ramp(t.astype(dtype), d)
+        err = np.abs(x - expected).max() / scale
+        print("d=%d, %s: max relative error %.1e" % (d, dtype, err))
+        if err > tol:
+            raise ValueError("SmoothRamp doesn't match the reference!")
+
+sizes = [int(float(n)) for n in sys.argv[1:]] or [10**6, 10**7, 10**8]
+print()
+print("%10s %12s %12s %12s %8s" %
+      ("samples", "reference", "SmoothRamp", "float32+out", "speedup"))
+for n in sizes:
+    # Sample times as used by the GUI: a regular grid over many periods
+    t = np.arange(n) * (5 * ramp.T / n)
+    t32 = t.astype('f4')
+    out = np.empty(n, dtype='f4')
+    ref, x_ref = timed(lambda: reference_ramp(ramp, t), 1)
+    new, x = timed(lambda: ramp(t))
+    new32, x32 = timed(lambda: ramp(t32, out=out))
+    print("%10d %10.3f s %10.3f s %10.3f s %7.1fx" %
+          (n, ref, new, new32, ref / new))
+    del x_ref, x, x32
@@ -0,0 +1,219 @@
+// Host benchmark of the update_sync inner loop (fill.h).
+//
+// Checks that the specialized loops, and copying from the pre-rendered cache
+//   ("SYNC CACHE"), produce exactly the same output as the original
+//   per-sample loop (reference_fill, below), for every mode, and times them.  Build and run from the firmware directory with:
+//
+//     g++ -O2 -Iinclude bench/bench_fill.cpp -o bench_fill && ./bench_fill
+//
+// Note that the timings are for the host CPU, not the ESP32; only the ratios
+//   are meaningful.
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <chrono>
+#include "fill.h"
+
+// These must match main.h
+#define SYNC_DATA_SIZE 16384
+#define I2S_WRITE_BUFFER_SIZE 64
+
+static uint32_t sync_data[SYNC_DATA_SIZE];
+
+struct Settings {
+    int start, cycles, analog_mode, digital_mode;
+    uint32_t multiplier[2], offset[2], trigger_mask, ana0_set;
+    int triggered;
+};
+
+// The per-sample loop from update_sync before it was specialized.  (The
+//   trigger state and settings are fixed here, so cycle boundaries only reset
+//   the address.)
+static void reference_fill(uint64_t *buffer, const Settings &s, int &sync_i, int &sync_end) {
+    for (int i=0; i<I2S_WRITE_BUFFER_SIZE; i++) {
+        uint32_t data = sync_data[sync_i];
+        uint32_t ad = (data & 0xFFFF);
+        if (s.analog_mode == 0) {
+            ad = (DAC_SPI_CH0 + s.ana0_set);
+        } else {
+            int channel = 0;
+            if (s.analog_mode == 3) {channel = sync_i%2;}
+            else {channel = s.analog_mode - 1;}
+
+            if (channel == 0) {
+                uint32_t a = ((ad * s.multiplier[0]) >> 16) + s.offset[0];
+                ad = (a < 65535 ? a : 65535) + DAC_SPI_CH0;
+            } else {
+                uint32_t a = ((ad * s.multiplier[1]) >> 16) + s.offset[1];
+                ad = (a < 65535 ? a : 65535) + DAC_SPI_CH1;
+            }
+        }
+
+        uint32_t dd = (data & 0xFFFF0000) >> 16;
+        if (!s.triggered) {dd &= ~s.trigger_mask;}
+        if (s.digital_mode & 0b10) {dd = ((dd & 0xFF00) >> 8) + ((dd & 0x00FF) << 8);}
+        if (s.digital_mode & 0b01) {dd |= (data & 0xFF00) >> 8;}
+
+        buffer[i] = ((uint64_t)(dd) << 40) + (ad<<DAC_SHIFT);
+
+        sync_i = (sync_i + 1) % SYNC_DATA_SIZE;
+        if (sync_i == sync_end) {
+            sync_i = s.start;
+            sync_end = (s.start + s.cycles) % SYNC_DATA_SIZE;
+        }
+    }
+}
+
+// The buffer loop from update_sync, using fill.h
+static void specialized_fill(uint64_t *buffer, const Settings &s, int &sync_i, int &sync_end) {
+    FillParams p;
+    for (int c=0; c<2; c++) {
+        p.multiplier[c] = s.multiplier[c];
+        p.offset[c] = s.offset[c];
+    }
+    p.digital_mask = s.triggered ? 0xFFFFFFFF : ~s.trigger_mask;
+    p.fixed = DAC_SPI_CH0 + s.ana0_set;
+    FillFunc fill = FILL_FUNCS[s.analog_mode & 0b11][s.digital_mode & 0b11];
+
+    int i = 0;
+    while (i < I2S_WRITE_BUFFER_SIZE) {
+        int n = (sync_end > sync_i) ? (sync_end - sync_i) : (SYNC_DATA_SIZE - sync_i);
+        if (n > I2S_WRITE_BUFFER_SIZE - i) {n = I2S_WRITE_BUFFER_SIZE - i;}
+
+        fill(buffer + i, sync_data + sync_i, n, sync_i & 1, p);
+        i += n;
+        sync_i += n;
+        if (sync_i == SYNC_DATA_SIZE) {sync_i = 0;}
+
+        if (sync_i == sync_end) {
+            sync_i = s.start;
+            sync_end = (s.start + s.cycles) % SYNC_DATA_SIZE;
+        }
+    }
+}
+
+// Pre-rendered cycle, as in update_cache (for the untriggered or triggered
+//   state of the settings it was rendered for)
+static uint64_t cache_words[SYNC_DATA_SIZE];
+
+static void render_cache(const Settings &s) {
+    FillParams p;
+    for (int c=0; c<2; c++) {
+        p.multiplier[c] = s.multiplier[c];
+        p.offset[c] = s.offset[c];
+    }
+    p.digital_mask = s.triggered ? 0xFFFFFFFF : ~s.trigger_mask;
+    p.fixed = DAC_SPI_CH0 + s.ana0_set;
+    FillFunc fill = FILL_FUNCS[s.analog_mode & 0b11][s.digital_mode & 0b11];
+
+    int period = s.cycles % SYNC_DATA_SIZE;
+    if (!period) {period = SYNC_DATA_SIZE;}
+    int n1 = (period < SYNC_DATA_SIZE - s.start) ? period : (SYNC_DATA_SIZE - s.start);
+    fill(cache_words, sync_data + s.start, n1, s.start & 1, p);
+    if (period > n1) {fill(cache_words + n1, sync_data, period - n1, 0, p);}
+}
+
+// The buffer loop from update_sync, when the cache is ready
+static void cached_fill(uint64_t *buffer, const Settings &s, int &sync_i, int &sync_end) {
+    int i = 0;
+    while (i < I2S_WRITE_BUFFER_SIZE) {
+        int n = (sync_end > sync_i) ? (sync_end - sync_i) : (SYNC_DATA_SIZE - sync_i);
+        if (n > I2S_WRITE_BUFFER_SIZE - i) {n = I2S_WRITE_BUFFER_SIZE - i;}
+
+        int j = sync_i - s.start;
+        if (j < 0) {j += SYNC_DATA_SIZE;}
+        memcpy(buffer + i, cache_words + j, n * sizeof(uint64_t));
+        i += n;
+        sync_i += n;
+        if (sync_i == SYNC_DATA_SIZE) {sync_i = 0;}
+
+        if (sync_i == sync_end) {
+            sync_i = s.start;
+            sync_end = (s.start + s.cycles) % SYNC_DATA_SIZE;
+        }
+    }
+}
+
+typedef void (*BufferFunc)(uint64_t *buffer, const Settings &s, int &sync_i, int &sync_end);
+
+static Settings random_settings(int analog_mode, int digital_mode) {
+    Settings s;
+    s.start = rand() % SYNC_DATA_SIZE;
+    s.cycles = rand() % 4 ? (rand() % 3000) + 1 : 0;
+    s.analog_mode = analog_mode;
+    s.digital_mode = digital_mode;
+    for (int c=0; c<2; c++) {
+        s.multiplier[c] = rand() % (1 << 17);
+        s.offset[c] = rand() % 65536;
+    }
+    s.trigger_mask = rand() & 0xFFFF;
+    s.ana0_set = rand() & 0xFFFF;
+    s.triggered = rand() % 2;
+    return s;
+}
+
+static int check(int analog_mode, int digital_mode) {
+    uint64_t a[I2S_WRITE_BUFFER_SIZE], b[I2S_WRITE_BUFFER_SIZE], c[I2S_WRITE_BUFFER_SIZE];
+    for (int trial=0; trial<200; trial++) {
+        Settings s = random_settings(analog_mode, digital_mode);
+        render_cache(s);
+        int ia = s.start, ib = s.start, ic = s.start;
+        int ea = (s.start + s.cycles) % SYNC_DATA_SIZE, eb = ea, ec = ea;
+        for (int n=0; n<300; n++) {
+            reference_fill(a, s, ia, ea);
+            specialized_fill(b, s, ib, eb);
+            cached_fill(c, s, ic, ec);
+            if (memcmp(a, b, sizeof(a)) || memcmp(a, c, sizeof(a))
+                    || (ia != ib) || (ea != eb) || (ia != ic) || (ea != ec)) {
+                printf("MISMATCH: analog mode %d, digital mode %d (start %d, cycles %d)\n",
+                       analog_mode, digital_mode, s.start, s.cycles);
+                return 1;
+            }
+        }
+    }
+    return 0;
+}
+
+// Average time per buffer, in ns
+static double time_fill(BufferFunc func, const Settings &s) {
+    static uint64_t buffer[I2S_WRITE_BUFFER_SIZE];
+    const int n = 200000;
+    int sync_i = s.start, sync_end = (s.start + s.cycles) % SYNC_DATA_SIZE;
+    auto t0 = std::chrono::steady_clock::now();
+    for (int i=0; i<n; i++) {
+        func(buffer, s, sync_i, sync_end);
+        // Stop the compiler from optimizing away the work
+        asm volatile("" : : "r"(buffer) : "memory");
+    }
+    auto t1 = std::chrono::steady_clock::now();
+    return std::chrono::duration<double, std::nano>(t1 - t0).count() / n;
+}
+
+int main() {
+    srand(1);
+    for (int i=0; i<SYNC_DATA_SIZE; i++) {sync_data[i] = ((uint32_t)rand() << 16) ^ rand();}
+
+    int failed = 0;
+    printf("Time per buffer (ns)\n");
+    printf("mode   reference   specialized   cached   speedup (specialized, cached)\n");
+    for (int analog_mode=0; analog_mode<4; analog_mode++) {
+        for (int digital_mode=0; digital_mode<4; digital_mode++) {
+            failed |= check(analog_mode, digital_mode);
+
+            Settings s = random_settings(analog_mode, digital_mode);
+            s.start = 0;
+            s.cycles = 1000;
+            render_cache(s);
+            double t_ref = time_fill(reference_fill, s);
+            double t_spec = time_fill(specialized_fill, s);
+            double t_cache = time_fill(cached_fill, s);
+            printf("%d %d    %9.1f     %9.1f   %6.1f     %5.2fx, %5.2fx\n",
+                   analog_mode, digital_mode, t_ref, t_spec, t_cache,
+                   t_ref / t_spec, t_ref / t_cache);
+        }
+    }
+
+    printf(failed ? "FAILED: outputs differ!\n" : "All outputs match.\n");
+    return failed;
+}
@@ -1,4 +1,7 @@
 #include "main.h"
+#include "pack.h"
+#include "crc.h"
+#include "perf.h"
 
 #if !defined(COMMANDS_H)
 
@@ -9,7 +12,7 @@ enum CHAR_TYPES : int {WHITESPACE, EOL, ALPHA, DIGIT, BINSTART};
 
 // States of the input character processor
 enum CMD_CYCLES : int {IDLE, READ_WORD, READ_INT, READ_BIN, READ_BIN_LEN, CMD_ERROR};
-enum BIN_WRITE_TARGETS : int {TARGET_NONE, TARGET_SYNC_DATA, TARGET_SERIAL1, TARGET_SERIAL2, TARGET_BT_NAME};
+enum BIN_WRITE_TARGETS : int {TARGET_NONE, TARGET_SYNC_DATA, TARGET_SERIAL1, TARGET_SERIAL2, TARGET_BT_NAME, TARGET_SYNC_PACKED, TARGET_TRIGGER_PROG};
 
 // Constants for the different commands
 // The commands each has a 1 byte code, determined here.
@@ -17,6 +20,7 @@ enum BIN_WRITE_TARGETS : int {TARGET_NONE, TARGET_SYNC_DATA, TARGET_SERIAL1, TAR
 enum CMD_NAMES : uint8_t {
     CMD_NONE, SYNC, READ, WRITE, ADDR, START, STOP, COUNT, RATE, ANA0, ANA1, SER1, SER2,
     TRIGGER, MASK, AVAIL, FLUSH, LED, CMD_ON, CMD_OFF, STAT, SET, SCALE, MODE, IDN, BLUETOOTH,
+    PACK, ACTIVE, DUMP, CRC, SWAP, STAGE, COMMIT, CACHE, DMA, AUTO, PERF, PROG, AT,
     CMD_INVALID //NOTE: If you add commands, CMD_INVALID MUST be LAST!
 };
 
@@ -53,6 +57,19 @@ static const uint32_t CMD_WORDS[NUM_CMD] = {
     CMD_UINT("MODE"),
     CMD_UINT("*IDN"),
     CMD_UINT("BLUE"),
+    CMD_UINT("PACK"),
+    CMD_UINT("ACTI"),
+    CMD_UINT("DUMP"),
+    CMD_UINT("\0CRC"),
+    CMD_UINT("SWAP"),
+    CMD_UINT("STAG"),
+    CMD_UINT("COMM"),
+    CMD_UINT("CACH"),
+    CMD_UINT("\0DMA"),
+    CMD_UINT("AUTO"),
+    CMD_UINT("PERF"),
+    CMD_UINT("PROG"),
+    CMD_UINT("\0\0AT"),
 };
 
 // Routines for packing command words into a command "sentence"
@@ -80,6 +97,7 @@ enum CMD_ERRORS : int {
     ERR_WRONG_NUM_ARGS1,
     ERR_WRONG_NUM_ARGS2,
     ERR_BT_NAME_TOO_LONG,
+    ERR_INVALID_PACKED_DATA,
 };
 
 // Error outputs for each type.
@@ -97,11 +115,61 @@ static const char* ERROR_STR[] = {
     "missing argument",
     "wrong number of arguments (should be 1)",
     "wrong number of arguments (should be 2)",
-    "bluetooth name too long (64 chars max)"
+    "bluetooth name too long (64 chars max)",
+    "invalid packed data"
 };
 
 #define STR_BUF_LEN 65
 
+// SYNC CRC processes this many bytes between updates of the sync output
+#define CRC_BLOCK_SIZE 1024
+
+// The reply to "SYNC DUMP": a snapshot of all the settings and status, sent
+//   as binary data.  This MUST match SYNC_STATE in "ad_sync/firmware.py"!
+//   (New fields should only be added at the end.)
+struct __attribute__((packed)) SyncState {
+    uint32_t sync_start;
+    uint32_t sync_cycles;
+    float sync_rate;
+    uint32_t ana_multiplier[2];
+    uint32_t ana_offset[2];
+    uint32_t trigger_mask;
+    int32_t trigger_count;
+    uint32_t buffer_update_time; // us
+    uint32_t last_update_age; // us since the last buffer update
+    uint32_t last_bytes_written;
+    uint16_t ana_set[2];
+    uint16_t ser_fill[4]; // ser1_input, ser1_output, ser2_input, ser2_output
+    uint8_t analog_sync_mode;
+    uint8_t digital_sync_mode;
+    uint8_t sync_active;
+    uint8_t led[3];
+    uint8_t ser_overflow; // Bit flags, in the same order as ser_fill
+    uint8_t settings_pending; // Changed settings are waiting for the end of the cycle
+    uint32_t buffer_update_time_max; // us, since the last SYNC STAT
+    uint8_t cache; // Bit 0: SYNC CACHE is on, bit 1: the cache is in use
+    uint32_t underruns;
+    uint16_t dma_buf_count;
+    uint16_t dma_buf_len; // samples
+    uint8_t dma_auto;
+    uint32_t cycle_count; // sync_cycle_count
+    uint8_t trigger_prog; // Bit 0: a trigger program is running, bit 1: a TRIGGER AT is pending
+};
+
+// The reply to "SYNC PERF".  The histograms cover the time since the last
+//   "SYNC PERF"; the counters are totals since the device was reset.  This
+//   MUST match SYNC_PERF in "ad_sync/firmware.py"!
+struct __attribute__((packed)) PerfStats {
+    uint32_t interval; // us since the last SYNC PERF
+    uint32_t underruns;
+    uint32_t slowest_command; // Command code of the longest command
+    PerfHist buffer_update; // Time to compute each output buffer
+    PerfHist buffer_interval; // Time between buffers handed to the DMA
+    PerfHist loop; // Time per pass of loop()
+    PerfHist command; // Time to execute each command
+    uint32_t ser_dropped[5]; // ser1_input, ser1_output, ser2_input, ser2_output, replies
+};
+
 // Command queue class
 class CommandQueue {
     private:
@@ -116,6 +184,7 @@ class CommandQueue {
         int bin_data_written;
         uint8_t *sync_ptr;
         uint8_t *sync_end;
+        PackDecoder unpacker;
 
         char str_buffer[STR_BUF_LEN];
 
@@ -127,6 +196,8 @@ class CommandQueue {
         int output_ok() {return output_buffer.write("ok.\n", 4);}
         int output_error();
         int output_float(float x);
+        int output_state();
+        int output_perf();
         void finish_word();
         void execute_command();
 
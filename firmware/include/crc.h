@@ -0,0 +1,11 @@
+#if !defined(CRC_H)
+
+#define CRC_H 1
+#include <stdint.h>
+
+// CRC-32 (the same as zlib/PNG/Ethernet), used by SYNC CRC.
+// To checksum data in pieces, start with crc = 0 and pass the result of each
+// call to the next one.
+uint32_t crc32_update(uint32_t crc, const uint8_t *data, int nbytes);
+
+#endif
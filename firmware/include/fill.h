@@ -0,0 +1,67 @@
+#if !defined(FILL_H)
+
+#define FILL_H 1
+#include <stdint.h>
+#include "dac.h"
+
+// The inner loop of update_sync, which converts sync data into I2S words.
+// There is a separate version of the loop for each combination of analog and
+//   digital mode, so that the mode checks are done once per run of samples
+//   instead of once per sample.  (This has no Arduino dependencies, so it can
+//   be benchmarked on the host; see firmware/bench.)
+
+// Output parameters which are constant for a run of samples
+struct FillParams {
+    uint32_t multiplier[2], offset[2];
+    uint32_t digital_mask; // ~trigger_mask if not triggered, otherwise all ones
+    uint32_t fixed; // DAC word for analog mode 0 (fixed output)
+};
+
+// Converts count samples of data into I2S words.  parity is the parity of the
+//   address of the first sample, which selects the channel in analog mode 3.
+typedef void (*FillFunc)(uint64_t *buffer, const uint32_t *data, int count, int parity, const FillParams &p);
+
+template <int ANALOG_MODE, int DIGITAL_MODE>
+void fill_samples(uint64_t *buffer, const uint32_t *data, int count, int parity, const FillParams &p) {
+    for (int i=0; i<count; i++) {
+        uint32_t x = data[i];
+        uint32_t ad;
+
+        if (ANALOG_MODE == 0) {
+            // We need to write something, so just update analog 0
+            ad = p.fixed;
+        } else {
+            // In dual output mode, the channel is chosen by address
+            int channel = (ANALOG_MODE == 3) ? ((i + parity) & 1) : (ANALOG_MODE - 1);
+            uint32_t a = (((x & 0xFFFF) * p.multiplier[channel]) >> 16) + p.offset[channel];
+            ad = (a < 65535 ? a : 65535) + (channel ? DAC_SPI_CH1 : DAC_SPI_CH0);
+        }
+
+        // Channels in the trigger mask are zeroed if not triggered
+        uint32_t dd = (x >> 16) & p.digital_mask;
+
+        // Swap mode
+        if (DIGITAL_MODE & 0b10) {
+            dd = ((dd & 0xFF00) >> 8) + ((dd & 0x00FF) << 8);
+        }
+
+        // OR output mode
+        if (DIGITAL_MODE & 0b01) {
+            dd |= (x & 0xFF00) >> 8;
+        }
+
+        // Bits 8-31 are analog output -- shift determined by global constant (DAC dependent)
+        // Bits 40-63 are digital output.
+        buffer[i] = ((uint64_t)(dd) << 40) + (ad << DAC_SHIFT);
+    }
+}
+
+// Indexed by [analog mode][digital mode & 0b11]
+static const FillFunc FILL_FUNCS[4][4] = {
+    {fill_samples<0, 0>, fill_samples<0, 1>, fill_samples<0, 2>, fill_samples<0, 3>},
+    {fill_samples<1, 0>, fill_samples<1, 1>, fill_samples<1, 2>, fill_samples<1, 3>},
+    {fill_samples<2, 0>, fill_samples<2, 1>, fill_samples<2, 2>, fill_samples<2, 3>},
+    {fill_samples<3, 0>, fill_samples<3, 1>, fill_samples<3, 2>, fill_samples<3, 3>},
+};
+
+#endif
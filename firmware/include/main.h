@@ -6,6 +6,8 @@
 // I2S config options
 #include "driver/i2s.h"
 
+#include "perf.h"
+
 // Is Bluetooth enabled at all?
 #define BLUETOOTH_ENABLED 1
 
@@ -16,6 +18,18 @@
     #endif
 #endif
 
+// Run the sync output in its own FreeRTOS task, on the core which loop()
+//   doesn't use, woken by the I2S driver whenever a DMA buffer has been sent.
+//   Its priority is below the Bluetooth controller, but above everything else.
+//   If not defined, the output is computed by update_sync, which loop() needs
+//   to call as often as possible.
+#define SYNC_TASK_ENABLED 1
+#define SYNC_TASK_CORE 0
+#define SYNC_TASK_PRIORITY (configMAX_PRIORITIES - 3)
+#define SYNC_TASK_STACK 4096
+#define SYNC_TASK_TIMEOUT_MS 10
+#define SYNC_EVENT_QUEUE_LEN 16
+
 // Maximum number of serial characters to process per command queue cycle.
 // #define MAX_SERIAL_CHAR_PER_CYCLE   16
 
@@ -25,7 +39,7 @@
 
 // Version numbers.
 #define VERSION_MAJOR 1
-#define VERSION_MINOR 0
+#define VERSION_MINOR 11
 
 
 // The output GPIO pin for a variety of functions
@@ -79,7 +93,7 @@ extern int startup_colors_active;
 // The size of various buffers.
 #define SER_BUFFER_SIZE 1024 // Used to buffer all inputs/outputs -- this is in addition to the built in serial buffer, which is 64 bytes.
 #define SYNC_DATA_SIZE  16384 // Sync data storage.  Larger sizes seem to result in memory errors.
-#define I2S_WRITE_BUFFER_SIZE 64 // Used to compute output values
+#define I2S_WRITE_BUFFER_SIZE 64 // Used to compute output values (default; see "SYNC DMA" below)
 
 
 // General purpose macros
@@ -99,6 +113,9 @@ extern uint16_t LED_LUT[256];
 
 void set_led_color(int r, int g, int b);
 
+// The current LED color (before gamma correction)
+extern int led_color[3];
+
 // I2S buffer used to write new samples
 // extern uint64_t i2s_write_buffer[I2S_WRITE_BUFFER_SIZE]; // Does not need to be global
 
@@ -108,9 +125,13 @@ extern uint32_t sync_data[SYNC_DATA_SIZE];
 // The start and length of the current cycle
 extern int sync_start, sync_cycles;
 
+
 // Is the sync output active?
 extern int sync_active;
 
+// The actual output rate, as returned by sync_freq
+extern float sync_rate;
+
 // Minimum and maximum frequency, set by the limits of the APLL clock
 #define MIN_FREQ 30
 #define MAX_FREQ 700000
@@ -118,6 +139,8 @@ extern int sync_active;
 // Used to compute "sync stat" output
 extern uint last_bytes_written, cycles_since_write;
 extern unsigned long buffer_update_time, last_sync_update;
+// The longest buffer update since the last "SYNC STAT"
+extern unsigned long buffer_update_time_max;
 
 // Analog default outputs when not in sync mode
 extern uint16_t ana0_set, ana1_set;
@@ -136,9 +159,93 @@ extern int digital_sync_mode;
 extern int trigger_count;
 extern uint32_t trigger_mask;
 
+// The number of the current output cycle: counts every cycle started since
+//   reset (and doesn't change while the output is stopped).  Triggers can be
+//   scheduled against this without depending on the host's timing.
+extern volatile uint32_t sync_cycle_count;
+
+// Trigger program ("TRIGGER PROG"): a list of entries which is run from
+//   "TRIGGER START".  Each entry waits delay cycles, and then triggers the
+//   next count cycles.  The first delay counts from the next cycle after
+//   "TRIGGER START" (if the output is stopped, the second cycle after "SYNC
+//   START", since the first is never triggered).
+#define TRIGGER_PROG_SIZE 256
+struct TriggerEntry {
+    uint32_t delay, count;
+};
+extern TriggerEntry trigger_prog[TRIGGER_PROG_SIZE];
+extern int trigger_prog_len;
+// trigger_prog_start is set by "TRIGGER START", and picked up by the output
+extern volatile int trigger_prog_start, trigger_prog_active, trigger_prog_entry;
+// A single trigger scheduled by "TRIGGER AT", for count cycles starting with
+//   cycle number trigger_at_cycle (or as soon as possible, if that is past)
+extern volatile int trigger_at_pending;
+extern uint32_t trigger_at_cycle, trigger_at_count;
+
+// The output settings above (address range, modes, analog scales and trigger
+//   mask) are staged: commands change these variables, and update_sync copies
+//   them into the output at the end of a cycle if settings_pending is set.
+//   While settings_hold is set ("SYNC STAGE"), changes are collected until
+//   "SYNC COMMIT", so that they take effect together (nothing is latched
+//   while it is set, even if a change from before "SYNC STAGE" is pending).
+extern volatile int settings_pending;
+extern volatile int settings_hold;
+
+// The output reads the settings from the other core, so they are guarded by
+//   a sequence lock: settings_seq is odd while a command is changing them.
+extern volatile uint32_t settings_seq;
+
+// Called by commands before and after changing an output setting
+void begin_settings();
+void stage_settings();
+
+// DMA buffer configuration ("SYNC DMA").  The I2S driver queues dma_buf_count
+//   buffers of dma_buf_len samples, and update_sync computes half a buffer at
+//   a time.  The queue is the headroom the main loop has before the output
+//   runs dry, so in auto mode it is sized to hold DMA_AUTO_TIME_US of output
+//   at the current rate.
+#define DMA_BUF_COUNT_MIN 2
+#define DMA_BUF_COUNT_MAX 32
+#define DMA_BUF_LEN_MIN 16
+#define DMA_BUF_LEN_MAX 1024 // Limit of the I2S driver
+#define DMA_SAMPLES_MAX 4096 // Total size of the queue; 8 bytes per sample
+#define DMA_AUTO_TIME_US 5000
+extern int dma_buf_count, dma_buf_len, dma_auto;
+// Reinstall the I2S driver with new buffers; returns 0 if the size is invalid
+int set_dma(int count, int len);
+// Pick the buffers for the current rate (if auto mode is on)
+void update_dma_auto();
+
+// Number of times the output ran out of data, as detected from the time
+//   between buffer writes
+extern uint32_t sync_underruns;
+
+// Timing statistics for "SYNC PERF": the time to compute each output buffer,
+//   the time between buffers handed to the DMA, and the time per pass of
+//   loop().  The first two are kept by the output, so "SYNC PERF" clears
+//   them by setting perf_clear_pending.
+extern PerfHist perf_buffer_update, perf_buffer_interval, perf_loop;
+extern volatile int perf_clear_pending;
+
+// Pre-rendered output ("SYNC CACHE").  When enabled, the I2S words for the
+//   current cycle are computed ahead of time by update_cache (a little at a
+//   time, from the main loop), and update_sync just copies them.  Only
+//   cycles of up to SYNC_CACHE_SIZE samples are cached.
+#define SYNC_CACHE_SIZE 2048
+extern int cache_enabled;
+extern volatile int cache_ready;
+void update_cache();
+// Called when the sync data or the fixed analog output changes
+void invalidate_cache();
+
 // Function to change frequency
 float sync_freq(float freq);
 
+// Function to update the sync output (see sync.cpp).  Commands which take a
+//   long time need to call this periodically, so the output doesn't stall.
+//   (With SYNC_TASK_ENABLED, this and update_cache do nothing.)
+void update_sync();
+
 // Maximum string length for bluetooth serial, to avoid infinite writes
 #ifdef BLUETOOTH_ENABLED
     #define SERIAL_BT_MAX_WRITE 1024
@@ -149,13 +256,15 @@ esp_err_t bluetooth_set_name(const char* name);
 
 // Circular buffer class
 // This is a non-blocking way of storing serial input/output.
-// It will fail silently on overlow, but set the overflow variable.
+// It will fail silently on overlow, but set the overflow variable (and count
+// the bytes lost in dropped, which isn't cleared by flush).
 // Code in "circular_buffer.cpp"
 class CircularBuffer {
     public:
         uint8_t buffer[SER_BUFFER_SIZE];
         uint8_t *b_current, *b_end;
         int start, available, overflow;
+        uint32_t dropped;
 
         CircularBuffer();
         int write(const uint8_t *s);
@@ -169,6 +278,7 @@ class CircularBuffer {
             int to_stream(BluetoothSerial &stream);
         #endif
         int to_stream(CircularBuffer &buf);
+        int to_stream(CircularBuffer &buf, int max_bytes);
         uint8_t * get_buffer(int * max_data);
         void flush();
 };
@@ -0,0 +1,52 @@
+#if !defined(PACK_H)
+
+#define PACK_H 1
+#include <stdint.h>
+
+// Streaming decoder for the packed sync data format (used by SYNC PACK).
+// The format is described in ad_sync/pack.py; in brief:
+//   [varint N] [digital ops ...] [analog ops ...]
+// Each op is a header byte (2 bit op code, 6 bit count - 1, where 63 means a
+// varint count - 64 follows), followed by its data.
+
+// Op codes for the digital and analog sections
+enum PACK_DIG_OPS : int {DIG_LIT, DIG_RUN, DIG_COPY};
+enum PACK_ANA_OPS : int {ANA_ZERO, ANA_SMALL, ANA_BYTE, ANA_RAW};
+
+// Decoder states.  Errors MUST come after PACK_DONE!
+enum PACK_STATES : int {PACK_NONE, PACK_COUNT, PACK_HEADER, PACK_EXT, PACK_ARG, PACK_DATA, PACK_DONE, PACK_OVERFLOW, PACK_INVALID};
+
+class PackDecoder {
+    private:
+        uint32_t *dest;
+        int max_samples;
+        int section; // 0 = digital, 1 = analog
+        int pos; // Index of the next sample in the current section
+        int op;
+        int count; // Samples left in the current op
+        uint32_t value;
+        int shift;
+        int byte_i;
+        uint16_t a1, a2; // Previous two analog samples, used for prediction
+
+        int read_varint(uint8_t c);
+        void begin_op();
+        void end_op();
+        void read_data(uint8_t c);
+        // Each section only replaces its half of the samples, so the memory
+        //   being output keeps its old analog values until the new ones arrive
+        void put_dig(uint32_t x) {dest[pos] = (dest[pos] & 0xFFFF) | (x << 16); pos++;}
+        void put_ana(uint16_t x) {dest[pos] = (dest[pos] & 0xFFFF0000) | x; a2 = a1; a1 = x; pos++;}
+        uint16_t predict() {return (uint16_t)(2*a1 - a2);}
+
+    public:
+        int state;
+        int total; // Total number of samples in the stream
+
+        PackDecoder() {reset();}
+        void reset() {state = PACK_NONE;} // Stop decoding
+        void start(uint32_t *dest, int max_samples); // Decode a new stream into dest
+        void process_char(uint8_t c); // Decode one byte of the stream
+};
+
+#endif
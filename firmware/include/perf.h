@@ -0,0 +1,22 @@
+#if !defined(PERF_H)
+
+#define PERF_H 1
+#include <stdint.h>
+
+// Timing statistics for "SYNC PERF".  Times are in us, and are histogrammed
+//   in powers of two: bin 0 counts times of 0, and bin i > 0 times from
+//   2^(i-1) to 2^i - 1 (the last bin also counts anything longer).  A
+//   histogram which is all zeros is empty, so these can be static.
+#define PERF_BINS 20
+
+struct __attribute__((packed)) PerfHist {
+    uint32_t count;
+    uint32_t min, max;
+    uint64_t total;
+    uint32_t bins[PERF_BINS];
+};
+
+void perf_clear(PerfHist &h);
+void perf_add(PerfHist &h, uint32_t t);
+
+#endif
@@ -6,54 +6,20 @@
 // The shared sync variables are defined in main.h, since they are also accessed by command.h
 
 // Constants used only by sync.cpp
+#include "dac.h"
+#include "fill.h"
+
+// The settings used by the output, copied from the staged globals (main.h)
+//   between cycles
+struct SyncSettings {
+    int start, cycles;
+    int analog_mode, digital_mode;
+    uint32_t multiplier[2], offset[2];
+    uint32_t trigger_mask;
+};
 
-// The following blocks depend on the DAC on the device.
-// The production version uses DAC8562
-// The prototype used MCP4822 (becuase I had one lying around!)
-
-#define DAC8562 1
-#ifdef DAC8562
-    // These are the SPI header bits used for the MCP4822
-    // Note: the data is always 16 bits, so we are shifting to the left of that.
-    #define DAC_SPI_CH0 (0b011000 << 16)
-    #define DAC_SPI_CH1 (0b011001 << 16)
-
-    // These codes are run (in order) after the device is fully booted.
-    
-    // Internal reference, gain = 2
-    #define DAC_SETUP_A 0b001110000000000000000001
-    //                    XXCCCAAAddddddddDDDDDDDD
-    // Set both DAC to gain = 1
-    #define DAC_SETUP_B 0b000000100000000000000011
-    //                    XXCCCAAAddddddddDDDDDDDD
-    // Disable both LDAC pins
-    #define DAC_SETUP_C 0b001100000000000000000011
-    //                    XXCCCAAAddddddddDDDDDDDD
-    // Power up both DACs
-    #define DAC_SETUP_D 0b001000000000000000000011
-    //                    XXCCCAAAddddddddDDDDDDDD
-
-    // Bit shift required to align the data.  The buffer is 32 bits, and the data+header is 24 bits
-    #define DAC_SHIFT 8
-
-    // Delay in us after boot to try running the setup commands.
-    #define DAC_SETUP_DELAY_US 100000
-#endif
-
-// #define MCP4822 1
-#ifdef MCP4822
-    // These are the SPI header bits used for the MCP4822
-    // Note: the data is always 16 bits, so we are shifting to the left of that.
-    #define DAC_SPI_CH0 (0b0011 << 16)
-    #define DAC_SPI_CH1 (0b1011 << 16)
-    #define DAC_SETUP_A 0
-    #define DAC_SETUP_B 0
-    #define DAC_SETUP_C 0
-    #define DAC_SETUP_D 0
-    // Bit shift required to align the data.  The buffer is 32 bits, and the data+header is 20 bits
-    #define DAC_SHIFT 12
-    #define DAC_SETUP_DELAY_US 0
-#endif
+// Number of samples rendered per call of update_cache
+#define CACHE_RENDER_BLOCK 256
 
 // Output masks for analog and digital data
 #define I2S_DIG_MASK (0xFFFFFFFF00000000)
@@ -75,7 +41,7 @@ const i2s_config_t i2s_config = {
     .channel_format = I2S_CHANNEL_FMT_RIGHT_LEFT,
     .communication_format = i2s_comm_format_t(I2S_COMM_FORMAT_I2S | I2S_COMM_FORMAT_I2S_LSB), // "LSB" alignment is really MSB alignment.  Don't ask me why!
     .intr_alloc_flags = ESP_INTR_FLAG_LEVEL1,
-    .dma_buf_count = 4,
+    .dma_buf_count = 4, // Changed by set_dma
     .dma_buf_len = (2*I2S_WRITE_BUFFER_SIZE),
     .use_apll = true,
 };
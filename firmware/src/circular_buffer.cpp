@@ -3,6 +3,7 @@
 int CircularBuffer::write(const uint8_t c) {
     if (available >= SER_BUFFER_SIZE) {
         overflow = 1;
+        dropped ++;
         return 0;
     } else {
         *b_current = c;
@@ -43,7 +44,10 @@ int CircularBuffer::write(const uint8_t *s, int nbytes) {
     if (b_current >= b_end) {b_current -= SER_BUFFER_SIZE;}
 
     available += bytes_written;
-    if (bytes_written != nbytes) {overflow = 1;}
+    if (bytes_written != nbytes) {
+        overflow = 1;
+        dropped += nbytes - bytes_written;
+    }
 
     return bytes_written;
 }
@@ -65,6 +69,7 @@ CircularBuffer::CircularBuffer() {
     start = 0;
     available = 0;
     overflow = 0;
+    dropped = 0;
     b_current = buffer;
     b_end = buffer + SER_BUFFER_SIZE;
 }
@@ -149,7 +154,11 @@ int CircularBuffer::to_stream(BluetoothSerial &stream) {
 #endif
 
 int CircularBuffer::to_stream(CircularBuffer &buf) {
-    int n = min(SER_BUFFER_SIZE - buf.available, available);
+    return to_stream(buf, SER_BUFFER_SIZE);
+}
+
+int CircularBuffer::to_stream(CircularBuffer &buf, int max_bytes) {
+    int n = min(min(SER_BUFFER_SIZE - buf.available, available), max_bytes);
 
     if (n) {
         int wrap = (start + n) - SER_BUFFER_SIZE;
@@ -1,6 +1,11 @@
 #include "main.h"
 #include "commands.h"
 
+// Statistics for "SYNC PERF", shared by all command queues
+static PerfHist perf_command;
+static uint32_t perf_slowest_command = 0;
+static unsigned long perf_interval_start = 0;
+
 int char_type(char c) {
     if (c == 10) return EOL;
     if (c == 62) return BINSTART;
@@ -44,6 +49,84 @@ int CommandQueue::output_float(float x) {
     return nbytes;
 }
 
+int CommandQueue::output_perf() {
+    PerfStats perf;
+    CircularBuffer* ser_buffers[5] = {&ser1_input, &ser1_output, &ser2_input, &ser2_output, &output_buffer};
+    unsigned long t = micros();
+
+    perf.interval = t - perf_interval_start;
+    perf.underruns = sync_underruns;
+    perf.slowest_command = perf_slowest_command;
+    // The output statistics may change while they are copied; this is
+    //   harmless, as the counts are only ever off by one
+    perf.buffer_update = perf_buffer_update;
+    perf.buffer_interval = perf_buffer_interval;
+    perf.loop = perf_loop;
+    perf.command = perf_command;
+    for (int i=0; i<5; i++) {perf.ser_dropped[i] = ser_buffers[i]->dropped;}
+
+    // Start a new interval
+    perf_interval_start = t;
+    perf_clear_pending = 1;
+    perf_clear(perf_loop);
+    perf_clear(perf_command);
+    perf_slowest_command = 0;
+
+    int nbytes = 0;
+    nbytes += output_buffer.write(">");
+    nbytes += output_int(sizeof(PerfStats));
+    nbytes += output_buffer.write(">");
+    nbytes += output_buffer.write((uint8_t*)&perf, sizeof(PerfStats));
+    nbytes += output_eol();
+    return nbytes;
+}
+
+int CommandQueue::output_state() {
+    SyncState state;
+    CircularBuffer* ser_buffers[4] = {&ser1_input, &ser1_output, &ser2_input, &ser2_output};
+
+    state.sync_start = sync_start;
+    state.sync_cycles = sync_cycles;
+    state.sync_rate = sync_rate;
+    state.ana_multiplier[0] = ana0_multiplier;
+    state.ana_multiplier[1] = ana1_multiplier;
+    state.ana_offset[0] = ana0_offset;
+    state.ana_offset[1] = ana1_offset;
+    state.trigger_mask = trigger_mask;
+    state.trigger_count = trigger_count;
+    state.buffer_update_time = buffer_update_time;
+    state.last_update_age = micros() - last_sync_update;
+    state.last_bytes_written = last_bytes_written;
+    state.ana_set[0] = ana0_set;
+    state.ana_set[1] = ana1_set;
+    state.analog_sync_mode = analog_sync_mode;
+    state.digital_sync_mode = digital_sync_mode;
+    state.sync_active = sync_active;
+    state.ser_overflow = 0;
+    for (int i=0; i<3; i++) {state.led[i] = led_color[i];}
+    for (int i=0; i<4; i++) {
+        state.ser_fill[i] = ser_buffers[i]->available;
+        if (ser_buffers[i]->overflow) {state.ser_overflow |= 1<<i;}
+    }
+    state.settings_pending = settings_pending;
+    state.buffer_update_time_max = buffer_update_time_max;
+    state.cache = cache_enabled + (cache_ready << 1);
+    state.underruns = sync_underruns;
+    state.dma_buf_count = dma_buf_count;
+    state.dma_buf_len = dma_buf_len;
+    state.dma_auto = dma_auto;
+    state.cycle_count = sync_cycle_count;
+    state.trigger_prog = (trigger_prog_active || trigger_prog_start) + (trigger_at_pending << 1);
+
+    int nbytes = 0;
+    nbytes += output_buffer.write(">");
+    nbytes += output_int(sizeof(SyncState));
+    nbytes += output_buffer.write(">");
+    nbytes += output_buffer.write((uint8_t*)&state, sizeof(SyncState));
+    nbytes += output_eol();
+    return nbytes;
+}
+
 void CommandQueue::reset() {
     cycle = IDLE;
     error = NO_ERROR;
@@ -54,6 +137,7 @@ void CommandQueue::reset() {
     bin_target = TARGET_NONE;
     sync_ptr = (uint8_t*)sync_data;
     bin_data_written = 0;
+    unpacker.reset();
 }
 
 void CommandQueue::finish_word() {
@@ -87,6 +171,7 @@ int CommandQueue::output_error() {
 }
 
 void CommandQueue::execute_command() {
+    unsigned long t0 = micros();
     if (cycle == READ_WORD) {finish_word();}
 
     #ifdef CMD_DEBUG
@@ -119,9 +204,19 @@ void CommandQueue::execute_command() {
                 break;
 
             case LED:
-                startup_colors_active = 0;
-                set_led_color((int)args[0], (int)args[1], (int)args[2]);
-                output_ok();
+                if (num_args == 0) {
+                    output_buffer.write("LED ");
+                    output_int(led_color[0]);
+                    output_buffer.write(" ");
+                    output_int(led_color[1]);
+                    output_buffer.write(" ");
+                    output_int(led_color[2]);
+                    output_eol();
+                } else {
+                    startup_colors_active = 0;
+                    set_led_color((int)args[0], (int)args[1], (int)args[2]);
+                    output_ok();
+                }
                 break;
 
             case CMD2(SER1, WRITE):
@@ -153,7 +248,7 @@ void CommandQueue::execute_command() {
                 output_buffer.write(">");
                 output_int(n);
                 output_buffer.write(">");
-                ser1_input.to_stream(output_buffer);
+                ser1_input.to_stream(output_buffer, n);
                 output_eol();
                 break;
 
@@ -164,7 +259,7 @@ void CommandQueue::execute_command() {
                 output_buffer.write(">");
                 output_int(n);
                 output_buffer.write(">");
-                ser2_input.to_stream(output_buffer);
+                ser2_input.to_stream(output_buffer, n);
                 output_eol();
                 break;
 
@@ -214,11 +309,17 @@ void CommandQueue::execute_command() {
                 output_int(micros() - last_sync_update);
                 output_buffer.write(" us ago (");
                 output_int(buffer_update_time);
-                output_buffer.write(" us to update buffer)\n");
+                output_buffer.write(" us to update buffer, ");
+                output_int(buffer_update_time_max);
+                output_buffer.write(" us max, ");
+                output_int(sync_underruns);
+                output_buffer.write(" underruns)\n");
+                buffer_update_time_max = 0;
                 break;
 
             case CMD2(SYNC, WRITE):
                 // Note: the data is actually written in the command character processing function!
+                invalidate_cache();
                 output_buffer.write("Wrote ");
                 output_int(bin_data_written / 4);
                 output_buffer.write(" samples to syncronous data, starting at address ");
@@ -231,46 +332,122 @@ void CommandQueue::execute_command() {
                 }
                 break;
 
+            case CMD2(SYNC, PACK):
+                // Note: the data is decoded in the command character processing function!
+                invalidate_cache();
+                if (unpacker.state != PACK_DONE) {
+                    error = ERR_INVALID_PACKED_DATA;
+                    output_error();
+                } else {
+                    output_buffer.write("Wrote ");
+                    output_int(unpacker.total);
+                    output_buffer.write(" samples to syncronous data, starting at address ");
+                    output_int(args[0]);
+                    output_buffer.write(".\n");
+                }
+                break;
+
+            case CMD2(SYNC, READ):
+                if ((num_args == 2) && (args[0] < SYNC_DATA_SIZE) && (args[1] <= SYNC_DATA_SIZE - args[0])) {
+                    // Only as many samples as fit in the output buffer are returned
+                    n = min((int)args[1], (SER_BUFFER_SIZE - output_buffer.available - 16) / 4);
+                    n = max(n, 0);
+                    output_buffer.write(">");
+                    output_int(4*n);
+                    output_buffer.write(">");
+                    output_buffer.write((uint8_t*)(sync_data + args[0]), 4*n);
+                    output_eol();
+                } else {
+                    error = ERR_INVALID_ADDR;
+                    output_error();
+                }
+                break;
+
+            case CMD2(SYNC, CRC):
+                if ((num_args == 2) && (args[0] < SYNC_DATA_SIZE) && (args[1] <= SYNC_DATA_SIZE - args[0])) {
+                    uint8_t *data = (uint8_t*)(sync_data + args[0]);
+                    uint32_t crc = 0;
+                    n = 4 * args[1];
+                    // Done in blocks, so that the sync output keeps running
+                    for (i=0; i<n; i+=CRC_BLOCK_SIZE) {
+                        crc = crc32_update(crc, data + i, min(CRC_BLOCK_SIZE, n - i));
+                        update_sync();
+                    }
+                    output_buffer.write(">4>");
+                    output_buffer.write((uint8_t*)&crc, 4);
+                    output_eol();
+                } else {
+                    error = ERR_INVALID_ADDR;
+                    output_error();
+                }
+                break;
+
             case CMD2(ANA0, SET):
-                if (num_args != 1) {
+                if (num_args == 0) {
+                    output_buffer.write("ANA0 SET ");
+                    output_int(ana0_set);
+                    output_eol();
+                } else if (num_args != 1) {
                     error = ERR_WRONG_NUM_ARGS1;
                     output_error();
                 } else {
                     ana0_set = args[0];
-                    analog_update |= 1<<0;
+                    __sync_fetch_and_or(&analog_update, 1<<0);
+                    // Used by the output in analog mode 0
+                    invalidate_cache();
                     output_ok();
                 }
                 break;
 
             case CMD2(ANA1, SET):
-                if (num_args != 1) {
+                if (num_args == 0) {
+                    output_buffer.write("ANA1 SET ");
+                    output_int(ana1_set);
+                    output_eol();
+                } else if (num_args != 1) {
                     error = ERR_WRONG_NUM_ARGS1;
                     output_error();
                 } else {
                     ana1_set = args[0];
-                    analog_update |= 1<<1;
+                    __sync_fetch_and_or(&analog_update, 1<<1);
                     output_ok();
                 }
                 break;
 
             case CMD2(ANA0, SCALE):
-                if (num_args != 2) {
+                if (num_args == 0) {
+                    output_buffer.write("ANA0 SCALE ");
+                    output_int(ana0_multiplier);
+                    output_buffer.write(" ");
+                    output_int(ana0_offset);
+                    output_eol();
+                } else if (num_args != 2) {
                     error = ERR_WRONG_NUM_ARGS2;
                     output_error();
                 } else {
+                    begin_settings();
                     ana0_multiplier = args[0];
                     ana0_offset = args[1];
+                    stage_settings();
                     output_ok();
                 }
                 break;
 
             case CMD2(ANA1, SCALE):
-                if (num_args != 2) {
+                if (num_args == 0) {
+                    output_buffer.write("ANA1 SCALE ");
+                    output_int(ana1_multiplier);
+                    output_buffer.write(" ");
+                    output_int(ana1_offset);
+                    output_eol();
+                } else if (num_args != 2) {
                     error = ERR_WRONG_NUM_ARGS2;
                     output_error();
                 } else {
+                    begin_settings();
                     ana1_multiplier = args[0];
                     ana1_offset = args[1];
+                    stage_settings();
                     output_ok();
                 }
                 break;
@@ -283,9 +460,11 @@ void CommandQueue::execute_command() {
                     output_int(digital_sync_mode);
                     output_eol();
                 } else if (args[0] < 4) {
+                    // The fixed outputs are updated when this takes effect
+                    begin_settings();
                     analog_sync_mode = args[0];
-                    analog_update |= (~analog_sync_mode) & 0b11;
                     digital_sync_mode = args[1];
+                    stage_settings();
                     output_ok();
                 } else {
                     error = ERR_INVALID_ARG;
@@ -294,9 +473,17 @@ void CommandQueue::execute_command() {
                 break;
 
             case CMD2(SYNC, ADDR):
-                if ((num_args == 2) && (args[0] < SYNC_DATA_SIZE) && (args[1] < SYNC_DATA_SIZE)) {
+                if (num_args == 0) {
+                    output_buffer.write("SYNC ADDR ");
+                    output_int(sync_start);
+                    output_buffer.write(" ");
+                    output_int(sync_cycles);
+                    output_eol();
+                } else if ((num_args == 2) && (args[0] < SYNC_DATA_SIZE) && (args[1] < SYNC_DATA_SIZE)) {
+                    begin_settings();
                     sync_start = args[0];
                     sync_cycles = args[1];
+                    stage_settings();
                     output_ok();
                 } else {
                     error = ERR_INVALID_ADDR;
@@ -316,8 +503,104 @@ void CommandQueue::execute_command() {
                 output_ok();
                 break;
 
+            case CMD2(SYNC, DUMP):
+                output_state();
+                break;
+
+            case CMD2(SYNC, PERF):
+                output_perf();
+                break;
+
+            case CMD2(SYNC, SWAP):
+                if (num_args == 0) {
+                    output_buffer.write("SYNC SWAP ");
+                    output_int(settings_pending);
+                    output_eol();
+                } else if ((num_args == 2) && (args[0] < SYNC_DATA_SIZE) && (args[1] < SYNC_DATA_SIZE)) {
+                    // The same as SYNC ADDR followed by SYNC COMMIT
+                    begin_settings();
+                    sync_start = args[0];
+                    sync_cycles = args[1];
+                    settings_hold = 0;
+                    stage_settings();
+                    output_ok();
+                } else {
+                    error = ERR_INVALID_ADDR;
+                    output_error();
+                }
+                break;
+
+            case CMD2(SYNC, CACHE):
+                output_buffer.write("SYNC CACHE ");
+                output_int(cache_enabled);
+                output_buffer.write(" ");
+                output_int(cache_ready);
+                output_eol();
+                break;
+
+            case CMD3(SYNC, CACHE, CMD_ON):
+                cache_enabled = 1;
+                output_ok();
+                break;
+
+            case CMD3(SYNC, CACHE, CMD_OFF):
+                cache_enabled = 0;
+                invalidate_cache();
+                output_ok();
+                break;
+
+            case CMD2(SYNC, DMA):
+                if (num_args == 0) {
+                    output_buffer.write("SYNC DMA ");
+                    output_int(dma_buf_count);
+                    output_buffer.write(" ");
+                    output_int(dma_buf_len);
+                    output_buffer.write(" ");
+                    output_int(dma_auto);
+                    output_eol();
+                } else if (num_args == 2) {
+                    if (set_dma(args[0], args[1])) {
+                        dma_auto = 0;
+                        output_ok();
+                    } else {
+                        error = ERR_INVALID_ARG;
+                        output_error();
+                    }
+                } else {
+                    error = ERR_WRONG_NUM_ARGS2;
+                    output_error();
+                }
+                break;
+
+            case CMD3(SYNC, DMA, AUTO):
+                dma_auto = 1;
+                update_dma_auto();
+                output_ok();
+                break;
+
+            case CMD2(SYNC, STAGE):
+                settings_hold = 1;
+                output_ok();
+                break;
+
+            case CMD2(SYNC, COMMIT):
+                settings_hold = 0;
+                settings_pending = 1;
+                output_ok();
+                break;
+
+            case CMD2(SYNC, ACTIVE):
+                output_buffer.write("SYNC ACTIVE ");
+                output_int(sync_active);
+                output_eol();
+                break;
+
             case CMD2(SYNC, RATE):
-                if ((num_args == 1) || (num_args == 2)) {
+                if (num_args == 0) {
+                    output_buffer.write("SYNC RATE = ");
+                    output_float(sync_rate);
+                    output_buffer.write(" Hz\n");
+                } else if ((num_args == 1) || (num_args == 2)) {
                     float freq = (float)args[0];
 
                     if (num_args == 2) {
@@ -328,9 +611,10 @@ void CommandQueue::execute_command() {
                         error = ERR_INVALID_FREQ;
                         output_error();
                     } else {
-                        freq = sync_freq(freq);
+                        sync_rate = sync_freq(freq);
+                        update_dma_auto();
                         output_buffer.write("SYNC RATE = ");
-                        output_float(freq);
+                        output_float(sync_rate);
                         output_buffer.write(" Hz\n");
                     }
                 } else {
@@ -340,8 +624,14 @@ void CommandQueue::execute_command() {
                 break;
 
             case CMD2(TRIGGER, MASK):
-                if (num_args == 1) {
+                if (num_args == 0) {
+                    output_buffer.write("TRIGGER MASK ");
+                    output_int(trigger_mask);
+                    output_eol();
+                } else if (num_args == 1) {
+                    begin_settings();
                     trigger_mask = args[0];
+                    stage_settings();
                     output_ok();
                 } else {
                     error = ERR_WRONG_NUM_ARGS1;
@@ -349,6 +639,69 @@ void CommandQueue::execute_command() {
                 }
                 break;
 
+            case CMD2(TRIGGER, PROG):
+                if (bin_data_written % sizeof(TriggerEntry)) {
+                    error = ERR_INVALID_BIN_DATA_LEN;
+                    output_error();
+                } else {
+                    trigger_prog_start = 0;
+                    trigger_prog_active = 0;
+                    trigger_prog_len = bin_data_written / sizeof(TriggerEntry);
+                    output_buffer.write("TRIGGER PROG ");
+                    output_int(trigger_prog_len);
+                    output_eol();
+                }
+                break;
+
+            case CMD2(TRIGGER, START):
+                trigger_prog_start = 1;
+                output_ok();
+                break;
+
+            case CMD2(TRIGGER, STOP):
+                // Cancels the program, TRIGGER AT and any trigger in progress
+                trigger_prog_start = 0;
+                trigger_prog_active = 0;
+                trigger_at_pending = 0;
+                trigger_count = 0;
+                output_ok();
+                break;
+
+            case CMD2(TRIGGER, STAT):
+                output_buffer.write("TRIGGER STAT ");
+                output_int(trigger_prog_active || trigger_prog_start);
+                output_buffer.write(" ");
+                output_int(trigger_prog_entry);
+                output_buffer.write(" ");
+                output_int(trigger_prog_len);
+                output_buffer.write(" ");
+                output_int(trigger_at_pending);
+                output_buffer.write(" ");
+                output_int(trigger_count);
+                output_eol();
+                break;
+
+            case CMD2(TRIGGER, AT):
+                if ((num_args == 1) || (num_args == 2)) {
+                    trigger_at_pending = 0;
+                    __sync_synchronize();
+                    trigger_at_cycle = args[0];
+                    trigger_at_count = (num_args == 2) ? args[1] : 1;
+                    __sync_synchronize();
+                    trigger_at_pending = 1;
+                    output_ok();
+                } else {
+                    error = ERR_WRONG_NUM_ARGS2;
+                    output_error();
+                }
+                break;
+
+            case CMD2(SYNC, COUNT):
+                output_buffer.write("SYNC COUNT ");
+                output_int(sync_cycle_count);
+                output_eol();
+                break;
+
             case TRIGGER:
                 if (num_args <= 1) {
                     if (num_args == 0) {trigger_count = 1;}
@@ -388,6 +741,10 @@ void CommandQueue::execute_command() {
         }
     }
 
+    uint32_t t = micros() - t0;
+    if (t >= perf_command.max) {perf_slowest_command = command;}
+    perf_add(perf_command, t);
+
     reset();
 }
 
@@ -396,11 +753,21 @@ void CommandQueue::process_char(char c) {
     if (cycle == READ_BIN) {
         switch (bin_target) {
             case TARGET_SYNC_DATA:
-                *sync_ptr = (uint8_t)c;
-                sync_ptr ++;
+                // Checked before the byte is stored, so that a write can
+                //   end at the last sample of the memory
                 if (sync_ptr >= sync_end) {
                     error = ERR_INVALID_ADDR;
                     bin_target = TARGET_NONE;
+                } else {
+                    *sync_ptr = (uint8_t)c;
+                    sync_ptr ++;
+                }
+                break;
+            case TARGET_SYNC_PACKED:
+                unpacker.process_char((uint8_t)c);
+                if (unpacker.state > PACK_DONE) {
+                    error = (unpacker.state == PACK_OVERFLOW) ? ERR_INVALID_ADDR : ERR_INVALID_PACKED_DATA;
+                    bin_target = TARGET_NONE;
                 }
                 break;
             case TARGET_SERIAL1:
@@ -409,6 +776,9 @@ void CommandQueue::process_char(char c) {
             case TARGET_SERIAL2:
                 ser2_output.write(c);
                 break;
+            case TARGET_TRIGGER_PROG:
+                ((uint8_t *)trigger_prog)[bin_data_written] = (uint8_t)c;
+                break;
             case TARGET_BT_NAME:
                 #ifdef BLUETOOTH_ENABLED
                     if (bin_data_written >= BT_NAME_MAX_LENGTH) {
@@ -462,10 +832,34 @@ void CommandQueue::process_char(char c) {
                         }
                         break;
 
+                    case CMD2(SYNC, PACK):
+                        if ((num_args == 1) && (args[0] >= 0) && (args[0] < SYNC_DATA_SIZE)) {
+                            bin_target = TARGET_SYNC_PACKED;
+                            unpacker.start(sync_data + args[0], SYNC_DATA_SIZE - args[0]);
+                        } else {
+                            bin_target = TARGET_NONE;
+                            error = ERR_INVALID_ADDR;
+                        }
+                        break;
+
                     case BLUETOOTH:
                         bin_target = TARGET_BT_NAME;
                         break;
 
+                    case CMD2(TRIGGER, PROG):
+                        if (bin_data_len <= sizeof(trigger_prog)) {
+                            // The running program (if any) is stopped before
+                            //   it is overwritten
+                            trigger_prog_start = 0;
+                            trigger_prog_active = 0;
+                            __sync_synchronize();
+                            bin_target = TARGET_TRIGGER_PROG;
+                        } else {
+                            bin_target = TARGET_NONE;
+                            error = ERR_INVALID_BIN_DATA_LEN;
+                        }
+                        break;
+
                     default:
                         cycle = CMD_ERROR;
                         error = ERR_EXTRA_BIN_DATA;
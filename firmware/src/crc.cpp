@@ -0,0 +1,28 @@
+#include "crc.h"
+
+// Reflected polynomial for CRC-32
+#define CRC32_POLY 0xEDB88320
+
+static uint32_t crc_table[256];
+static int crc_table_ready = 0;
+
+static void crc32_init() {
+    for (uint32_t i=0; i<256; i++) {
+        uint32_t c = i;
+        for (int k=0; k<8; k++) {
+            c = (c & 1) ? (CRC32_POLY ^ (c >> 1)) : (c >> 1);
+        }
+        crc_table[i] = c;
+    }
+    crc_table_ready = 1;
+}
+
+uint32_t crc32_update(uint32_t crc, const uint8_t *data, int nbytes) {
+    if (!crc_table_ready) {crc32_init();}
+
+    crc = ~crc;
+    for (int i=0; i<nbytes; i++) {
+        crc = crc_table[(crc ^ data[i]) & 0xFF] ^ (crc >> 8);
+    }
+    return ~crc;
+}
@@ -10,6 +10,7 @@
 
 // Define some globally shared variables/arrays
 uint16_t LED_LUT[256];
+int led_color[3] = {0, 0, 0};
 
 // Set up the serial input/output buffers
 // Note: these are in *addition* to the Arduino serial buffers.
@@ -24,8 +25,6 @@ CircularBuffer ser0_output, ser1_input, ser1_output, ser2_input, ser2_output;
     CircularBuffer serbt_output;
 #endif
 
-TaskHandle_t command_task;         
-
 void setup()
 {
     // Build LED lookup table for gamma correction
@@ -45,6 +44,9 @@ void setup()
     digitalWrite(OE_PIN, LOW); // Shift registers enabled
 
     // Set up serial ports
+    // The receive buffer must hold the data the host sends ahead of our replies
+    //   (see ADSync.WINDOW); this has to be set before begin.
+    Serial.setRxBufferSize(SER_BUFFER_SIZE);
     Serial.begin(921600); // 0 is used for USB communication with host
     Serial1.begin(9600, SERIAL_8N1, RX1_PIN, TX1_PIN); // Ser1
     Serial2.begin(9600, SERIAL_8N1, RX2_PIN, TX2_PIN); // Ser2
@@ -138,11 +140,21 @@ CommandQueue serial_commands;
 
 int startup_colors_active = 1;
 
+// Time per pass of loop(), for "SYNC PERF"
+PerfHist perf_loop;
+static unsigned long last_loop = 0;
+
 void loop()
 {
     // This loops processes all the command queues, and updates the DMA for the sync
     // Note that update_sync should return quickly if there is nothing to do; it's better
     //  to run it a lot to avoid corrupting the output.
+    // (With SYNC_TASK_ENABLED, the sync output runs in its own task instead,
+    //  and the update_sync calls do nothing.)
+
+    unsigned long t_loop = micros();
+    if (last_loop) {perf_add(perf_loop, t_loop - last_loop);}
+    last_loop = t_loop;
 
     // Update the LED with pretty colors on boot.
     if (startup_colors_active) {
@@ -205,10 +217,15 @@ void loop()
     ser2_input.from_stream(Serial2);
 
     update_sync();
+    update_cache();
+    update_sync();
 }
 
 
 void set_led_color(int r, int g, int b) {
+    led_color[0] = max(min(r, 255), 0);
+    led_color[1] = max(min(g, 255), 0);
+    led_color[2] = max(min(b, 255), 0);
     ledcWrite(0, (LED_LUT[max(min(r, 255), 0)] * LED_TRIM[0]) >> 16);
     ledcWrite(1, (LED_LUT[max(min(g, 255), 0)] * LED_TRIM[1]) >> 16);
     ledcWrite(2, (LED_LUT[max(min(b, 255), 0)] * LED_TRIM[2]) >> 16);
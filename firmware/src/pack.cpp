@@ -0,0 +1,153 @@
+#include "pack.h"
+
+void PackDecoder::start(uint32_t *d, int max) {
+    dest = d;
+    max_samples = max;
+    state = PACK_COUNT;
+    total = 0;
+    section = 0;
+    pos = 0;
+    op = 0;
+    count = 0;
+    value = 0;
+    shift = 0;
+    byte_i = 0;
+    a1 = 0;
+    a2 = 0;
+}
+
+// Add a byte to a varint; returns 1 when it is complete
+int PackDecoder::read_varint(uint8_t c) {
+    if (shift > 28) {
+        state = PACK_INVALID;
+        return 0;
+    }
+    value += ((uint32_t)(c & 0x7F)) << shift;
+    shift += 7;
+    return !(c & 0x80);
+}
+
+void PackDecoder::begin_op() {
+    value = 0;
+    shift = 0;
+    byte_i = 0;
+
+    if ((count < 1) || (count > total - pos)) {
+        state = PACK_INVALID;
+    } else if (section == 0) {
+        if (op == DIG_COPY) {state = PACK_ARG;}
+        else if (op == DIG_LIT || op == DIG_RUN) {state = PACK_DATA;}
+        else {state = PACK_INVALID;}
+    } else if (op == ANA_ZERO) {
+        for (; count > 0; count--) {put_ana(predict());}
+        end_op();
+    } else {
+        state = PACK_DATA;
+    }
+}
+
+void PackDecoder::end_op() {
+    if (pos < total) {
+        state = PACK_HEADER;
+    } else if (section == 0) {
+        // Digital section finished; the analog section follows
+        section = 1;
+        pos = 0;
+        state = PACK_HEADER;
+    } else {
+        state = PACK_DONE;
+    }
+}
+
+void PackDecoder::read_data(uint8_t c) {
+    if (section == 0) {
+        value += ((uint32_t)c) << (8 * byte_i);
+        byte_i++;
+        if (byte_i == 2) {
+            if (op == DIG_RUN) {
+                for (; count > 0; count--) {put_dig(value);}
+            } else {
+                put_dig(value);
+                count--;
+            }
+            value = 0;
+            byte_i = 0;
+        }
+    } else if (op == ANA_SMALL) {
+        for (int i=0; (i<4) && (count > 0); i++, count--) {
+            put_ana(predict() + ((c >> (2*i)) & 0b11) - 2);
+        }
+    } else if (op == ANA_BYTE) {
+        put_ana(predict() + (int8_t)c);
+        count--;
+    } else {
+        value += ((uint32_t)c) << (8 * byte_i);
+        byte_i++;
+        if (byte_i == 2) {
+            put_ana(value);
+            count--;
+            value = 0;
+            byte_i = 0;
+        }
+    }
+
+    if (count == 0) {end_op();}
+}
+
+void PackDecoder::process_char(uint8_t c) {
+    switch (state) {
+        case PACK_DATA:
+            read_data(c);
+            break;
+
+        case PACK_HEADER:
+            op = c >> 6;
+            count = (c & 63) + 1;
+            if (count == 64) {
+                value = 0;
+                shift = 0;
+                state = PACK_EXT;
+            } else {
+                begin_op();
+            }
+            break;
+
+        case PACK_EXT:
+            if (read_varint(c)) {
+                count = 64 + value;
+                begin_op();
+            }
+            break;
+
+        case PACK_ARG:
+            if (read_varint(c)) {
+                int d = value;
+                if ((d < 1) || (d > pos)) {
+                    state = PACK_INVALID;
+                } else {
+                    // Copy one sample at a time, so that d < count repeats
+                    for (; count > 0; count--) {
+                        dest[pos] = (dest[pos] & 0xFFFF) | (dest[pos - d] & 0xFFFF0000);
+                        pos++;
+                    }
+                    end_op();
+                }
+            }
+            break;
+
+        case PACK_COUNT:
+            if (read_varint(c)) {
+                total = value;
+                value = 0;
+                if (total > max_samples) {state = PACK_OVERFLOW;}
+                else if (total == 0) {state = PACK_DONE;}
+                else {state = PACK_HEADER;}
+            }
+            break;
+
+        case PACK_DONE:
+            // Trailing data
+            state = PACK_INVALID;
+            break;
+    }
+}
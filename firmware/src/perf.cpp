@@ -0,0 +1,21 @@
+#include "perf.h"
+
+void perf_clear(PerfHist &h) {
+    h.count = 0;
+    h.min = 0;
+    h.max = 0;
+    h.total = 0;
+    for (int i=0; i<PERF_BINS; i++) {h.bins[i] = 0;}
+}
+
+void perf_add(PerfHist &h, uint32_t t) {
+    if ((h.count == 0) || (t < h.min)) {h.min = t;}
+    h.count ++;
+    if (t > h.max) {h.max = t;}
+    h.total += t;
+
+    // The bin is the number of bits needed for t
+    int bin = t ? (32 - __builtin_clz(t)) : 0;
+    if (bin >= PERF_BINS) {bin = PERF_BINS - 1;}
+    h.bins[bin] ++;
+}
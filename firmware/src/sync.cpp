@@ -5,7 +5,7 @@
 // These are specified as "extern" in "main.h"
 uint last_bytes_written = 0;
 uint cycles_since_write = 0;
-unsigned long buffer_update_time = 0, last_sync_update = 0;
+unsigned long buffer_update_time = 0, buffer_update_time_max = 0, last_sync_update = 0;
 uint16_t ana0_set = 1<<15, ana1_set = 1<<15;
 int analog_update = 0;
 int analog_sync_mode = 1;
@@ -15,135 +15,357 @@ uint32_t sync_data[SYNC_DATA_SIZE];
 int sync_start = 0;
 int sync_cycles = 1024;
 int sync_active = 0;
+float sync_rate = 0;
 int trigger_count = 0;
 uint32_t trigger_mask = 0;
+volatile uint32_t sync_cycle_count = 0;
+TriggerEntry trigger_prog[TRIGGER_PROG_SIZE];
+int trigger_prog_len = 0;
+volatile int trigger_prog_start = 0, trigger_prog_active = 0, trigger_prog_entry = 0;
+volatile int trigger_at_pending = 0;
+uint32_t trigger_at_cycle = 0, trigger_at_count = 0;
+volatile int settings_pending = 1;
+volatile uint32_t settings_seq = 0;
+volatile int settings_hold = 0;
+int dma_buf_count = 4, dma_buf_len = 2*I2S_WRITE_BUFFER_SIZE, dma_auto = 1;
+uint32_t sync_underruns = 0;
+PerfHist perf_buffer_update, perf_buffer_interval;
+volatile int perf_clear_pending = 0;
 
 // Internal variables
+static SyncSettings out;
+static FillParams fill_params;
+
+// Pre-rendered I2S words for the current cycle: untriggered and triggered.
+//   If the trigger mask has no effect, only the first is rendered.
+static uint64_t cache_words[2][SYNC_CACHE_SIZE];
+static int cache_rendered = 0;
+static volatile int cache_invalid = 1; // Set by commands; the rendering is restarted
+static int cache_variants = 1;
+int cache_enabled = 0;
+volatile int cache_ready = 0;
 static int sync_end = 1024;
 static unsigned long t1;
-static uint64_t i2s_write_buffer[I2S_WRITE_BUFFER_SIZE];
+static uint64_t i2s_write_buffer[DMA_BUF_LEN_MAX/2];
+static int i2s_write_len = I2S_WRITE_BUFFER_SIZE;
 static size_t bytes_written = I2S_WRITE_BUFFER_SIZE; // When we've just start up we need to update the output.
+static unsigned long last_write = 0; // Time of the last buffer handed to the DMA; 0 if unknown
+static float freq_requested = 102400.0; // Used to restore the clock when the driver is reinstalled
+static volatile int dma_pending = 0; // set_dma was called, but the driver hasn't been reinstalled
 static int sync_i = 0;
+static uint32_t trigger_prog_next = 0; // The cycle at which the current entry triggers
 static int sync_was_active = 0;
 static int triggered = 0;
 
 static float APLL_DIV_MIN[NUM_APLL_DIV];
 
+#ifdef SYNC_TASK_ENABLED
+    // The I2S driver posts an event here each time a DMA buffer is sent
+    static QueueHandle_t i2s_events = NULL;
+    static TaskHandle_t sync_task_handle;
+    static void sync_task(void *param);
+#endif
+
+static esp_err_t install_i2s(const i2s_config_t *config) {
+    #ifdef SYNC_TASK_ENABLED
+        esp_err_t err = i2s_driver_install(I2S_NUM_0, config, SYNC_EVENT_QUEUE_LEN, &i2s_events);
+    #else
+        esp_err_t err = i2s_driver_install(I2S_NUM_0, config, 0, NULL);
+    #endif
+    if (err != ESP_OK) {return err;}
+
+    err = i2s_set_pin(I2S_NUM_0, &pin_config);
+    if (err != ESP_OK) {return err;}
+
+    return i2s_start(I2S_NUM_0);
+}
+
 void init_sync() {
     // Install I2S driver; this is used to drive the sync outputs.
-    esp_err_t err;
-
-    err = i2s_driver_install(I2S_NUM_0, &i2s_config, 0, NULL);
-    if (err != ESP_OK) {
+    if (install_i2s(&i2s_config) != ESP_OK) {
         Serial.write("Failed installing I2S driver!\n");
         return;
     }
 
-    err = i2s_set_pin(I2S_NUM_0, &pin_config);
-    if (err != ESP_OK) {
-        Serial.write("Failed setting I2S pins!\n");
-        return;
-    }
-
     Serial.write("I2S driver installed succesfully.\n");
 
-    i2s_start(I2S_NUM_0);
-
     for (int i=0; i<NUM_APLL_DIV; i++) {
         APLL_DIV_MIN[i] = (float)APLL_MIN / (2*(2+APLL_DIV[i][0]) * APLL_DIV[i][1] * APLL_DIV[i][2]);
     }
 
-    sync_freq(102400.0);
+    sync_rate = sync_freq(freq_requested);
 
     Serial.write("Output task running on CPU core ");
-    Serial.println(xPortGetCoreID());
+    #ifdef SYNC_TASK_ENABLED
+        xTaskCreatePinnedToCore(sync_task, "sync", SYNC_TASK_STACK, NULL, SYNC_TASK_PRIORITY, &sync_task_handle, SYNC_TASK_CORE);
+        Serial.println(SYNC_TASK_CORE);
+    #else
+        Serial.println(xPortGetCoreID());
+    #endif
 }
 
 static int dac_setup_complete = 0;
 
-void update_sync() {
-    // Only update the buffer if we need to
-    if (bytes_written) { // The buffer was written, so prepare a new one!
-        t1 = micros();
+int set_dma(int count, int len) {
+    if ((count < DMA_BUF_COUNT_MIN) || (count > DMA_BUF_COUNT_MAX) ||
+        (len < DMA_BUF_LEN_MIN) || (len > DMA_BUF_LEN_MAX) || (len & 1) ||
+        (count * len > DMA_SAMPLES_MAX)) {
+        return 0;
+    }
+    if ((count == dma_buf_count) && (len == dma_buf_len)) {return 1;}
 
-        if (sync_active && (!sync_was_active)) {
-            sync_i = sync_start;
-            sync_end = (sync_start + sync_cycles) % SYNC_DATA_SIZE;
-        }
-        sync_was_active = sync_active;
+    // The driver is reinstalled by the output (see apply_dma)
+    dma_buf_count = count;
+    dma_buf_len = len;
+    dma_pending = 1;
+    return 1;
+}
 
-        for (int i=0; i<I2S_WRITE_BUFFER_SIZE; i++) {
-            if (sync_active) {
-                uint32_t data = sync_data[sync_i];
+// Reinstall the I2S driver with the buffers from set_dma
+static void apply_dma() {
+    dma_pending = 0;
+
+    // This interrupts the output briefly
+    i2s_config_t config = i2s_config;
+    config.dma_buf_count = dma_buf_count;
+    config.dma_buf_len = dma_buf_len;
+    i2s_driver_uninstall(I2S_NUM_0);
+    if (install_i2s(&config) != ESP_OK) {
+        // Fall back to the defaults, which are known to fit
+        i2s_driver_uninstall(I2S_NUM_0);
+        install_i2s(&i2s_config);
+        dma_buf_count = i2s_config.dma_buf_count;
+        dma_buf_len = i2s_config.dma_buf_len;
+    }
+    // Installing the driver resets the I2S clock
+    sync_freq(freq_requested);
 
-                // uint32_t ao = (((data & 0xFFFF) * analog_multiplier) >> 16) + analog_offset;
-                uint32_t ad = (data & 0xFFFF);
-                if (analog_sync_mode == 0) { // Fixed output mode
-                    // We need to write something, so just update analog 0
-                    ad = (DAC_SPI_CH0 + ana0_set);
-                } else {
-                    int channel = 0;
+    i2s_write_len = dma_buf_len / 2;
+    // Any partly written buffer is dropped, and a new one computed
+    bytes_written = 1;
+    last_write = 0;
+}
 
-                    // If we're in dual output mode, channel is chosen by address
-                    if (analog_sync_mode == 3) {channel = sync_i%2;}
-                    // Otherwise its determined by the mode
-                    else {channel = analog_sync_mode - 1;}
+void update_dma_auto() {
+    if (!dma_auto) {return;}
+
+    // Smallest power of two queue holding DMA_AUTO_TIME_US of output (the
+    //   default of 4 x 128 samples is enough up to ~100 kHz); larger queues
+    //   use more buffers rather than just longer ones.
+    float needed = sync_rate * (DMA_AUTO_TIME_US * 1E-6);
+    int total = 4 * 2*I2S_WRITE_BUFFER_SIZE;
+    while ((total < needed) && (total < DMA_SAMPLES_MAX)) {total *= 2;}
+    int count = (total > 4 * 2*I2S_WRITE_BUFFER_SIZE) ? 8 : 4;
+    set_dma(count, total / count);
+}
 
-                    if (channel == 0) {
-                        ad = min(((ad * ana0_multiplier) >> 16) + ana0_offset, 65535) + DAC_SPI_CH0;
-                    } else {
-                        ad = min(((ad * ana1_multiplier) >> 16) + ana1_offset, 65535) + DAC_SPI_CH1;
-                    }
-                }
+void begin_settings() {
+    settings_seq ++;
+    __sync_synchronize();
+}
 
-                uint32_t dd = (data & 0xFFFF0000) >> 16;
+void stage_settings() {
+    __sync_synchronize();
+    settings_seq ++;
+    if (!settings_hold) {settings_pending = 1;}
+}
 
-                // If triggered, all channels output.
-                // If not, we need to zero the triggered channels
-                if (!triggered) {
-                    dd &= ~trigger_mask;
-                }
+// Select the output loop for the current settings, and set up its parameters
+static FillFunc prepare_fill() {
+    fill_params.multiplier[0] = out.multiplier[0];
+    fill_params.multiplier[1] = out.multiplier[1];
+    fill_params.offset[0] = out.offset[0];
+    fill_params.offset[1] = out.offset[1];
+    fill_params.digital_mask = triggered ? 0xFFFFFFFF : ~out.trigger_mask;
+    fill_params.fixed = DAC_SPI_CH0 + ana0_set;
+    return FILL_FUNCS[out.analog_mode & 0b11][out.digital_mode & 0b11];
+}
 
-                // Swap mode
-                if (digital_sync_mode & 0b10) {
-                    dd = ((dd & 0xFF00) >> 8) + ((dd & 0x00FF) << 8);
-                }
+// Copy the staged settings into the output; only called between cycles.
+//   Commands may be changing them at the same time (on the other core), so
+//   if one does, the copy is abandoned and retried at the next chance.  While
+//   the settings are held ("SYNC STAGE"), they may be half changed, so they
+//   stay pending until "SYNC COMMIT".
+static void latch_settings() {
+    if (settings_hold) {return;}
+    uint32_t seq = settings_seq;
+    if (seq & 1) {return;}
+    settings_pending = 0;
+    __sync_synchronize();
+
+    SyncSettings s;
+    s.start = sync_start;
+    s.cycles = sync_cycles;
+    s.analog_mode = analog_sync_mode;
+    s.digital_mode = digital_sync_mode;
+    s.multiplier[0] = ana0_multiplier;
+    s.multiplier[1] = ana1_multiplier;
+    s.offset[0] = ana0_offset;
+    s.offset[1] = ana1_offset;
+    s.trigger_mask = trigger_mask;
+
+    __sync_synchronize();
+    if (settings_seq != seq) {
+        settings_pending = 1;
+        return;
+    }
 
-                // OR output mode
-                if (digital_sync_mode & 0b01) {
-                    dd |= (data & 0xFF00) >> 8;
-                }
+    // A channel which is no longer streamed needs its fixed value sent
+    if (s.analog_mode != out.analog_mode) {
+        __sync_fetch_and_or(&analog_update, (~s.analog_mode) & 0b11);
+    }
 
-                
+    out = s;
+    invalidate_cache();
+}
 
-                // Bits 8-31 are analog output -- shift determined by global constant (DAC dependent)
-                // Bits 40-63 are digital output.
-                i2s_write_buffer[i] = ((uint64_t)(dd) << 40) + (ad<<DAC_SHIFT);
+void invalidate_cache() {
+    cache_ready = 0;
+    cache_invalid = 1;
+}
+
+// Render the next block of the cache; only called by the output
+static void render_cache() {
+    if (cache_invalid) {
+        cache_invalid = 0;
+        cache_ready = 0;
+        cache_rendered = 0;
+    }
+    if (!cache_enabled || cache_ready) {return;}
+
+    int period = out.cycles % SYNC_DATA_SIZE;
+    if (!period) {period = SYNC_DATA_SIZE;}
+    if (period > SYNC_CACHE_SIZE) {return;}
+
+    FillParams p;
+    p.multiplier[0] = out.multiplier[0];
+    p.multiplier[1] = out.multiplier[1];
+    p.offset[0] = out.offset[0];
+    p.offset[1] = out.offset[1];
+    p.fixed = DAC_SPI_CH0 + ana0_set;
+    FillFunc fill = FILL_FUNCS[out.analog_mode & 0b11][out.digital_mode & 0b11];
+    cache_variants = (out.trigger_mask & 0xFFFF) ? 2 : 1;
+
+    // Only a block is rendered per call, so the main loop isn't held up
+    int n = min(period - cache_rendered, CACHE_RENDER_BLOCK);
+    int addr = (out.start + cache_rendered) % SYNC_DATA_SIZE;
+    int n1 = min(n, SYNC_DATA_SIZE - addr);
+    for (int v=0; v<cache_variants; v++) {
+        p.digital_mask = v ? 0xFFFFFFFF : ~out.trigger_mask;
+        uint64_t *words = cache_words[v] + cache_rendered;
+        fill(words, sync_data + addr, n1, addr & 1, p);
+        if (n > n1) {fill(words + n1, sync_data, n - n1, 0, p);}
+    }
+
+    cache_rendered += n;
+    if ((cache_rendered == period) && !cache_invalid) {cache_ready = 1;}
+}
+
+// Called at the start of each cycle (except the first after SYNC START), to run the trigger
+//   program and TRIGGER AT.  (Cycle numbers wrap, so they are compared by
+//   their difference.)
+static void schedule_triggers(uint32_t cycle) {
+    if (trigger_prog_start) {
+        trigger_prog_start = 0;
+        trigger_prog_entry = 0;
+        trigger_prog_next = cycle + trigger_prog[0].delay;
+        trigger_prog_active = (trigger_prog_len > 0);
+    }
+
+    if (trigger_prog_active && ((int32_t)(cycle - trigger_prog_next) >= 0)) {
+        uint32_t count = trigger_prog[trigger_prog_entry].count;
+        trigger_count = count;
+        trigger_prog_entry ++;
+        if (trigger_prog_entry < trigger_prog_len) {
+            trigger_prog_next = cycle + count + trigger_prog[trigger_prog_entry].delay;
+        } else {
+            trigger_prog_active = 0;
+        }
+    }
+
+    if (trigger_at_pending && ((int32_t)(cycle - trigger_at_cycle) >= 0)) {
+        trigger_count = trigger_at_count;
+        trigger_at_pending = 0;
+    }
+}
+
+// Compute the next buffer if the last one was sent, and try to hand it to the
+//   DMA.  Returns the number of bytes written (0 if the DMA queue is full).
+static size_t feed_i2s() {
+    if (dma_pending) {apply_dma();}
+    if (perf_clear_pending) {
+        perf_clear(perf_buffer_update);
+        perf_clear(perf_buffer_interval);
+        perf_clear_pending = 0;
+    }
+
+    // Only update the buffer if we need to
+    if (bytes_written) { // The buffer was written, so prepare a new one!
+        t1 = micros();
+
+        // Outside of a running cycle, changes take effect immediately
+        if (settings_pending && !(sync_active && sync_was_active)) {
+            latch_settings();
+        }
+
+        if (sync_active && (!sync_was_active)) {
+            // A new cycle, but (as for TRIGGER) none are triggered until the next
+            sync_cycle_count ++;
+            sync_i = out.start;
+            sync_end = (out.start + out.cycles) % SYNC_DATA_SIZE;
+        }
+        sync_was_active = sync_active;
+
+        if (sync_active) {
+            FillFunc fill = prepare_fill();
+            int i = 0;
+            while (i < i2s_write_len) {
+                // The longest run of samples which doesn't pass the end of
+                //   the cycle or the end of the memory
+                int n = (sync_end > sync_i) ? (sync_end - sync_i) : (SYNC_DATA_SIZE - sync_i);
+                if (n > i2s_write_len - i) {n = i2s_write_len - i;}
+
+                if (cache_ready && !cache_invalid) {
+                    int j = sync_i - out.start;
+                    if (j < 0) {j += SYNC_DATA_SIZE;}
+                    const uint64_t *words = cache_words[(cache_variants > 1) ? triggered : 0];
+                    memcpy(i2s_write_buffer + i, words + j, n * sizeof(uint64_t));
+                } else {
+                    fill(i2s_write_buffer + i, sync_data + sync_i, n, sync_i & 1, fill_params);
+                }
+                i += n;
+                sync_i += n;
+                if (sync_i == SYNC_DATA_SIZE) {sync_i = 0;}
 
-                sync_i = (sync_i + 1) % SYNC_DATA_SIZE;
                 if (sync_i == sync_end) {
-                    sync_i = sync_start;
-                    sync_end = (sync_start + sync_cycles) % SYNC_DATA_SIZE;
+                    if (settings_pending) {latch_settings();}
+                    sync_i = out.start;
+                    sync_end = (out.start + out.cycles) % SYNC_DATA_SIZE;
+                    sync_cycle_count ++;
+                    schedule_triggers(sync_cycle_count);
                     if (trigger_count > 0) {
                         triggered = 1;
-                        trigger_count --;
+                        __sync_fetch_and_sub(&trigger_count, 1);
                     } else {
                         triggered = 0;
                     }
+                    fill = prepare_fill();
                 }
-            } else {
+            }
+        } else {
+            for (int i=0; i<i2s_write_len; i++) {
                 i2s_write_buffer[i] = (DAC_SPI_CH0 + ana0_set) << DAC_SHIFT;
             }
         }
 
         // If fixed analog outputs need updating, then update them!
-        if ((analog_update & 1) && !(analog_sync_mode & 1)) {
+        int update = __sync_fetch_and_and(&analog_update, 0);
+        if ((update & 1) && !(out.analog_mode & 1)) {
             i2s_write_buffer[0] = (i2s_write_buffer[0] & I2S_DIG_MASK) + ((DAC_SPI_CH0 + ana0_set) << DAC_SHIFT);
         }
-        if ((analog_update & 2) && !(analog_sync_mode & 2)) {
+        if ((update & 2) && !(out.analog_mode & 2)) {
             i2s_write_buffer[1] = (i2s_write_buffer[1] & I2S_DIG_MASK) + ((DAC_SPI_CH1 + ana1_set) << DAC_SHIFT);
         }
-        analog_update = 0;
 
         if ((!dac_setup_complete) && (t1 > DAC_SETUP_DELAY_US)) {
             i2s_write_buffer[0] = (i2s_write_buffer[0] & I2S_DIG_MASK) + (DAC_SETUP_A << DAC_SHIFT);
@@ -158,6 +380,8 @@ void update_sync() {
         last_bytes_written = bytes_written;
         last_sync_update = micros();
         buffer_update_time = last_sync_update - t1;
+        if (buffer_update_time > buffer_update_time_max) {buffer_update_time_max = buffer_update_time;}
+        perf_add(perf_buffer_update, buffer_update_time);
     } else {
         cycles_since_write++;
     }
@@ -165,10 +389,51 @@ void update_sync() {
     // Try to hand off the buffer to the DMA module.
     // If it's not ready for a new buffer, it will return 0 bytes written, and won't update in the
     //   next pass.
-    i2s_write(I2S_NUM_0, i2s_write_buffer, (size_t)(I2S_WRITE_BUFFER_SIZE*8), &bytes_written, 0);
+    i2s_write(I2S_NUM_0, i2s_write_buffer, (size_t)(i2s_write_len*8), &bytes_written, 0);
+
+    if (bytes_written) {
+        // The queue can't hold more than dma_buf_count * dma_buf_len samples,
+        //   so if it has been longer than that since the last write, the
+        //   output must have run dry in between.
+        unsigned long t = micros();
+        if (last_write) {perf_add(perf_buffer_interval, t - last_write);}
+        if (last_write && sync_active &&
+            ((float)(t - last_write) * sync_rate > 1E6 * (float)(dma_buf_count * dma_buf_len))) {
+            sync_underruns ++;
+        }
+        last_write = t;
+    }
+
+    return bytes_written;
 }
 
+#ifdef SYNC_TASK_ENABLED
+    // The output runs in its own task, so these are only needed without one
+    void update_sync() {}
+    void update_cache() {}
+
+    // Keep the DMA queue full, waking up whenever the driver has sent a buffer.
+    //   The cache is rendered a block at a time in between.
+    static void sync_task(void *param) {
+        i2s_event_t event;
+
+        while (1) {
+            while (feed_i2s()) {}
+            render_cache();
+
+            // Come back sooner if there is more of the cache to render.  (The
+            //   timeout is only a fallback; the DMA is always running.)
+            TickType_t wait = (cache_enabled && !cache_ready) ? 1 : pdMS_TO_TICKS(SYNC_TASK_TIMEOUT_MS);
+            xQueueReceive(i2s_events, &event, wait);
+        }
+    }
+#else
+    void update_sync() {feed_i2s();}
+    void update_cache() {render_cache();}
+#endif
+
 float sync_freq(float freq) {
+    freq_requested = freq;
     float clock_freq = min(max(freq, MIN_FREQ), MAX_FREQ) * 2 * I2S_BIT_DEPTH;
     uint32_t odiv=31, N=63, M=63; //Default to minimum frequency case.
 
@@ -0,0 +1,23 @@
+"""
+Host side tests, which run against the device emulator (`emu://`), so no
+hardware is needed:
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import pytest
+
+# Test the package in this tree, even if it isn't installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ad_sync import ADSync
+
+
+@pytest.fixture
+def sync():
+    "An ADSync connected to a fresh emulator."
+    sync = ADSync("emu://")
+    yield sync
+    sync.close()
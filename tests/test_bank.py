@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from ad_sync import ADSyncError
+
+
+def test_update_bank(sync):
+    # Each upload goes to the bank which isn't being output
+    rng = np.random.default_rng(1)
+    half = sync.MAX_ADDR // 2
+    sync.addr(0, 1000)
+    sync.start()
+    dev = sync.ser.emulator
+    for bank in (1, 0, 1):
+        data = (rng.integers(0, 4, 2000, dtype='u4') << 16) | 0x8000
+        assert sync.update_bank(data) == bank * half
+        assert (dev.sync_start, dev.sync_cycles) == (bank * half, len(data))
+        assert np.array_equal(sync.read(bank * half, len(data)), data)
+
+
+def test_write_to_end(sync):
+    # Uploads which end at the last sample of memory (e.g. a full bank 1),
+    #   with data which is sent unpacked as it doesn't compress
+    rng = np.random.default_rng(2)
+    half = sync.MAX_ADDR // 2
+    sync.addr(0, 1000)
+    sync.start()
+    data = rng.integers(0, 1 << 32, half, dtype='u4')
+    assert sync.update_bank(data) == half
+    assert np.array_equal(sync.read(half, half), data)
+
+    for n in (1, 2, 4, 8, 16):
+        data = rng.integers(0, 1 << 32, n, dtype='u4')
+        sync.write(sync.MAX_ADDR - n, data, packed=False)
+        assert np.array_equal(sync.read(sync.MAX_ADDR - n, n), data)
+
+    with pytest.raises(ADSyncError):
+        sync.write(sync.MAX_ADDR - 4, np.arange(8), packed=False)
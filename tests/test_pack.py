@@ -0,0 +1,37 @@
+import numpy as np
+from ad_sync import pack
+from ad_sync.profile import ScanSpec, compile_scan
+
+
+def _data():
+    rng = np.random.default_rng(0)
+    yield compile_scan(ScanSpec(fpv=100)).sync_data()
+    yield compile_scan(ScanSpec(fpv=300, channels=2)).sync_data()
+    yield rng.integers(0, 1 << 32, 1000, dtype='u4')
+    yield np.zeros(1, dtype='u4')
+
+
+def test_round_trip():
+    for data in _data():
+        assert np.array_equal(pack.unpack(pack.pack(data)), data)
+
+
+def test_digital_keeps_analog():
+    # A stream which has only got as far as the digital section must not
+    #   change the analog half of the memory being output
+    data = compile_scan(ScanSpec(fpv=100)).sync_data()
+    packed = pack.pack(data)
+    old = np.arange(len(data), dtype='u4') * 7919
+    for n in range(1, len(packed), 7):
+        dest = old.copy()
+        unpacker = pack.Unpacker()
+        unpacker.start(dest)
+        unpacker.write(packed[:n])
+        if unpacker.section == 0:
+            assert np.array_equal(dest & 0xFFFF, old & 0xFFFF)
+
+
+def test_packed_write(sync):
+    data = compile_scan(ScanSpec(fpv=100)).sync_data()
+    sync.write(100, data, packed=True)
+    assert np.array_equal(sync.read(100, len(data)), data)
@@ -0,0 +1,14 @@
+import numpy as np
+from ad_sync.firmware import render
+
+
+def test_render_samples():
+    data = np.arange(10, dtype='u4') << 16
+    assert len(render(data, 0, 10)) == 10
+    assert len(render(data, 0, 10, samples=25)) == 25
+    assert len(render(data, 0, 10, trigger_schedule=[0, 1, 0])) == 30
+    # An int counts triggered cycles after the (untriggered) first one
+    dig, ana = render(data, 0, 10, trigger_schedule=3, trigger_mask=0xFFFF,
+                      decode=True)
+    assert len(dig) == 40
+    assert list(dig.reshape(4, 10)[:, 1]) == [0, 1, 1, 1]
@@ -0,0 +1,24 @@
+import numpy as np
+
+
+def test_slots(sync):
+    rng = np.random.default_rng(3)
+    a, b = (rng.integers(0, 1 << 32, n, dtype='u4') for n in (4000, 5000))
+    assert sync.upload_slot('a', a) == 0
+    assert sync.upload_slot('b', b) == 4000
+    sync.select('b')
+    dev = sync.ser.emulator
+    assert (dev.sync_start, dev.sync_cycles) == (4000, 5000)
+    assert np.array_equal(sync.read(4000, 5000), b)
+
+
+def test_output_protected(sync):
+    # The range being output is protected, even if the host has forgotten it
+    data = np.arange(1000, dtype='u4')
+    sync.write(0, data)
+    sync.addr(0, 1000)
+    sync.start()
+    sync.invalidate_settings()
+    addr = sync.upload_slot('x', np.ones(500, dtype='u4'))
+    assert addr >= 1000
+    assert np.array_equal(sync.read(0, 1000), data)
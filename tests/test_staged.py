@@ -0,0 +1,21 @@
+def test_staged(sync):
+    dev = sync.ser.emulator
+    sync.start()
+    with sync.staged():
+        sync.addr(5, 10)
+        sync.trigger_mask(3)
+        assert dev.output['sync_start'] == 0
+    assert dev.output['sync_start'] == 5
+    assert dev.output['trigger_mask'] == 3
+
+
+def test_hold(sync):
+    # Nothing is latched while the settings are held, even if asked to
+    dev = sync.ser.emulator
+    dev.settings_hold = 1
+    dev.sync_start = 7
+    dev.latch_settings()
+    assert dev.output['sync_start'] == 0
+    dev.settings_hold = 0
+    dev.latch_settings()
+    assert dev.output['sync_start'] == 7
@@ -0,0 +1,40 @@
+import asyncio
+from ad_sync import ADSync
+from ad_sync.aio import AsyncADSync
+
+
+def _run(sync):
+    sync.rate(1000)
+    sync.addr(0, 10)
+    sync.trigger_program([(5, 3), (2, 4)])
+    sync.trigger_start()
+    sync.start()
+    sync.wait_trigger(timeout=2)
+    return sync.ser.clock, sync.cycle_count(), sync.trigger_status()
+
+
+def test_wait_trigger(sync):
+    # The emulator runs on the virtual clock of the link, so this is exactly
+    #   repeatable: 100 cycles/s, and the last triggered cycle is 15
+    clock, count, status = _run(sync)
+    assert 0.14 < clock < 0.17
+    assert count == 16
+    assert status['entry'] == 2 and not status['running']
+    sync.close()
+
+    assert _run(ADSync("emu://")) == (clock, count, status)
+
+
+def test_wait_trigger_async():
+    async def main():
+        sync = await AsyncADSync.open("emu://")
+        await sync.rate(1000)
+        await sync.addr(0, 10)
+        await sync.start()
+        count = await sync.cycle_count()
+        await sync.trigger_at(count + 20, 5)
+        await sync.wait_trigger(timeout=2)
+        assert await sync.cycle_count() >= count + 24
+        await sync.aclose()
+
+    asyncio.run(main())